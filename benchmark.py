@@ -0,0 +1,259 @@
+# benchmark.py
+# Benchmark y regresión del pipeline sobre los casos de test/test_case.txt, sin red:
+#   python benchmark.py                                   # replay de test/bench_recordings.json
+#   python benchmark.py --output bench_baseline.json      # guarda la línea base
+#   python benchmark.py --compare bench_baseline.json     # compara contra una línea base
+#   python benchmark.py --record                          # regraba con la API real (requiere OPENAI_API_KEY)
+#   python benchmark.py --samples 5                       # votación de 5 muestras por paso (exactitud por dólar)
+
+import re
+import sys
+import json
+import time
+import types
+import hashlib
+import argparse
+import threading
+from typing import Optional, Dict, List, Any, Tuple
+
+import reasoning_core
+from reasoning_core import (
+    MODEL_NAME, CONTEXT_POLICY, ARITHMETIC_ENGINE_ENABLED, SELF_CONSISTENCY_SAMPLES, SYSTEM_PROMPT_COMUN,
+    crear_cliente_openai, estimar_tokens, proceso_razonamiento_llm_calculator,
+    mensajes_descompositor, mensajes_verificador_plan, mensajes_solucionador, mensajes_sintetizador,
+)
+
+# --- Configuración ---
+CASES_PATH = "test/test_case.txt"
+RECORDINGS_PATH = "test/bench_recordings.json"
+CORRECTNESS_TOLERANCE = 0.01 # Error relativo aceptado sobre el total esperado
+PROMPT_CACHE_MIN_TOKENS, PROMPT_CACHE_INCREMENT = 1024, 128 # Caché de prefijos del proveedor: desde 1024 tokens, de a 128
+CASE_RE = re.compile(r'^CASE\s*(\d+)\s*:', re.IGNORECASE | re.MULTILINE)
+EXPECTED_RE = re.compile(r'^\s*TOTAL\s+ESPERADO\s*:\s*\$?\s*(-?[\d,]+(?:\.\d+)?)\s*$', re.IGNORECASE | re.MULTILINE)
+SEPARATOR_RE = re.compile(r'^-{5,}\s*$', re.MULTILINE)
+NUMBER_RE = re.compile(r'-?\d[\d,]*(?:\.\d+)?')
+TASK_PREFIX = "Ejecuta y detalla este paso del plan: "
+
+def _sistema_rol(messages: List[Dict]) -> str:
+    """Instrucciones del rol: el prompt de sistema sin el prompt común a todos los agentes."""
+    sistema = next((m["content"] for m in messages if m.get("role") == "system"), "")
+    return sistema[len(SYSTEM_PROMPT_COMUN):].lstrip() if sistema.startswith(SYSTEM_PROMPT_COMUN) else sistema
+
+# Cada agente se reconoce por el inicio de su prompt de sistema; rol -> etapa del pipeline
+ROLES = {
+    "descompositor": (_sistema_rol(mensajes_descompositor(""))[:40], "decomposing"),
+    "verificador": (_sistema_rol(mensajes_verificador_plan("", ""))[:40], "verifying"),
+    "solucionador": (_sistema_rol(mensajes_solucionador("", ""))[:40], "solving"),
+    "sintetizador": (_sistema_rol(mensajes_sintetizador("", "", {}))[:40], "synthesizing"),
+}
+
+# --- Casos de prueba ---
+def leer_casos(path: str = CASES_PATH) -> List[Dict[str, Any]]:
+    """Parsea los bloques 'CASE N:' (pregunta + línea 'TOTAL ESPERADO: X') del archivo de casos."""
+    with open(path, encoding="utf-8") as f: texto = f.read()
+    marcas = list(CASE_RE.finditer(texto)); casos = []
+    for n, m in enumerate(marcas):
+        bloque = texto[m.end(): marcas[n + 1].start() if n + 1 < len(marcas) else len(texto)]
+        bloque = SEPARATOR_RE.split(bloque)[0]
+        esperado = EXPECTED_RE.search(bloque)
+        pregunta = EXPECTED_RE.sub("", bloque).strip()
+        casos.append({"id": f"CASE{m.group(1)}", "question": pregunta,
+                      "expected": float(esperado.group(1).replace(',', '')) if esperado else None})
+    return casos
+
+def extraer_total(respuesta: Optional[str]) -> Optional[float]:
+    """Último número de la respuesta final ('Costo Total: 6,059.57' -> 6059.57)."""
+    numeros = NUMBER_RE.findall(respuesta or "")
+    try: return float(numeros[-1].replace(',', '')) if numeros else None
+    except ValueError: return None
+
+# --- Cliente LLM de grabación/reproducción ---
+class FaltaGrabacion(Exception):
+    """La llamada no tiene respuesta grabada (hay que regrabar con --record)."""
+
+def rol_mensajes(messages: List[Dict]) -> str:
+    sistema = _sistema_rol(messages)
+    for rol, (prefijo, _) in ROLES.items():
+        if sistema.startswith(prefijo): return rol
+    raise FaltaGrabacion(f"Prompt de sistema no reconocido: {sistema[:60]!r}")
+
+def _huella_mensajes(messages: List[Dict]) -> str:
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class ClienteReplay:
+    """Cliente compatible con 'client.chat.completions.create' que reproduce respuestas grabadas.
+
+    Las respuestas se indexan por rol del agente (y por texto del paso para el Solucionador), no por
+    el prompt exacto: así un cambio de prompt o de política de contexto se puede medir sin regrabar.
+    Los tokens de prompt son los grabados si el prompt no cambió; si cambió, se estiman del prompt real.
+    Con 'cliente_real' las llamadas sin grabación se envían a la API y se graban. Las llamadas con 'n'
+    (votación) reproducen en orden las muestras grabadas ("samples"), o repiten la única respuesta.
+    Simula la caché de prefijos del proveedor: 'prompt_tokens_details.cached_tokens' es el prefijo
+    más largo compartido con un prompt anterior (desde PROMPT_CACHE_MIN_TOKENS, de a PROMPT_CACHE_INCREMENT).
+    """
+
+    def __init__(self, grabacion: Dict[str, Any], cliente_real: Optional[Any] = None):
+        self.grabacion = grabacion; self.cliente_real = cliente_real
+        self.llamadas: List[Dict[str, Any]] = []; self._lock = threading.Lock(); self._usadas: Dict[Tuple[str, Optional[str]], int] = {}
+        self._prompts: List[str] = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _clave(self, messages: List[Dict]) -> Tuple[str, Optional[str]]:
+        rol = rol_mensajes(messages)
+        if rol != "solucionador": return rol, None
+        tarea = messages[-1]["content"]
+        return rol, tarea[tarea.rindex(TASK_PREFIX) + len(TASK_PREFIX):].strip() if TASK_PREFIX in tarea else tarea.strip()
+
+    def _prefijo_compartido(self, messages: List[Dict]) -> int:
+        """Tokens (estimados) del prefijo más largo que este prompt comparte con uno anterior."""
+        texto = "".join(f"<{m['role']}>{m.get('content') or ''}" for m in messages); largo = 0
+        for previo in self._prompts:
+            n = next((i for i, (a, b) in enumerate(zip(texto, previo)) if a != b), min(len(texto), len(previo))); largo = max(largo, n)
+        self._prompts.append(texto)
+        return estimar_tokens(texto[:largo]) if largo else 0
+
+    def _grabada(self, rol: str, paso: Optional[str]) -> Optional[Dict[str, Any]]:
+        entrada = self.grabacion.get(rol)
+        return (entrada or {}).get(paso) if paso is not None else entrada
+
+    def _create(self, model: str, messages: List[Dict], temperature: float = 0.1, **kwargs):
+        if kwargs.get("stream"): raise ValueError("ClienteReplay no soporta streaming.")
+        rol, paso = self._clave(messages); huella = _huella_mensajes(messages); n = kwargs.get("n", 1)
+        with self._lock: grabada = self._grabada(rol, paso)
+        inicio = time.perf_counter()
+        if grabada is None:
+            if self.cliente_real is None: raise FaltaGrabacion(f"Sin grabación para {rol}" + (f" / {paso[:60]!r}" if paso else ""))
+            respuesta = self.cliente_real.chat.completions.create(model=model, messages=messages, temperature=temperature, n=n)
+            grabada = {"content": respuesta.choices[0].message.content, "prompt_sha256": huella,
+                       "prompt_tokens": respuesta.usage.prompt_tokens, "completion_tokens": round(respuesta.usage.completion_tokens / len(respuesta.choices))}
+            if n > 1: grabada["samples"] = [c.message.content for c in respuesta.choices]
+            with self._lock:
+                if paso is None: self.grabacion[rol] = grabada
+                else: self.grabacion.setdefault(rol, {})[paso] = grabada
+        prompt_tokens = grabada["prompt_tokens"] if grabada.get("prompt_sha256") == huella else estimar_tokens(json.dumps(messages, ensure_ascii=False))
+        muestras = grabada.get("samples") or [grabada["content"]]
+        with self._lock: usadas = self._usadas.get((rol, paso), 0); self._usadas[(rol, paso)] = usadas + n
+        contenidos = [muestras[(usadas + k) % len(muestras)] for k in range(n)]
+        completion_tokens = grabada["completion_tokens"] * n
+        with self._lock: prefijo = min(self._prefijo_compartido(messages), prompt_tokens)
+        cached_tokens = prefijo // PROMPT_CACHE_INCREMENT * PROMPT_CACHE_INCREMENT if prefijo >= PROMPT_CACHE_MIN_TOKENS else 0
+        usage = types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens,
+                                      prompt_tokens_details=types.SimpleNamespace(cached_tokens=cached_tokens))
+        with self._lock: self.llamadas.append({"stage": ROLES[rol][1], "prompt_tokens": prompt_tokens, "completion_tokens": usage.completion_tokens,
+                                               "prefix_tokens": prefijo, "cached_tokens": cached_tokens, "seconds": time.perf_counter() - inicio})
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=c)) for c in contenidos], usage=usage)
+
+# --- Ejecución del benchmark ---
+def ejecutar_caso(caso: Dict[str, Any], grabacion: Dict[str, Any], cliente_real: Optional[Any] = None,
+                  model_name: str = MODEL_NAME) -> Dict[str, Any]:
+    """Corre un caso completo con proceso_razonamiento_llm_calculator y arma sus métricas."""
+    cliente = ClienteReplay(grabacion, cliente_real)
+    inicio = time.perf_counter()
+    results = proceso_razonamiento_llm_calculator(cliente, model_name, caso["question"])
+    total_s = time.perf_counter() - inicio
+    etapas: Dict[str, Dict[str, Any]] = {}
+    for _, etapa in ROLES.values():
+        llamadas = [c for c in cliente.llamadas if c["stage"] == etapa]
+        etapas[etapa] = {"seconds": round(results.get("stage_seconds", {}).get(etapa, 0.0), 4), "calls": len(llamadas),
+                         "prompt_tokens": sum(c["prompt_tokens"] for c in llamadas), "completion_tokens": sum(c["completion_tokens"] for c in llamadas)}
+    obtenido = extraer_total(results.get("respuesta_final"))
+    esperado = caso["expected"]
+    correcto = (obtenido is not None and esperado is not None and abs(obtenido - esperado) <= CORRECTNESS_TOLERANCE * abs(esperado))
+    token_report = results.get("token_report", {})
+    pasos_llm = [sp["duration_s"] for sp in results.get("spans", []) if sp["kind"] == "step" and not sp.get("local")]
+    return {
+        "expected": esperado, "answer": obtenido, "correct": correcto, "error_message": results.get("error_message"),
+        "seconds": round(total_s, 4), "calls": len(cliente.llamadas),
+        "prompt_tokens": sum(e["prompt_tokens"] for e in etapas.values()), "completion_tokens": sum(e["completion_tokens"] for e in etapas.values()),
+        "prefix_tokens": sum(c["prefix_tokens"] for c in cliente.llamadas), "cached_tokens": token_report.get("prompt_cached", 0),
+        "cost_total": round(token_report.get("cost_total", 0.0), 8), "local_steps": results.get("local_steps", []), "stages": etapas,
+        "step_seconds": round(sum(pasos_llm) / len(pasos_llm), 4) if pasos_llm else None, "votes": results.get("vote_report", {}).get("steps", {})
+    }
+
+def ejecutar_benchmark(casos: List[Dict[str, Any]], grabaciones: Dict[str, Any], cliente_real: Optional[Any] = None,
+                       model_name: str = MODEL_NAME, muestras: int = SELF_CONSISTENCY_SAMPLES) -> Dict[str, Any]:
+    """Corre todos los casos (sin cachés ni checkpoints, para medir el pipeline) y devuelve el reporte.
+
+    'muestras' > 1 activa la votación del Solucionador; el total informa exactitud por dólar
+    (casos correctos / costo) y la latencia media de los pasos resueltos por el LLM.
+    """
+    previos = reasoning_core.LLM_CACHE_ENABLED, reasoning_core.RUN_STORE_ENABLED, reasoning_core.PLAN_CACHE_ENABLED, reasoning_core.SELF_CONSISTENCY_SAMPLES
+    reasoning_core.LLM_CACHE_ENABLED = reasoning_core.RUN_STORE_ENABLED = reasoning_core.PLAN_CACHE_ENABLED = False
+    reasoning_core.SELF_CONSISTENCY_SAMPLES = muestras
+    try: resultados = {c["id"]: ejecutar_caso(c, grabaciones.setdefault(c["id"], {}), cliente_real, model_name) for c in casos}
+    finally: reasoning_core.LLM_CACHE_ENABLED, reasoning_core.RUN_STORE_ENABLED, reasoning_core.PLAN_CACHE_ENABLED, reasoning_core.SELF_CONSISTENCY_SAMPLES = previos
+    totales = {k: round(sum(r[k] for r in resultados.values()), 8) for k in ("seconds", "calls", "prompt_tokens", "completion_tokens", "prefix_tokens", "cached_tokens", "cost_total")}
+    totales["correct"] = sum(1 for r in resultados.values() if r["correct"]); totales["cases"] = len(resultados)
+    totales["correct_per_usd"] = round(totales["correct"] / totales["cost_total"], 2) if totales["cost_total"] else None
+    latencias = [r["step_seconds"] for r in resultados.values() if r["step_seconds"] is not None]
+    totales["step_seconds"] = round(sum(latencias) / len(latencias), 4) if latencias else None
+    return {"model": model_name, "context_policy": CONTEXT_POLICY, "arithmetic_engine": ARITHMETIC_ENGINE_ENABLED, "samples": muestras,
+            "cases": resultados, "totals": totales}
+
+# --- Comparación contra una línea base ---
+METRICAS_COMPARADAS = ("correct", "calls", "prompt_tokens", "completion_tokens", "prefix_tokens", "cached_tokens", "cost_total", "seconds",
+                       "correct_per_usd", "step_seconds")
+
+def comparar_con_linea_base(actual: Dict[str, Any], base: Dict[str, Any]) -> Tuple[List[str], bool]:
+    """Devuelve (líneas del diff, hay_regresión). Regresión = un caso que era correcto y ya no lo es."""
+    lineas = []; regresion = False
+    filas = [(cid, actual["cases"][cid], base["cases"].get(cid)) for cid in actual["cases"]] + [("TOTAL", actual["totals"], base.get("totals"))]
+    for cid, nuevo, viejo in filas:
+        if viejo is None: lineas.append(f"{cid}: (sin línea base)"); continue
+        cambios = []
+        for metrica in METRICAS_COMPARADAS:
+            a, b = nuevo.get(metrica), viejo.get(metrica)
+            if a == b or a is None or b is None: continue
+            if isinstance(a, bool): cambios.append(f"{metrica} {b} -> {a}"); regresion = regresion or (b and not a); continue
+            delta = f" ({(a - b) / b:+.1%})" if b else ""
+            cambios.append(f"{metrica} {b} -> {a}{delta}")
+        lineas.append(f"{cid}: " + ("; ".join(cambios) if cambios else "sin cambios"))
+    return lineas, regresion
+
+def imprimir_reporte(reporte: Dict[str, Any]) -> None:
+    print(f"\n=== Benchmark ({reporte['model']}, contexto={reporte['context_policy']}, motor aritmético={reporte['arithmetic_engine']}, "
+          f"muestras por paso={reporte.get('samples', 1)}) ===")
+    print(f"{'Caso':<8} {'OK':<3} {'Esperado':>10} {'Obtenido':>10} {'Llamadas':>8} {'Prompt':>8} {'Compl.':>7} {'Costo USD':>10} {'Tiempo s':>9}")
+    for cid, r in reporte["cases"].items():
+        print(f"{cid:<8} {'✔' if r['correct'] else '✘':<3} {r['expected'] or '-':>10} {r['answer'] if r['answer'] is not None else '-':>10} "
+              f"{r['calls']:>8} {r['prompt_tokens']:>8} {r['completion_tokens']:>7} {r['cost_total']:>10.6f} {r['seconds']:>9.3f}")
+        for etapa, m in r["stages"].items():
+            print(f"    {etapa:<13} {m['calls']:>3} llamadas  {m['prompt_tokens']:>6} prompt  {m['completion_tokens']:>5} compl.  {m['seconds']:.3f}s")
+        for paso, v in r.get("votes", {}).items():
+            print(f"    {paso:<13} votos {v['votes']}/{v['samples']} ({'consenso' if v['consensus'] else 'sin consenso'}), {v['requests']} pedidos, {v['seconds']:.3f}s, ${v['cost_usd']:.6f}")
+        if r["error_message"]: print(f"    Error: {r['error_message']}")
+    t = reporte["totals"]
+    print(f"TOTAL: {t['correct']}/{t['cases']} correctos, {t['calls']} llamadas, {t['prompt_tokens']} + {t['completion_tokens']} tokens, ${t['cost_total']:.6f}, {t['seconds']:.3f}s")
+    print(f"       prefijo compartido con llamadas previas: {t.get('prefix_tokens', 0)} tokens ({t.get('cached_tokens', 0)} cacheados por el proveedor)")
+    if t.get("correct_per_usd") is not None: print(f"       {t['correct_per_usd']} casos correctos por dólar; latencia media por paso LLM: {t['step_seconds'] or 0:.3f}s")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark determinista del pipeline sobre test/test_case.txt.")
+    parser.add_argument("--cases", default=CASES_PATH); parser.add_argument("--recordings", default=RECORDINGS_PATH)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--samples", type=int, default=SELF_CONSISTENCY_SAMPLES, help="Muestras por paso del Solucionador (votación; 1 = sin votación).")
+    parser.add_argument("--record", action="store_true", help="Completa las grabaciones faltantes llamando a la API real.")
+    parser.add_argument("--output", help="Guarda el reporte JSON (línea base).")
+    parser.add_argument("--compare", help="Reporte JSON previo contra el que comparar.")
+    args = parser.parse_args(argv)
+    try:
+        with open(args.recordings, encoding="utf-8") as f: grabaciones = json.load(f)
+    except FileNotFoundError: grabaciones = {}
+    casos = leer_casos(args.cases)
+    reporte = ejecutar_benchmark(casos, grabaciones, crear_cliente_openai() if args.record else None, args.model, args.samples)
+    imprimir_reporte(reporte)
+    if args.record:
+        with open(args.recordings, "w", encoding="utf-8") as f: json.dump(grabaciones, f, ensure_ascii=False, indent=2)
+        print(f"Grabaciones actualizadas en {args.recordings}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(reporte, f, ensure_ascii=False, indent=2)
+        print(f"Reporte guardado en {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: base = json.load(f)
+        lineas, regresion = comparar_con_linea_base(reporte, base)
+        print(f"\n=== Diferencias vs {args.compare} ==="); print("\n".join(lineas))
+        if regresion: print("!!! Regresión de exactitud respecto de la línea base."); return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# reasoning_cli.py
+# Uso sin interfaz gráfica del motor de razonamiento (reasoning_core):
+#   python reasoning_cli.py run --input preguntas.jsonl --output resultados.jsonl
+#   cat preguntas.jsonl | python reasoning_cli.py run
+#   python reasoning_cli.py resume <run_id>     # retoma una ejecución interrumpida
+#   python reasoning_cli.py serve --port 8000   ->  POST /reason {"question": "..."}, GET /metrics (Prometheus), GET /trace/<run_id> (JSONL)
+
+import sys
+import json
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, List, Any, IO
+
+from reasoning_core import (
+    MODEL_NAME, MAX_BATCH_CONCURRENCY, ERROR_RUN_ID_DESCONOCIDO,
+    crear_cliente_openai, get_planificador_llm, get_almacen_ejecuciones, get_trazador, get_plan_cache, proceso_razonamiento_llm_calculator, proceso_razonamiento_batch,
+)
+
+# --- Lectura/Escritura JSONL ---
+def leer_preguntas_jsonl(origen: IO[str]) -> List[Dict[str, Any]]:
+    """Lee líneas JSON {"id"?, "question"}; las líneas vacías se ignoran. El id por defecto es el número de línea."""
+    preguntas = []
+    for n, linea in enumerate(origen, start=1):
+        if not linea.strip(): continue
+        try: registro = json.loads(linea)
+        except json.JSONDecodeError as e: raise ValueError(f"Línea {n}: JSON inválido ({e})")
+        if not isinstance(registro, dict) or not str(registro.get("question", "")).strip(): raise ValueError(f"Línea {n}: falta el campo 'question'.")
+        preguntas.append({"id": registro.get("id", n), "question": registro["question"]})
+    return preguntas
+
+def presupuesto_args(args: argparse.Namespace) -> Optional[Dict[str, Any]]:
+    """Límites por ejecución pasados por línea de comandos (None = los de RUN_MAX_COST_USD / RUN_MAX_TOKENS)."""
+    presupuesto = {k: v for k, v in (("max_cost_usd", args.max_cost), ("max_tokens", args.max_tokens)) if v is not None}
+    return presupuesto or None
+
+def comando_run(args: argparse.Namespace) -> int:
+    origen = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    try: preguntas = leer_preguntas_jsonl(origen)
+    finally:
+        if origen is not sys.stdin: origen.close()
+    if not preguntas: print("No hay preguntas en la entrada.", file=sys.stderr); return 1
+    resultados = proceso_razonamiento_batch([p["question"] for p in preguntas], max_concurrency=args.max_concurrency, model_name=args.model,
+                                            presupuesto=presupuesto_args(args))
+    destino = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for pregunta, resultado in zip(preguntas, resultados):
+            destino.write(json.dumps({"id": pregunta["id"], **resultado}, ensure_ascii=False) + "\n")
+    finally:
+        if destino is not sys.stdout: destino.close()
+    fallidas = sum(1 for r in resultados if r.get("error_message"))
+    print(f"{len(resultados)} preguntas procesadas ({fallidas} con error).", file=sys.stderr)
+    return 0 if fallidas == 0 else 2
+
+def comando_resume(args: argparse.Namespace) -> int:
+    if get_almacen_ejecuciones() is None: print("El almacén de ejecuciones está deshabilitado (RUN_STORE_ENABLED=0).", file=sys.stderr); return 1
+    if args.run_id is None:
+        for run in get_almacen_ejecuciones().listar(): print(f"{run['run_id']}\t{run['stage']}\t{run['question'][:70]!r}")
+        return 0
+    resultado = proceso_razonamiento_llm_calculator(crear_cliente_openai(), args.model, "", run_id=args.run_id, presupuesto=presupuesto_args(args))
+    print(json.dumps(resultado, ensure_ascii=False))
+    if resultado.get("error_message") == ERROR_RUN_ID_DESCONOCIDO: print(f"No hay una ejecución guardada con id {args.run_id}.", file=sys.stderr); return 1
+    return 0 if not resultado.get("error_message") else 2
+
+# --- Servicio HTTP ---
+class ServicioRazonamiento(BaseHTTPRequestHandler):
+    """POST /reason {"question": "..."} (o {"run_id": "..."} para reanudar) -> resultados en JSON; GET /health -> {"status": "ok"}; GET /metrics -> Prometheus.
+
+    El cuerpo puede traer "max_cost_usd" y "max_tokens" para limitar esa ejecución.
+    """
+    model_name: str = MODEL_NAME
+    presupuesto: Optional[Dict[str, Any]] = None
+    _client = None; _client_lock = threading.Lock()
+
+    @classmethod
+    def cliente(cls):
+        with cls._client_lock: # Un único cliente compartido, creado en la primera petición
+            if cls._client is None: cls._client = crear_cliente_openai()
+            return cls._client
+
+    def _responder(self, status: int, cuerpo: Dict[str, Any]) -> None:
+        self._enviar(status, json.dumps(cuerpo, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+    def _enviar(self, status: int, datos: bytes, tipo: str) -> None:
+        self.send_response(status); self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(datos))); self.end_headers(); self.wfile.write(datos)
+
+    def do_GET(self):
+        if self.path == "/health": self._responder(200, {"status": "ok", "model": self.model_name, "scheduler": get_planificador_llm().stats,
+                                                    "plan_cache": get_plan_cache().stats() if get_plan_cache() else None})
+        elif self.path == "/metrics": self._enviar(200, get_trazador().metricas_prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        elif self.path.startswith("/trace/"): self._enviar(200, get_trazador().exportar_jsonl(self.path[len("/trace/"):]).encode("utf-8"), "application/x-ndjson; charset=utf-8")
+        else: self._responder(404, {"error_message": f"Ruta no encontrada: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/reason": self._responder(404, {"error_message": f"Ruta no encontrada: {self.path}"}); return
+        try:
+            cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            pregunta = str(cuerpo.get("question", "")).strip() if isinstance(cuerpo, dict) else ""
+            run_id = cuerpo.get("run_id") if isinstance(cuerpo, dict) else None
+            presupuesto = {**(self.presupuesto or {}), **{k: (float if k == "max_cost_usd" else int)(cuerpo[k]) for k in ("max_cost_usd", "max_tokens")
+                                                         if isinstance(cuerpo, dict) and cuerpo.get(k) is not None}}
+        except (ValueError, TypeError, json.JSONDecodeError) as e: self._responder(400, {"error_message": f"JSON inválido: {e}"}); return
+        if not pregunta and not run_id: self._responder(400, {"error_message": "Falta el campo 'question' (o 'run_id')."}); return
+        try: resultado = proceso_razonamiento_llm_calculator(self.cliente(), self.model_name, pregunta, run_id=run_id, presupuesto=presupuesto or None)
+        except Exception as e: self._responder(500, {"error_message": f"Error inesperado: {e}"}); return
+        self._responder(404 if resultado.get("error_message") == ERROR_RUN_ID_DESCONOCIDO else 200, resultado)
+
+def comando_serve(args: argparse.Namespace) -> int:
+    ServicioRazonamiento.model_name = args.model; ServicioRazonamiento.presupuesto = presupuesto_args(args)
+    servidor = ThreadingHTTPServer((args.host, args.port), ServicioRazonamiento)
+    print(f"Servicio de razonamiento en http://{args.host}:{args.port} (POST /reason, GET /health, GET /metrics, GET /trace/<run_id>)", file=sys.stderr)
+    try: servidor.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: servidor.server_close()
+    return 0
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Motor de razonamiento LLM sin interfaz gráfica.")
+    parser.add_argument("--model", default=MODEL_NAME, help=f"Modelo a usar (por defecto {MODEL_NAME}).")
+    parser.add_argument("--max-cost", type=float, default=None, help="Costo máximo (USD) por ejecución.")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Tokens máximos por ejecución.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_run = sub.add_parser("run", help="Procesa un archivo JSONL de preguntas ({\"id\"?, \"question\"} por línea).")
+    p_run.add_argument("--input", default="-", help="Archivo JSONL de entrada ('-' = stdin).")
+    p_run.add_argument("--output", default="-", help="Archivo JSONL de salida ('-' = stdout).")
+    p_run.add_argument("--max-concurrency", type=int, default=MAX_BATCH_CONCURRENCY, help="Máximo de llamadas LLM simultáneas.")
+    p_run.set_defaults(func=comando_run)
+    p_resume = sub.add_parser("resume", help="Retoma una ejecución guardada desde su último paso bueno (sin id: lista las pendientes).")
+    p_resume.add_argument("run_id", nargs="?")
+    p_resume.set_defaults(func=comando_resume)
+    p_serve = sub.add_parser("serve", help="Expone POST /reason como servicio HTTP.")
+    p_serve.add_argument("--host", default="127.0.0.1"); p_serve.add_argument("--port", type=int, default=8000)
+    p_serve.set_defaults(func=comando_serve)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
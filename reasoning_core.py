@@ -0,0 +1,2206 @@
+# reasoning_core.py
+"""Motor de razonamiento (CoT simulada) independiente de la interfaz.
+
+Contiene agentes, caché, DAG de pasos, motor aritmético, contexto y orquestadores. No importa
+Streamlit y difiere la importación de 'openai' hasta que se crea un cliente o se hace una
+llamada, para que importar el módulo (CLI, servicio HTTP, tests) sea barato.
+"""
+from __future__ import annotations
+
+import os
+import re
+import asyncio
+import contextvars
+import ast
+import json
+import time
+import random
+import types
+import hashlib
+import uuid
+import sqlite3
+import threading
+import traceback
+import copy
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Tuple, List, Any, Set, Callable, Generator, TYPE_CHECKING
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+if TYPE_CHECKING: # Sólo para anotaciones: 'openai' se importa de forma perezosa
+    from openai import OpenAI, AsyncOpenAI
+
+# --- 1. Configuración Inicial y Constantes ---
+MODEL_NAME = "gpt-4o-mini" # Modelo potente recomendado
+PI_VALUE = math.pi
+PI_DISPLAY = "π"
+
+# --- TARIFAS POR MODELO (USD por 1 Millón de Tokens: entrada, salida - Verificar siempre!) ---
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60), "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40), "gpt-4.1-mini": (0.40, 1.60), "gpt-4.1": (2.00, 8.00),
+}
+RATE_INPUT_GPT4O, RATE_OUTPUT_GPT4O = MODEL_PRICING[MODEL_NAME] # Tarifas del modelo por defecto
+# Entrada servida desde la caché de prefijos del proveedor (USD por 1 Millón de tokens 'cached_tokens')
+MODEL_CACHED_INPUT_PRICING: Dict[str, float] = {
+    "gpt-4o-mini": 0.075, "gpt-4o": 1.25, "gpt-4.1-nano": 0.025, "gpt-4.1-mini": 0.10, "gpt-4.1": 0.50,
+}
+
+# --- Ruteo de modelos y presupuesto por ejecución (ver modelo_para_llamada y PresupuestoEjecucion) ---
+ROUTER_SMALL_MODEL = os.environ.get("ROUTER_SMALL_MODEL", "gpt-4.1-nano") # Verificación y pasos con fórmula ("" = sin ruteo)
+RUN_MAX_COST_USD = float(os.environ["RUN_MAX_COST_USD"]) if os.environ.get("RUN_MAX_COST_USD") else None # Costo máximo por ejecución
+RUN_MAX_TOKENS = int(os.environ["RUN_MAX_TOKENS"]) if os.environ.get("RUN_MAX_TOKENS") else None # Tokens máximos por ejecución
+
+# --- Ejecución paralela de pasos independientes del plan ---
+MAX_PARALLEL_STEPS = 4 # Máximo de llamadas concurrentes al Agente Solucionador
+MAX_BATCH_CONCURRENCY = 8 # Máximo de llamadas LLM simultáneas en el modo batch (semáforo global)
+ARITHMETIC_ENGINE_ENABLED = True # Resolver localmente (sin LLM) los pasos que son fórmulas aritméticas
+
+# --- Ejecuciones en segundo plano (ver RegistroEjecuciones) ---
+BACKGROUND_MAX_RUNS = int(os.environ.get("BACKGROUND_MAX_RUNS", "4")) # Ejecuciones simultáneas en el pool compartido (el resto espera en cola)
+BACKGROUND_KEEP_FINISHED = 100 # Ejecuciones terminadas que el registro conserva en memoria
+
+# --- Autoconsistencia del Solucionador (ver agente_solucionador_votacion) ---
+SELF_CONSISTENCY_SAMPLES = int(os.environ.get("SELF_CONSISTENCY_SAMPLES", "1")) # Muestras máximas por paso (1 = sin votación)
+SELF_CONSISTENCY_TEMPERATURE = 0.7 # Temperatura de las muestras (necesita diversidad para que el voto informe algo)
+SELF_CONSISTENCY_TOLERANCE = 1e-3 # Error relativo con el que dos resultados cuentan como el mismo voto
+
+# --- Contexto enviado a cada llamada (ver ContextoRazonamiento) ---
+CONTEXT_POLICY = os.environ.get("CONTEXT_POLICY", "results-only") # "full" | "results-only" | "ancestors-only"
+CONTEXT_TOKEN_BUDGET = 3000 # Tokens (estimados) máximos de contexto por llamada
+
+# --- Caché de respuestas LLM (memoria LRU + SQLite en disco) ---
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", ".llm_cache.sqlite3")
+LLM_CACHE_MEMORY_ENTRIES = 256 # Entradas en el nivel LRU en memoria
+LLM_CACHE_DISK_ENTRIES = 10_000 # Máximo de filas en SQLite (se expulsan las menos usadas)
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600 # Antigüedad máxima de una respuesta cacheada
+LLM_CACHE_MAX_TEMPERATURE = float(os.environ.get("LLM_CACHE_MAX_TEMPERATURE", "0.3")) # Por encima se busca diversidad: no se cachea
+
+# --- Checkpoints de ejecuciones (ver AlmacenEjecuciones) ---
+RUN_STORE_ENABLED = os.environ.get("RUN_STORE_ENABLED", "1") != "0"
+RUN_STORE_PATH = os.environ.get("RUN_STORE_PATH", ".reasoning_runs.sqlite3")
+RUN_STORE_MAX_RUNS = int(os.environ.get("RUN_STORE_MAX_RUNS", "1000")) # Ejecuciones guardadas (se borran las menos recientes)
+RUN_STORE_MAX_AGE_DAYS = float(os.environ.get("RUN_STORE_MAX_AGE_DAYS", "30")) # Antigüedad máxima desde la última actualización
+
+# --- Caché semántica de planes (ver PlanTemplateCache) ---
+PLAN_CACHE_ENABLED = os.environ.get("PLAN_CACHE_ENABLED", "1") != "0"
+PLAN_CACHE_PATH = os.environ.get("PLAN_CACHE_PATH", ".plan_cache.sqlite3")
+PLAN_CACHE_MAX_ENTRIES = 500 # Plantillas guardadas (se expulsan las menos usadas)
+PLAN_CACHE_MIN_SIMILARITY = 0.9 # Similitud mínima (n-gramas) para reutilizar un plan de una plantilla parecida
+
+# --- Trazas (ver Trazador) ---
+TRACE_JSONL_PATH = os.environ.get("TRACE_JSONL_PATH") or None # Si se define, cada span cerrado se agrega a este JSONL
+TRACE_MAX_RUNS = 200 # Ejecuciones cuyas trazas se conservan en memoria
+
+# --- Planificador de llamadas LLM (ver PlanificadorLLM) ---
+LLM_RPM_LIMIT = int(os.environ.get("LLM_RPM_LIMIT", "500")) # Peticiones por minuto permitidas (lado cliente)
+LLM_TPM_LIMIT = int(os.environ.get("LLM_TPM_LIMIT", "200000")) # Tokens por minuto permitidos (lado cliente)
+LLM_EXPECTED_COMPLETION_TOKENS = 500 # Tokens de salida reservados por llamada hasta conocer el 'usage' real
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4")) # Reintentos después del primer intento
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 30.0
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", "60")) # Timeout de cada intento
+LLM_CALL_DEADLINE_SECONDS = float(os.environ.get("LLM_CALL_DEADLINE_SECONDS", "180")) # Plazo total (esperas + reintentos)
+LLM_BREAKER_THRESHOLD = 5 # Fallos transitorios seguidos que abren el circuito
+LLM_BREAKER_COOLDOWN_SECONDS = 30.0
+
+# --- Caché de Respuestas LLM Direccionada por Contenido ---
+class LLMResponseCache:
+    """Caché de dos niveles (LRU en memoria + SQLite en disco) con expulsión por tamaño y TTL.
+
+    La clave es un hash del request canonicalizado (modelo, mensajes, temperatura); el
+    'purpose' de la llamada no forma parte de la clave. Las llamadas de muestreo (temperatura
+    sobre LLM_CACHE_MAX_TEMPERATURE o 'n' > 1) no pasan por ella. Es segura para uso entre hilos.
+    """
+
+    def __init__(self, path: Optional[str] = LLM_CACHE_PATH, memory_entries: int = LLM_CACHE_MEMORY_ENTRIES,
+                 disk_entries: int = LLM_CACHE_DISK_ENTRIES, ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.memory_entries = memory_entries; self.disk_entries = disk_entries; self.ttl_seconds = ttl_seconds
+        self.hits = 0; self.misses = 0
+        self._memoria: "OrderedDict[str, Tuple[float, str, int, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY, model TEXT, content TEXT, prompt_tokens INTEGER,
+                completion_tokens INTEGER, created_at REAL, last_access REAL)""")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model_name: str, messages: List[Dict], temperature: float) -> str:
+        """Hash SHA-256 del request canonicalizado."""
+        canonico = json.dumps({"model": model_name, "messages": messages, "temperature": round(float(temperature), 6)},
+                              sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonico.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, int, int]]:
+        """Devuelve (content, prompt_tokens, completion_tokens) originales o None si no hay entrada vigente."""
+        ahora = time.time()
+        with self._lock:
+            entrada = self._memoria.get(key)
+            if entrada and ahora - entrada[0] <= self.ttl_seconds:
+                self._memoria.move_to_end(key); self.hits += 1
+                return entrada[1:]
+            if entrada: del self._memoria[key]
+            if self._db is not None:
+                fila = self._db.execute("SELECT content, prompt_tokens, completion_tokens, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if fila and ahora - fila[3] <= self.ttl_seconds:
+                    self._db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (ahora, key)); self._db.commit()
+                    self._guardar_memoria(key, (fila[3], fila[0], fila[1], fila[2])); self.hits += 1
+                    return fila[0], fila[1], fila[2]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, model_name: str, content: str, prompt_tokens: int, completion_tokens: int) -> None:
+        """Guarda una respuesta exitosa en ambos niveles y aplica la expulsión."""
+        ahora = time.time()
+        with self._lock:
+            self._guardar_memoria(key, (ahora, content, prompt_tokens, completion_tokens))
+            if self._db is None: return
+            self._db.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (key, model_name, content, prompt_tokens, completion_tokens, ahora, ahora))
+            self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (ahora - self.ttl_seconds,))
+            self._db.execute("""DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache
+                                ORDER BY last_access DESC LIMIT -1 OFFSET ?)""", (self.disk_entries,))
+            self._db.commit()
+
+    def _guardar_memoria(self, key: str, entrada: Tuple[float, str, int, int]) -> None:
+        self._memoria[key] = entrada; self._memoria.move_to_end(key)
+        while len(self._memoria) > self.memory_entries: self._memoria.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores globales de aciertos y fallos."""
+        return {"hits": self.hits, "misses": self.misses}
+
+_LLM_CACHE: Optional[LLMResponseCache] = None
+_LLM_CACHE_LOCK = threading.Lock()
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """Devuelve la caché global (creada de forma perezosa) o None si está deshabilitada."""
+    global _LLM_CACHE
+    if not LLM_CACHE_ENABLED: return None
+    with _LLM_CACHE_LOCK:
+        if _LLM_CACHE is None:
+            try: _LLM_CACHE = LLMResponseCache()
+            except sqlite3.Error as e: print(f"Adv: caché en disco no disponible ({e}); se usa sólo memoria."); _LLM_CACHE = LLMResponseCache(path=None)
+        return _LLM_CACHE
+
+def _usage_cacheado(prompt_tokens: int, completion_tokens: int) -> object:
+    """'usage' de un acierto de caché: tokens facturables en cero, conserva los originales."""
+    return types.SimpleNamespace(prompt_tokens=0, completion_tokens=0, cached=True,
+                                 original_prompt_tokens=prompt_tokens, original_completion_tokens=completion_tokens)
+
+def es_cache_hit(usage: Optional[object]) -> bool:
+    """Indica si un 'usage' proviene de la caché."""
+    return bool(getattr(usage, "cached", False))
+
+def registrar_cache(cache_report: Dict[str, int], usage: Optional[object]) -> None:
+    """Acumula aciertos/fallos de caché de una llamada en el reporte de la ejecución."""
+    if usage is None or getattr(usage, "local", False): return
+    cache_report["hits" if es_cache_hit(usage) else "misses"] += 1
+
+def _leer_cache(model_name: str, messages: List[Dict], temperature: float, purpose: str) -> Tuple[Optional[str], Optional[str], Optional[object]]:
+    """Consulta la caché: devuelve (clave, contenido, usage) — contenido/usage en None si no hay acierto.
+
+    Sin clave (tampoco se escribe) si la caché está deshabilitada o la temperatura supera
+    LLM_CACHE_MAX_TEMPERATURE: ahí cada llamada debe traer una muestra nueva.
+    """
+    cache = get_llm_cache()
+    if cache is None or temperature > LLM_CACHE_MAX_TEMPERATURE: return None, None, None
+    key = LLMResponseCache.make_key(model_name, messages, temperature)
+    entrada = cache.get(key)
+    if entrada is None: return key, None, None
+    print(f"Cache HIT ({purpose}): {key[:12]}")
+    return key, entrada[0], _usage_cacheado(entrada[1], entrada[2])
+
+def _escribir_cache(key: Optional[str], model_name: str, content: Optional[str], usage: object) -> None:
+    cache = get_llm_cache()
+    if cache is None or key is None or content is None: return
+    cache.put(key, model_name, content, usage.prompt_tokens, usage.completion_tokens)
+
+
+# --- Planificador de Llamadas LLM (reintentos, límites de tasa, plazos, circuit breaker) ---
+class CircuitoAbiertoError(Exception):
+    """El circuit breaker está abierto: la API viene fallando y se rechaza la llamada sin intentarla."""
+
+def tipo_error_llm(e: Exception) -> str:
+    """Clasifica una excepción del cliente: 'rate_limit', 'timeout', 'transitorio' o 'permanente'."""
+    try: import openai
+    except ImportError: openai = None
+    if openai is not None:
+        if isinstance(e, openai.RateLimitError): return "rate_limit"
+        if isinstance(e, openai.APITimeoutError): return "timeout"
+        if isinstance(e, (openai.APIConnectionError, openai.InternalServerError)): return "transitorio"
+        if isinstance(e, openai.APIStatusError) and (e.status_code in (408, 409) or e.status_code >= 500): return "transitorio"
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)): return "timeout"
+    if isinstance(e, ConnectionError): return "transitorio"
+    return "permanente"
+
+def retry_after_segundos(e: Exception) -> Optional[float]:
+    """Lee 'retry-after-ms' / 'retry-after' (en segundos) de la respuesta HTTP asociada al error, si existe."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    for nombre, escala in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            if headers.get(nombre) is not None: return max(0.0, float(headers[nombre]) * escala)
+        except (TypeError, ValueError): continue # p. ej. 'retry-after' como fecha HTTP
+    return None
+
+class PlanificadorLLM:
+    """Puerta compartida por todas las llamadas LLM del proceso (hilos y tareas asyncio).
+
+    - Presupuesto de peticiones/min y tokens/min con dos cubetas de tokens. Las reservas pueden dejar
+      la cubeta en negativo: cada llamador espera su turno en orden de llegada en vez de competir.
+    - Reintentos con backoff exponencial con jitter completo; un 429 con 'retry-after' pausa a todos.
+    - Plazo total por llamada (incluye esperas y reintentos) y timeout por intento.
+    - Circuit breaker: tras N fallos transitorios seguidos (timeouts, 5xx, conexión) rechaza llamadas
+      durante un enfriamiento; luego deja pasar una sola llamada de prueba. Los errores permanentes
+      (p. ej. un 400 por un prompt inválido) y los 429 no cuentan: la API está respondiendo.
+    """
+
+    def __init__(self, rpm: int = LLM_RPM_LIMIT, tpm: int = LLM_TPM_LIMIT, max_reintentos: int = LLM_MAX_RETRIES,
+                 timeout: float = LLM_CALL_TIMEOUT_SECONDS, plazo: float = LLM_CALL_DEADLINE_SECONDS,
+                 umbral_circuito: int = LLM_BREAKER_THRESHOLD, enfriamiento: float = LLM_BREAKER_COOLDOWN_SECONDS):
+        self.rpm = max(1, rpm); self.tpm = max(1, tpm); self.max_reintentos = max_reintentos
+        self.timeout = timeout; self.plazo = plazo; self.umbral_circuito = umbral_circuito; self.enfriamiento = enfriamiento
+        self._lock = threading.Lock(); self._ultimo = time.monotonic()
+        self._peticiones = float(self.rpm); self._tokens = float(self.tpm); self._pausa_hasta = 0.0
+        self._estado = "cerrado"; self._fallos_seguidos = 0; self._abierto_hasta = 0.0
+        self.stats = {"calls": 0, "attempts": 0, "retries": 0, "rate_limited": 0, "timeouts": 0, "throttled_seconds": 0.0, "circuit_opens": 0}
+
+    # Presupuesto de tasa
+    def _recargar(self, ahora: float) -> None:
+        transcurrido = ahora - self._ultimo; self._ultimo = ahora
+        self._peticiones = min(self.rpm, self._peticiones + transcurrido * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + transcurrido * self.tpm / 60)
+
+    def reservar(self, tokens: int) -> float:
+        """Reserva un turno (1 petición + 'tokens') y devuelve los segundos a esperar antes de usarlo."""
+        with self._lock:
+            ahora = time.monotonic(); self._recargar(ahora); tokens = min(tokens, self.tpm)
+            espera = max(0.0, self._pausa_hasta - ahora, (1 - self._peticiones) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+            self._peticiones -= 1; self._tokens -= tokens; self.stats["throttled_seconds"] += espera
+            return espera
+
+    def ajustar(self, reservados: int, reales: int) -> None:
+        """Corrige la reserva de tokens con el consumo real (devuelve o cobra la diferencia)."""
+        with self._lock: self._tokens = min(self.tpm, self._tokens + min(reservados, self.tpm) - reales)
+
+    # Circuit breaker
+    def _admitir(self) -> bool:
+        """Deja pasar la llamada o lanza CircuitoAbiertoError; True si es la llamada de prueba del circuito semiabierto."""
+        with self._lock:
+            if self._estado == "cerrado": return False
+            restante = self._abierto_hasta - time.monotonic()
+            if self._estado == "abierto" and restante <= 0: self._estado = "semiabierto"; return True # Una llamada de prueba
+            if self._estado == "semiabierto": raise CircuitoAbiertoError("API en observación: hay una llamada de prueba en curso; reintente en unos segundos.")
+            raise CircuitoAbiertoError(f"API no disponible tras {self._fallos_seguidos} fallos seguidos; reintente en {max(0.0, restante):.0f}s.")
+
+    def _liberar_prueba(self) -> None:
+        """La llamada de prueba terminó sin veredicto (p. ej. plazo agotado esperando turno): la próxima llamada vuelve a probar."""
+        with self._lock:
+            if self._estado == "semiabierto": self._estado = "abierto"; self._abierto_hasta = time.monotonic()
+
+    def _registrar_exito(self) -> None:
+        with self._lock: self._estado = "cerrado"; self._fallos_seguidos = 0
+
+    def _registrar_fallo(self, tipo: str) -> None:
+        with self._lock:
+            if tipo == "rate_limit": self.stats["rate_limited"] += 1; return # Cuota, no caída: lo gestiona retry-after
+            if tipo == "permanente": # La API respondió: no es una caída
+                if self._estado == "semiabierto": self._estado = "cerrado"; self._fallos_seguidos = 0
+                return
+            if tipo == "timeout": self.stats["timeouts"] += 1
+            self._fallos_seguidos += 1
+            if self._estado == "semiabierto" or self._fallos_seguidos >= self.umbral_circuito:
+                if self._estado != "abierto": self.stats["circuit_opens"] += 1
+                self._estado = "abierto"; self._abierto_hasta = time.monotonic() + self.enfriamiento
+
+    # Un intento: turno -> llamada -> (éxito | pausa antes del próximo intento)
+    def _preparar_intento(self, tokens: int, limite: float, info: Dict[str, Any]) -> float:
+        if not (info.get("prueba") and self._estado == "semiabierto") and self._admitir(): info["prueba"] = True # Reintentos de la prueba: sin readmitir
+        espera = self.reservar(tokens)
+        if time.monotonic() + espera >= limite:
+            self.ajustar(tokens, 0); raise TimeoutError(f"Plazo de {self.plazo:.0f}s agotado esperando turno de llamada.")
+        info["throttled_seconds"] += espera; info["attempts"] += 1
+        with self._lock: self.stats["attempts"] += 1
+        return espera
+
+    def _pausa_tras_fallo(self, e: Exception, intento: int, tokens: int, limite: float, info: Dict[str, Any], completions: int = 1) -> Optional[float]:
+        """Registra el fallo y devuelve cuánto esperar antes de reintentar (None = no reintentar)."""
+        tipo = tipo_error_llm(e); self._registrar_fallo(tipo)
+        if tipo == "timeout": info["timed_out_tokens"] += max(0, tokens - completions * LLM_EXPECTED_COMPLETION_TOKENS) # El prompt pudo facturarse
+        else: self.ajustar(tokens, 0) # Petición rechazada: sus tokens no se consumieron
+        if tipo == "permanente" or intento >= self.max_reintentos: return None
+        retry_after = retry_after_segundos(e)
+        if retry_after is not None and tipo == "rate_limit":
+            with self._lock: self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + retry_after) # Pausa compartida
+            pausa = 0.0 # reservar() ya hará esperar hasta '_pausa_hasta'
+        else: pausa = random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** intento))
+        if time.monotonic() + max(pausa, retry_after or 0.0) >= limite: return None
+        print(f"Adv: intento {intento + 1} falló ({tipo}: {e}); reintento en {max(pausa, retry_after or 0.0):.1f}s.")
+        info["retries"] += 1; info["throttled_seconds"] += pausa
+        with self._lock: self.stats["retries"] += 1
+        return pausa
+
+    def _cerrar(self, respuesta: Any, tokens: int) -> None:
+        self._registrar_exito()
+        usage = getattr(respuesta, "usage", None) # Con streaming el 'usage' llega al final: lo ajusta quien consume
+        if usage is not None: self.ajustar(tokens, usage.prompt_tokens + usage.completion_tokens)
+
+    def ejecutar(self, llamada: Callable[[float], Any], tokens: int, completions: int = 1) -> Tuple[Any, Dict[str, Any]]:
+        """Ejecuta 'llamada(timeout)' respetando turnos, plazos y reintentos.
+
+        'tokens' es la reserva de la llamada (prompt + 'completions' salidas esperadas).
+        Devuelve (respuesta, info) con info = {attempts, retries, throttled_seconds, timed_out_tokens}.
+        Si se agotan los reintentos o el plazo, propaga la última excepción.
+        """
+        with self._lock: self.stats["calls"] += 1
+        limite = time.monotonic() + self.plazo; info = {"attempts": 0, "retries": 0, "throttled_seconds": 0.0, "timed_out_tokens": 0}
+        try:
+            for intento in range(self.max_reintentos + 1):
+                time.sleep(self._preparar_intento(tokens, limite, info))
+                try: respuesta = llamada(max(0.1, min(self.timeout, limite - time.monotonic())))
+                except Exception as e:
+                    pausa = self._pausa_tras_fallo(e, intento, tokens, limite, info, completions)
+                    if pausa is None: raise
+                    time.sleep(pausa); continue
+                self._cerrar(respuesta, tokens); return respuesta, info
+        finally:
+            if info.pop("prueba", False): self._liberar_prueba()
+
+    async def ejecutar_async(self, llamada: Callable[[float], Any], tokens: int, completions: int = 1) -> Tuple[Any, Dict[str, Any]]:
+        """Equivalente asíncrono de ejecutar: 'llamada(timeout)' devuelve un awaitable."""
+        with self._lock: self.stats["calls"] += 1
+        limite = time.monotonic() + self.plazo; info = {"attempts": 0, "retries": 0, "throttled_seconds": 0.0, "timed_out_tokens": 0}
+        try:
+            for intento in range(self.max_reintentos + 1):
+                await asyncio.sleep(self._preparar_intento(tokens, limite, info))
+                try: respuesta = await llamada(max(0.1, min(self.timeout, limite - time.monotonic())))
+                except Exception as e:
+                    pausa = self._pausa_tras_fallo(e, intento, tokens, limite, info, completions)
+                    if pausa is None: raise
+                    await asyncio.sleep(pausa); continue
+                self._cerrar(respuesta, tokens); return respuesta, info
+        finally:
+            if info.pop("prueba", False): self._liberar_prueba()
+
+_PLANIFICADOR_LLM: Optional[PlanificadorLLM] = None
+_PLANIFICADOR_LLM_LOCK = threading.Lock()
+
+def get_planificador_llm() -> PlanificadorLLM:
+    """Devuelve el planificador global (compartido por todas las ejecuciones del proceso)."""
+    global _PLANIFICADOR_LLM
+    with _PLANIFICADOR_LLM_LOCK:
+        if _PLANIFICADOR_LLM is None: _PLANIFICADOR_LLM = PlanificadorLLM()
+        return _PLANIFICADOR_LLM
+
+def tokens_estimados_llamada(messages: List[Dict], completions: int = 1) -> int:
+    """Tokens a reservar antes de conocer el 'usage': prompt estimado + salida esperada (por cada completion pedida)."""
+    return estimar_tokens("".join(m.get("content") or "" for m in messages)) + completions * LLM_EXPECTED_COMPLETION_TOKENS
+
+def usage_con_reintentos(usage: object, info: Dict[str, Any]) -> object:
+    """Agrega al 'usage' los tokens de intentos fallidos facturables y las métricas de reintento."""
+    if not info["retries"] and not info["throttled_seconds"] and not info["timed_out_tokens"]: return usage
+    prompt_tokens = usage.prompt_tokens + max(0, info["timed_out_tokens"])
+    return types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=usage.completion_tokens,
+                                 total_tokens=prompt_tokens + usage.completion_tokens,
+                                 prompt_tokens_details=getattr(usage, "prompt_tokens_details", None),
+                                 retries=info["retries"], throttled_seconds=info["throttled_seconds"], retry_tokens=max(0, info["timed_out_tokens"]))
+
+def registrar_reintentos(retry_report: Dict[str, Any], usage: Optional[object]) -> None:
+    if usage is None: return
+    retry_report["retries"] += getattr(usage, "retries", 0); retry_report["retry_tokens"] += getattr(usage, "retry_tokens", 0)
+    retry_report["throttled_seconds"] += getattr(usage, "throttled_seconds", 0.0)
+
+
+# --- Tarifas por Modelo, Ruteo de Modelos y Presupuesto por Ejecución ---
+_MODELOS_SIN_TARIFA: Set[str] = set()
+
+def _modelo_tarifado(model_name: Optional[str]) -> str:
+    """Entrada de MODEL_PRICING que corresponde al modelo; admite sufijos de versión ('gpt-4o-mini-2024-07-18')."""
+    model_name = model_name or MODEL_NAME
+    if model_name in MODEL_PRICING: return model_name
+    prefijos = [m for m in MODEL_PRICING if model_name.startswith(m + "-")]
+    if prefijos: return max(prefijos, key=len)
+    if model_name not in _MODELOS_SIN_TARIFA:
+        _MODELOS_SIN_TARIFA.add(model_name); print(f"Adv: sin tarifa para '{model_name}'; se usan las de {MODEL_NAME}.")
+    return MODEL_NAME
+
+def tarifas_modelo(model_name: Optional[str]) -> Tuple[float, float]:
+    """(entrada, salida) en USD por millón de tokens."""
+    return MODEL_PRICING[_modelo_tarifado(model_name)]
+
+def tarifa_entrada_cacheada(model_name: Optional[str]) -> float:
+    """USD por millón de tokens de entrada servidos desde la caché de prefijos (sin tarifa propia: la de entrada)."""
+    modelo = _modelo_tarifado(model_name)
+    return MODEL_CACHED_INPUT_PRICING.get(modelo, MODEL_PRICING[modelo][0])
+
+def tokens_cacheados(usage: Optional[object]) -> int:
+    """Tokens de entrada que el proveedor sirvió desde su caché de prefijos ('usage.prompt_tokens_details.cached_tokens').
+
+    El proveedor sólo cachea prefijos de 1024 tokens o más: con los prompts cortos de este repositorio
+    suele valer 0 y el costo no cambia. Se contabiliza para que el costo sea correcto con prompts de
+    sistema o planes largos, donde las llamadas de un mismo rol sí comparten un prefijo cacheable.
+    """
+    detalles = getattr(usage, "prompt_tokens_details", None)
+    cached = detalles.get("cached_tokens") if isinstance(detalles, dict) else getattr(detalles, "cached_tokens", None)
+    return int(cached or 0)
+
+def costo_llamada(prompt_tokens: int, completion_tokens: int, model_name: Optional[str] = None, cached_tokens: int = 0) -> float:
+    """Costo USD de una llamada con las tarifas del modelo que la atendió.
+
+    La entrada se cobra a tarifa de entrada, salvo los 'cached_tokens' (incluidos en 'prompt_tokens'),
+    que se cobran a tarifa de entrada cacheada; la salida, a tarifa de salida.
+    """
+    tarifa_entrada, tarifa_salida = tarifas_modelo(model_name); cached_tokens = min(cached_tokens, prompt_tokens)
+    return ((prompt_tokens - cached_tokens) * (tarifa_entrada / 1_000_000) + cached_tokens * (tarifa_entrada_cacheada(model_name) / 1_000_000)
+            + completion_tokens * (tarifa_salida / 1_000_000))
+
+def usage_con_modelo(usage: Optional[object], model_name: str) -> Optional[object]:
+    """Anota en el 'usage' el modelo que atendió la llamada, para costearla con sus tarifas."""
+    if usage is None: return None
+    try: usage.modelo = model_name; return usage
+    except (AttributeError, TypeError, ValueError): # Objetos que no aceptan atributos nuevos
+        return types.SimpleNamespace(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                                     prompt_tokens_details=getattr(usage, "prompt_tokens_details", None), modelo=model_name)
+
+def modelo_para_llamada(model_name: str, etapa: str, paso: Optional[str] = None) -> str:
+    """Modelo de una llamada: la verificación y los pasos con fórmula van al modelo barato (si lo es); el resto, al de la ejecución.
+
+    El ruteo sólo abarata: nunca sube a un modelo más caro que el elegido para la ejecución, que actúa
+    como el modelo "grande" para la descomposición, los pasos sin fórmula y la síntesis.
+    """
+    if not ROUTER_SMALL_MODEL or sum(tarifas_modelo(ROUTER_SMALL_MODEL)) >= sum(tarifas_modelo(model_name)): return model_name
+    if etapa == "verifying" or (etapa == "solving" and paso is not None and nombre_asignado_paso(paso) is not None): return ROUTER_SMALL_MODEL
+    return model_name
+
+class PresupuestoExcedidoError(Exception):
+    """La próxima llamada LLM superaría el presupuesto de costo o de tokens de la ejecución."""
+
+class PresupuestoEjecucion:
+    """Límites de costo (USD) y de tokens de una ejecución, consultados antes de cada llamada LLM.
+
+    Cada llamada reserva su costo estimado (prompt + salida esperada) y al terminar se liquida
+    con el 'usage' real; así las llamadas en paralelo no pueden sobrepasar juntas el límite.
+    """
+
+    def __init__(self, max_cost_usd: Optional[float], max_tokens: Optional[int], costo: float = 0.0, tokens: int = 0):
+        self.max_cost_usd = max_cost_usd; self.max_tokens = max_tokens; self.costo = costo; self.tokens = tokens
+        self._lock = threading.Lock()
+
+    def reservar(self, model_name: str, messages: List[Dict], completions: int = 1) -> Tuple[float, int]:
+        tokens = tokens_estimados_llamada(messages, completions)
+        salida = completions * LLM_EXPECTED_COMPLETION_TOKENS; costo = costo_llamada(tokens - salida, salida, model_name)
+        with self._lock:
+            if self.max_cost_usd is not None and self.costo + costo > self.max_cost_usd:
+                raise PresupuestoExcedidoError(f"costo ${self.costo:.6f} + ~${costo:.6f} estimado supera el máximo de ${self.max_cost_usd:.6f}")
+            if self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+                raise PresupuestoExcedidoError(f"{self.tokens} tokens + ~{tokens} estimados superan el máximo de {self.max_tokens}")
+            self.costo += costo; self.tokens += tokens
+        return costo, tokens
+
+    def liquidar(self, reserva: Tuple[float, int], model_name: str, usage: Optional[object]) -> None:
+        """Reemplaza la reserva por lo facturado (nada si la llamada falló sin 'usage')."""
+        costo = costo_llamada(usage.prompt_tokens, usage.completion_tokens, model_name, tokens_cacheados(usage)) if usage is not None else 0.0
+        tokens = usage.prompt_tokens + usage.completion_tokens if usage is not None else 0
+        with self._lock: self.costo += costo - reserva[0]; self.tokens += tokens - reserva[1]
+
+# Presupuesto de la ejecución en curso (llega a los hilos del pool de pasos con copy_context)
+_PRESUPUESTO_ACTUAL: contextvars.ContextVar[Optional[PresupuestoEjecucion]] = contextvars.ContextVar("_PRESUPUESTO_ACTUAL", default=None)
+
+@contextmanager
+def presupuesto_activo(estado: Dict[str, Any]) -> Generator[Optional[PresupuestoEjecucion], None, None]:
+    """Activa el presupuesto de la ejecución (partiendo de lo ya gastado) mientras dura el bloque."""
+    limites = estado["budget"]
+    if limites["max_cost_usd"] is None and limites["max_tokens"] is None: yield None; return
+    presupuesto = PresupuestoEjecucion(limites["max_cost_usd"], limites["max_tokens"],
+                                       estado["token_report"]["cost_total"], estado["token_report"]["total_calc"])
+    token = _PRESUPUESTO_ACTUAL.set(presupuesto)
+    try: yield presupuesto
+    finally: _PRESUPUESTO_ACTUAL.reset(token)
+
+def _reservar_presupuesto(model_name: str, messages: List[Dict], completions: int = 1) -> Optional[Tuple[float, int]]:
+    presupuesto = _PRESUPUESTO_ACTUAL.get()
+    return presupuesto.reservar(model_name, messages, completions) if presupuesto is not None else None
+
+def _liquidar_presupuesto(reserva: Optional[Tuple[float, int]], model_name: str, usage: Optional[object]) -> None:
+    presupuesto = _PRESUPUESTO_ACTUAL.get()
+    if presupuesto is not None and reserva is not None: presupuesto.liquidar(reserva, model_name, usage)
+
+
+# --- Trazas Estructuradas (spans por ejecución, etapa, paso y llamada LLM) ---
+_SPAN_ACTUAL: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("_SPAN_ACTUAL", default=None)
+
+class Trazador:
+    """Registra spans (run_id, padre, nombre, tipo, inicio, duración y atributos) de cada ejecución.
+
+    El span actual viaja en un contextvar, así los spans de pasos y llamadas LLM quedan anidados bajo
+    su etapa aun dentro de hilos (si se propaga el contexto) o tareas asyncio. Guarda en memoria las
+    últimas TRACE_MAX_RUNS ejecuciones, agrega contadores para Prometheus y, si TRACE_JSONL_PATH está
+    definido, agrega cada span cerrado a ese archivo JSONL. Es seguro para uso entre hilos.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = TRACE_JSONL_PATH, max_runs: int = TRACE_MAX_RUNS):
+        self.jsonl_path = jsonl_path; self.max_runs = max_runs
+        self._lock = threading.Lock()
+        self._spans: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._metricas: Dict[Tuple[str, str, str], float] = {}
+
+    @staticmethod
+    def _nuevo_span(nombre: str, tipo: str, run_id: Optional[str], atributos: Dict[str, Any]) -> Dict[str, Any]:
+        padre = _SPAN_ACTUAL.get() or {}
+        return {"run_id": run_id or padre.get("run_id"), "span_id": uuid.uuid4().hex[:8], "parent_id": padre.get("span_id"),
+                "name": nombre, "kind": tipo, "stage": atributos.pop("stage", None) or padre.get("stage"),
+                "start": time.time(), "duration_s": None, "status": "ok", **atributos}
+
+    @contextmanager
+    def span(self, nombre: str, tipo: str, run_id: Optional[str] = None, **atributos: Any):
+        """Abre un span hijo del actual; el bloque puede completar sus atributos vía el dict devuelto."""
+        span = self._nuevo_span(nombre, tipo, run_id, atributos)
+        inicio = time.perf_counter(); token = _SPAN_ACTUAL.set(span)
+        try: yield span
+        except BaseException: span["status"] = "error"; raise
+        finally:
+            _SPAN_ACTUAL.reset(token); span["duration_s"] = time.perf_counter() - inicio
+            self._cerrar(span)
+
+    def registrar_span(self, nombre: str, tipo: str, duracion: float, **atributos: Any) -> None:
+        """Registra un span ya terminado (p. ej. un paso resuelto localmente) bajo el span actual."""
+        span = self._nuevo_span(nombre, tipo, None, atributos)
+        span["duration_s"] = duracion; span["start"] -= duracion
+        self._cerrar(span)
+
+    def _cerrar(self, span: Dict[str, Any]) -> None:
+        if span["status"] == "ok" and span.get("error"): span["status"] = "error"
+        with self._lock:
+            if span["run_id"] is not None:
+                self._spans.setdefault(span["run_id"], []).append(span); self._spans.move_to_end(span["run_id"])
+                while len(self._spans) > self.max_runs: self._spans.popitem(last=False)
+            etiquetas = (span["kind"], span["stage"] or "", span["name"] if span["kind"] in ("stage", "run") else "")
+            for metrica, valor in (("spans", 1), ("seconds", span["duration_s"]), ("errors", span["status"] == "error"),
+                                   ("queue_wait_seconds", span.get("queue_wait_s") or 0.0), ("ttft_seconds", span.get("ttft_s") or 0.0),
+                                   ("prompt_tokens", span.get("prompt_tokens") or 0), ("cached_prompt_tokens", span.get("cached_tokens") or 0),
+                                   ("completion_tokens", span.get("completion_tokens") or 0),
+                                   ("cost_usd", span.get("cost_usd") or 0.0), ("cache_hits", bool(span.get("cache_hit"))), ("retries", span.get("retries") or 0)):
+                self._metricas[(metrica, *etiquetas)] = self._metricas.get((metrica, *etiquetas), 0) + valor
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as f: f.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+                except OSError as e: print(f"Adv: no se pudo escribir la traza en {self.jsonl_path}: {e}")
+
+    def spans(self, run_id: str) -> List[Dict[str, Any]]:
+        """Spans cerrados de una ejecución, ordenados por inicio."""
+        with self._lock: return sorted((dict(s) for s in self._spans.get(run_id, [])), key=lambda s: s["start"])
+
+    def exportar_jsonl(self, run_id: Optional[str] = None) -> str:
+        """Spans (de una ejecución o de todas las que están en memoria) como texto JSONL."""
+        with self._lock: ids = [run_id] if run_id else list(self._spans)
+        return "".join(json.dumps(s, ensure_ascii=False, default=str) + "\n" for rid in ids for s in self.spans(rid))
+
+    def metricas_prometheus(self) -> str:
+        """Contadores acumulados en formato de exposición de texto de Prometheus (HELP, TYPE y una muestra por etiquetas)."""
+        with self._lock: metricas = dict(self._metricas)
+        lineas = []
+        for metrica in sorted({m for m, *_ in metricas}):
+            nombre = f"reasoning_{metrica}_total"
+            lineas.append(f"# HELP {nombre} {AYUDA_METRICAS.get(metrica, metrica)}"); lineas.append(f"# TYPE {nombre} counter")
+            for (m, tipo, etapa, span), valor in sorted(metricas.items()):
+                if m != metrica: continue
+                etiquetas = f'kind="{_escapar_etiqueta(tipo)}",stage="{_escapar_etiqueta(etapa)}"' + (f',name="{_escapar_etiqueta(span)}"' if span else "")
+                lineas.append(f"{nombre}{{{etiquetas}}} {float(valor):.6g}")
+        return "\n".join(lineas) + "\n"
+
+AYUDA_METRICAS = {
+    "spans": "Spans cerrados.", "seconds": "Tiempo de pared acumulado (s).", "errors": "Spans terminados con error.",
+    "queue_wait_seconds": "Espera en cola acumulada: límite de tasa y semáforo del batch (s).", "ttft_seconds": "Tiempo hasta el primer token acumulado (s).",
+    "prompt_tokens": "Tokens de entrada.", "cached_prompt_tokens": "Tokens de entrada servidos por la caché de prefijos del proveedor.",
+    "completion_tokens": "Tokens de salida.", "cost_usd": "Costo estimado (USD).", "cache_hits": "Llamadas resueltas por la caché de respuestas.",
+    "retries": "Reintentos de llamadas LLM.",
+}
+
+def _escapar_etiqueta(valor: str) -> str:
+    """Escapa el valor de una etiqueta Prometheus (barra invertida, comillas y saltos de línea)."""
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+_TRAZADOR: Optional[Trazador] = None
+_TRAZADOR_LOCK = threading.Lock()
+
+def get_trazador() -> Trazador:
+    """Devuelve el trazador global del proceso."""
+    global _TRAZADOR
+    with _TRAZADOR_LOCK:
+        if _TRAZADOR is None: _TRAZADOR = Trazador()
+        return _TRAZADOR
+
+def anotar_llamada_llm(span: Dict[str, Any], content: Optional[str], usage: Optional[object], metricas: Optional[Dict[str, Any]] = None) -> None:
+    """Completa el span de una llamada LLM con tokens (y los de la caché de prefijos), costo, caché, reintentos, espera y TTFT."""
+    if usage is None: span["error"] = (content or "sin respuesta")[:200]; return
+    span.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens, cached_tokens=tokens_cacheados(usage),
+                cost_usd=costo_llamada(usage.prompt_tokens, usage.completion_tokens, getattr(usage, "modelo", span.get("model")), tokens_cacheados(usage)), cache_hit=es_cache_hit(usage),
+                retries=getattr(usage, "retries", 0), queue_wait_s=span.get("queue_wait_s", 0.0) + getattr(usage, "throttled_seconds", 0.0))
+    if metricas and metricas.get("ttft") is not None: span["ttft_s"] = metricas["ttft"]
+
+
+# --- 2. Funciones de Lógica de Razonamiento (AGENTES LLM CON PROMPTS MEJORADOS) ---
+
+def crear_cliente_openai() -> OpenAI:
+    """Crea el cliente OpenAI síncrono (importa 'openai' recién aquí)."""
+    from openai import OpenAI
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key: raise ValueError("Variable de entorno OPENAI_API_KEY no encontrada.")
+    return OpenAI(api_key=api_key)
+
+def mensaje_error_llm(e: Exception) -> str:
+    """Traduce una excepción del cliente al texto de error que esperan los orquestadores."""
+    try: import openai
+    except ImportError: openai = None # Clientes alternativos (p. ej. réplica offline) sin el paquete instalado
+    if openai is not None and isinstance(e, openai.RateLimitError): print(f"!!! ERROR RateLimitError: {e}"); return f"Error Límite Tasa: {e}"
+    if openai is not None and isinstance(e, openai.BadRequestError): print(f"!!! ERROR BadRequest: {e}"); return f"Error API: {e}"
+    if isinstance(e, PresupuestoExcedidoError): print(f"!!! Presupuesto de la ejecución agotado: {e}"); return f"Error Presupuesto: {e}"
+    if isinstance(e, CircuitoAbiertoError): print(f"!!! ERROR Circuito abierto: {e}"); return f"Error API: {e}"
+    if tipo_error_llm(e) != "permanente": print(f"!!! ERROR LLM Call (reintentos agotados): {e}"); return f"Error API: {e}"
+    print(f"!!! ERROR LLM Call: {e}"); traceback.print_exc(); return f"Error inesperado: {e}"
+
+def call_llm_with_usage(client: OpenAI, model_name: str, messages: List[Dict], purpose: str = "", temperature: float = 0.1, use_cache: bool = True,
+                        stream: bool = False, on_delta: Optional[Callable[[str], None]] = None, metricas: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], Optional[object]]:
+    """Realiza una llamada al LLM (o la resuelve desde la caché) y devuelve contenido y objeto 'usage'.
+
+    Con stream=True consume stream_llm_with_usage: cada fragmento se entrega a 'on_delta' y el
+    tiempo hasta el primer token queda en metricas["ttft"] (si se pasa el diccionario).
+    Cada llamada queda registrada como un span 'llm' bajo el span actual.
+    """
+    metricas = {} if metricas is None else metricas
+    with get_trazador().span(purpose, "llm", model=model_name) as span:
+        content, usage = _call_llm_with_usage(client, model_name, messages, purpose, temperature, use_cache, stream, on_delta, metricas)
+        usage = usage_con_modelo(usage, model_name); anotar_llamada_llm(span, content, usage, metricas)
+    return content, usage
+
+def _call_llm_with_usage(client: OpenAI, model_name: str, messages: List[Dict], purpose: str, temperature: float, use_cache: bool,
+                         stream: bool, on_delta: Optional[Callable[[str], None]], metricas: Dict[str, Any]) -> Tuple[Optional[str], Optional[object]]:
+    if stream: return consumir_stream_llm(stream_llm_with_usage(client, model_name, messages, purpose, temperature, use_cache), on_delta, metricas)
+    print(f"\n--- LLM Call ({purpose} | Temp: {temperature}) ---")
+    if not client: return "Error: Cliente LLM no proporcionado.", None
+    reserva = None
+    try:
+        key = None
+        if use_cache:
+            key, content, usage = _leer_cache(model_name, messages, temperature, purpose)
+            if usage is not None: return content, usage
+        reserva = _reservar_presupuesto(model_name, messages)
+        response, info = get_planificador_llm().ejecutar(
+            lambda timeout: client.chat.completions.create(model=model_name, messages=messages, temperature=temperature, timeout=timeout),
+            tokens_estimados_llamada(messages))
+        content = response.choices[0].message.content
+        usage = usage_con_reintentos(response.usage, info)
+        print(f"Token Usage ({purpose}): Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}")
+        _escribir_cache(key, model_name, content, response.usage); _liquidar_presupuesto(reserva, model_name, usage)
+        return content, usage
+    except Exception as e: _liquidar_presupuesto(reserva, model_name, None); return mensaje_error_llm(e), None
+
+def stream_llm_with_usage(client: OpenAI, model_name: str, messages: List[Dict], purpose: str = "", temperature: float = 0.1,
+                          use_cache: bool = True) -> Generator[str, None, Tuple[Optional[str], Optional[object], Optional[float]]]:
+    """Generador en modo streaming: produce los fragmentos de texto a medida que llegan.
+
+    Al agotarse devuelve (contenido, usage, ttft_segundos) como valor de retorno del generador.
+    Se pide 'include_usage' para que el último chunk traiga el conteo de tokens. Si el stream no se
+    puede abrir por un error permanente, la llamada se repite sin streaming y la respuesta completa
+    sale como un único fragmento (su TTFT es la latencia total).
+    """
+    print(f"\n--- LLM Stream ({purpose} | Temp: {temperature}) ---")
+    if not client: return "Error: Cliente LLM no proporcionado.", None, None
+    inicio = time.perf_counter(); reserva = None
+    try:
+        key = None
+        if use_cache:
+            key, content, usage = _leer_cache(model_name, messages, temperature, purpose)
+            if usage is not None:
+                ttft = time.perf_counter() - inicio
+                yield content
+                return content, usage, ttft
+        reserva = _reservar_presupuesto(model_name, messages)
+        # Se reintenta sólo el establecimiento del stream: un corte a mitad de respuesta se informa como error
+        planificador = get_planificador_llm(); reservados = tokens_estimados_llamada(messages)
+        try:
+            respuesta, info = planificador.ejecutar(
+                lambda timeout: client.chat.completions.create(model=model_name, messages=messages, temperature=temperature,
+                                                               stream=True, stream_options={"include_usage": True}, timeout=timeout),
+                reservados)
+        except Exception as e:
+            # Un rechazo permanente del stream (modelo o cliente sin 'stream'/'stream_options') se repite sin streaming
+            if tipo_error_llm(e) != "permanente" or isinstance(e, CircuitoAbiertoError): raise
+            print(f"Adv: no se pudo abrir el stream ({purpose}): {e}; se repite la llamada sin streaming.")
+            _liquidar_presupuesto(reserva, model_name, None); reserva = None
+            content, usage = _call_llm_with_usage(client, model_name, messages, purpose, temperature, False, False, None, {})
+            if usage is None: return content, None, None
+            _escribir_cache(key, model_name, content, usage)
+            ttft = time.perf_counter() - inicio # Sin streaming el primer token llega con la respuesta completa
+            yield content
+            return content, usage, ttft
+        partes: List[str] = []; usage = None; ttft = None
+        for chunk in respuesta:
+            if getattr(chunk, "usage", None): usage = chunk.usage
+            if not chunk.choices: continue
+            delta = chunk.choices[0].delta.content
+            if not delta: continue
+            if ttft is None: ttft = time.perf_counter() - inicio
+            partes.append(delta)
+            yield delta
+        content = "".join(partes)
+        if usage is None:
+            print(f"Adv: el stream ({purpose}) no informó 'usage'; se registran 0 tokens.")
+            usage = types.SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+        print(f"Token Usage ({purpose}): Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}, TTFT={ttft if ttft is None else round(ttft, 3)}s")
+        planificador.ajustar(reservados, usage.prompt_tokens + usage.completion_tokens)
+        _escribir_cache(key, model_name, content, usage)
+        usage = usage_con_reintentos(usage, info); _liquidar_presupuesto(reserva, model_name, usage)
+        return content, usage, ttft
+    except Exception as e: _liquidar_presupuesto(reserva, model_name, None); return mensaje_error_llm(e), None, None
+
+def consumir_stream_llm(generador: Generator[str, None, Tuple[Optional[str], Optional[object], Optional[float]]],
+                        on_delta: Optional[Callable[[str], None]] = None, metricas: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], Optional[object]]:
+    """Consume un stream entregando cada fragmento a 'on_delta'; devuelve (contenido, usage) como call_llm_with_usage."""
+    while True:
+        try: delta = next(generador)
+        except StopIteration as fin: content, usage, ttft = fin.value; break
+        if on_delta: on_delta(delta)
+    if metricas is not None: metricas["ttft"] = ttft
+    return content, usage
+
+# (Las definiciones de agente_descompositor, agente_verificador_plan,
+# agente_solucionador, agente_sintetizador permanecen IGUAL que en
+# la versión anterior "LLM Calculator" con prompts ultra-detallados)
+# Los mensajes de cada agente se construyen en funciones propias para compartirlos
+# entre la ruta síncrona (OpenAI) y la asíncrona (AsyncOpenAI). Todos tienen la misma forma: un
+# único mensaje de sistema (prompt común + instrucciones del rol), la pregunta y el plan, y al final
+# el contenido variable. Las llamadas de un mismo rol (p. ej. todos los pasos del Solucionador)
+# repiten ese prefijo idéntico, que el proveedor puede cachear y cobrar a tarifa reducida.
+SYSTEM_PROMPT_COMUN = f"""Resuelves problemas de cálculo en equipo (planificador, revisor, calculista y auditor). Usa {PI_DISPLAY} ≈ {PI_VALUE}... Tu rol se indica a continuación.""" # Omitido
+
+def contenido_prefijo(pregunta_original: str, plan: str = "") -> str:
+    return f"Pregunta Original:\n{pregunta_original}" + (f"\n\nPlan:\n{plan}" if plan else "")
+
+def mensajes_prefijo(instrucciones_rol: str, pregunta_original: str, plan: str = "") -> List[Dict]:
+    """Prefijo estable de las llamadas de un rol: sistema (común + rol), pregunta y plan (si ya existe)."""
+    return [{"role": "system", "content": f"{SYSTEM_PROMPT_COMUN}\n\n{instrucciones_rol}"}, {"role": "user", "content": contenido_prefijo(pregunta_original, plan)}]
+
+def mensajes_descompositor(pregunta_compleja: str) -> List[Dict]:
+    system_prompt = f"""Eres un ingeniero de planificación... (Instrucciones Detalladas)... Usa {PI_DISPLAY} ≈ {PI_VALUE}... Si un paso es un cálculo directo escribe su fórmula como 'NOMBRE = expresión' usando sólo números, {PI_DISPLAY} y NOMBRES de pasos previos (condiciones como 'A si CONDICIÓN, si no B'). Al final de cada paso indica de qué pasos previos depende con el formato '[depende de: Paso 1, Paso 3]' o '[depende de: ninguno]'. Responde únicamente con la lista numerada de pasos.""" # Omitido
+    return mensajes_prefijo(system_prompt, pregunta_compleja) + [
+        {"role": "user", "content": "Descompón la pregunta anterior en pasos de cálculo detallados."}
+    ]
+
+def mensajes_verificador_plan(pregunta_original: str, plan_propuesto: str) -> List[Dict]:
+    system_prompt = f"Eres un revisor lógico... Responde brevemente con tu evaluación y termina con una línea '{VERDICT_APPROVED}' o '{VERDICT_REJECTED}'." # Omitido
+    return mensajes_prefijo(system_prompt, pregunta_original, plan_propuesto) + [
+        {"role": "user", "content": "Evaluación Crítica del Plan:"}
+    ]
+
+def mensajes_solucionador(paso_actual: str, contexto_completo: str, pregunta_original: str = "", plan: str = "") -> List[Dict]:
+    """'contexto_completo' lleva sólo lo que cambia entre pasos (resultados previos); pregunta y plan van en el prefijo."""
+    system_prompt = f"""Eres una calculadora/analista extremadamente preciso... Usa {PI_DISPLAY} ≈ {PI_VALUE}... MUESTRA TU TRABAJO... Responde únicamente con la ejecución detallada y el resultado de ESTE PASO.""" # Omitido
+    return mensajes_prefijo(system_prompt, pregunta_original, plan) + [
+        {"role": "user", "content": f"Contexto (Resultados Previos):\n{contexto_completo}\n\n--- TAREA ACTUAL ---\nEjecuta y detalla este paso del plan: {paso_actual}"}
+    ]
+
+def mensajes_sintetizador(pregunta_original: str, plan: str, resultados_parciales: dict) -> List[Dict]:
+    contexto_respuestas = "Resultados Detallados...\n" + "\n".join([f"- {k}:\n  {v}" for k, v in resultados_parciales.items()])
+    final_format_instruction = "Proporciona únicamente el valor numérico final redondeado a 2 decimales, precedido por 'Costo Total:'. Ejemplo: 'Costo Total: 12345.67'"
+    if "costo total" not in pregunta_original.lower(): final_format_instruction = "Resume la respuesta final..."
+    system_prompt = f"""Eres un experto sintetizador y auditor final... Realiza cualquier cálculo FINAL necesario... Responde ÚNICAMENTE según el formato solicitado... {final_format_instruction} No añadas explicaciones...""" # Omitido
+    return mensajes_prefijo(system_prompt, pregunta_original, plan) + [
+        {"role": "user", "content": f"{contexto_respuestas}\n\n--- INSTRUCCIÓN FINAL ---\nActúa como Auditor Final: Revisa, extrae, calcula y proporciona la respuesta final EXACTAMENTE como se pide."}
+    ]
+
+def agente_descompositor(client: OpenAI, model_name: str, pregunta_compleja: str) -> Tuple[Optional[str], Optional[object]]:
+    messages = mensajes_descompositor(pregunta_compleja)
+    return call_llm_with_usage(client, model_name, messages, purpose="Descomposición Ultra-Detallada", temperature=0.3)
+
+def agente_verificador_plan(client: OpenAI, model_name: str, pregunta_original: str, plan_propuesto: str) -> Tuple[Optional[str], Optional[object]]:
+    messages = mensajes_verificador_plan(pregunta_original, plan_propuesto)
+    return call_llm_with_usage(client, model_name, messages, purpose="Verificación Plan", temperature=0.1)
+
+def agente_solucionador(client: OpenAI, model_name: str, paso_actual: str, contexto_completo: str,
+                        on_delta: Optional[Callable[[str], None]] = None, metricas: Optional[Dict[str, Any]] = None,
+                        etiqueta: str = "Paso", pregunta_original: str = "", plan: str = "") -> Tuple[Optional[str], Optional[object]]:
+    if SELF_CONSISTENCY_SAMPLES > 1: # Votación: sin streaming, el resultado elegido se entrega completo
+        respuesta, usage = agente_solucionador_votacion(client, model_name, paso_actual, contexto_completo, etiqueta, pregunta_original=pregunta_original, plan=plan)
+        if on_delta and usage is not None: on_delta(respuesta)
+        return respuesta, usage
+    messages = mensajes_solucionador(paso_actual, contexto_completo, pregunta_original, plan)
+    return call_llm_with_usage(client, model_name, messages, purpose=f"Solución {etiqueta}", temperature=0.05,
+                               stream=on_delta is not None, on_delta=on_delta, metricas=metricas)
+
+def agente_sintetizador(client: OpenAI, model_name: str, pregunta_original: str, plan: str, resultados_parciales: dict,
+                        on_delta: Optional[Callable[[str], None]] = None, metricas: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], Optional[object]]:
+    messages = mensajes_sintetizador(pregunta_original, plan, resultados_parciales)
+    return call_llm_with_usage(client, model_name, messages, purpose="Auditoría y Síntesis Final", temperature=0.05,
+                               stream=on_delta is not None, on_delta=on_delta, metricas=metricas)
+
+
+# --- Autoconsistencia: votación entre varias muestras del Agente Solucionador ---
+def valor_resultado(respuesta: Optional[str]) -> Optional[float]:
+    """Valor numérico del resultado de un paso: último número de su resultado compacto ('Resultado: RI = 2.75 m' -> 2.75)."""
+    numeros = QUANTITY_RE.findall(extraer_resultado_compacto(respuesta))
+    try: return float(numeros[-1].replace(',', '')) if numeros else None
+    except ValueError: return None
+
+def agrupar_valores(valores: List[Optional[float]]) -> List[Tuple[float, List[int]]]:
+    """Agrupa valores iguales (tolerancia relativa SELF_CONSISTENCY_TOLERANCE): [(valor, índices)], más votados primero."""
+    grupos: List[Tuple[float, List[int]]] = []
+    for i, valor in enumerate(valores):
+        if valor is None: continue
+        grupo = next((g for g in grupos if abs(valor - g[0]) <= SELF_CONSISTENCY_TOLERANCE * max(1.0, abs(g[0]))), None)
+        if grupo is None: grupos.append((valor, [i]))
+        else: grupo[1].append(i)
+    return sorted(grupos, key=lambda g: -len(g[1])) # sorted es estable: a igualdad de votos gana el primero
+
+def muestras_pendientes(valores: List[Optional[float]], muestras: int, quorum: int) -> int:
+    """Cuántas muestras más pedir: 0 si ya hay quórum, si se agotaron o si el quórum ya es inalcanzable."""
+    grupos = agrupar_valores(valores); lider = len(grupos[0][1]) if grupos else 0; restantes = muestras - len(valores)
+    if lider >= quorum or restantes <= 0 or lider + restantes < quorum: return 0
+    return min(restantes, quorum - lider)
+
+def usage_combinado(usages: List[object], model_name: str) -> object:
+    """Suma los 'usage' de las rondas de una votación en uno solo."""
+    return types.SimpleNamespace(prompt_tokens=sum(u.prompt_tokens for u in usages), completion_tokens=sum(u.completion_tokens for u in usages),
+                                 prompt_tokens_details=types.SimpleNamespace(cached_tokens=sum(tokens_cacheados(u) for u in usages)),
+                                 modelo=model_name, retries=sum(getattr(u, "retries", 0) for u in usages),
+                                 retry_tokens=sum(getattr(u, "retry_tokens", 0) for u in usages),
+                                 throttled_seconds=sum(getattr(u, "throttled_seconds", 0.0) for u in usages))
+
+def _resultado_votacion(respuestas: List[str], usages: List[object], model_name: str, muestras: int, quorum: int,
+                        etiqueta: str, inicio: float) -> Tuple[str, object]:
+    """Elige la respuesta más votada y adjunta al 'usage' combinado el reporte de la votación.
+
+    Si ninguna muestra trajo contenido devuelve un error 'Error Votación' (paso fallido) con el
+    'usage' de lo ya pagado.
+    """
+    grupos = agrupar_valores([valor_resultado(r) for r in respuestas]); numericas = sum(len(g[1]) for g in grupos)
+    votos = len(grupos[0][1]) if grupos else 0
+    usage = usage_combinado(usages, model_name)
+    usage.votacion = {"samples": len(respuestas), "requests": len(usages), "votes": votos, "quorum": quorum,
+                      "agreement": round(votos / numericas, 4) if numericas else None, "value": grupos[0][0] if grupos else None,
+                      "consensus": votos >= quorum, "seconds": round(time.perf_counter() - inicio, 4),
+                      "cost_usd": costo_llamada(usage.prompt_tokens, usage.completion_tokens, model_name, tokens_cacheados(usage))}
+    if not respuestas: return f"Error Votación: ninguna muestra de {etiqueta} trajo contenido.", usage # Fallo del paso, con su costo
+    if votos < quorum: print(f"Adv: {etiqueta} sin consenso ({votos}/{len(respuestas)} muestras coinciden); se usa la más votada.")
+    return respuestas[grupos[0][1][0] if grupos else 0], usage
+
+def agente_solucionador_votacion(client: OpenAI, model_name: str, paso_actual: str, contexto_completo: str, etiqueta: str = "Paso",
+                                 muestras: Optional[int] = None, quorum: Optional[int] = None,
+                                 pregunta_original: str = "", plan: str = "") -> Tuple[Optional[str], Optional[object]]:
+    """Autoconsistencia: pide muestras del Solucionador (con 'n=' en una sola llamada) y vota el resultado numérico.
+
+    La primera ronda pide sólo las muestras necesarias para el quórum; si no coinciden se piden
+    más, de a las que falten, hasta llegar al quórum o a 'muestras'. 'usage.votacion' lleva el
+    reporte (votos, acuerdo, latencia y costo del paso).
+    """
+    muestras = muestras or SELF_CONSISTENCY_SAMPLES; quorum = quorum or muestras // 2 + 1
+    messages = mensajes_solucionador(paso_actual, contexto_completo, pregunta_original, plan); inicio = time.perf_counter()
+    respuestas: List[str] = []; valores: List[Optional[float]] = []; usages: List[object] = []
+    while True:
+        pedir = muestras_pendientes(valores, muestras, quorum)
+        if pedir == 0: break
+        contenidos, usage = call_llm_muestras(client, model_name, messages, purpose=f"Votación {etiqueta}", n=pedir)
+        if usage is None:
+            if not respuestas: return contenidos[0], None
+            break # Se vota con las muestras ya obtenidas
+        usages.append(usage); respuestas += contenidos; valores += [valor_resultado(c) for c in contenidos]
+        if not contenidos: break
+    return _resultado_votacion(respuestas, usages, model_name, muestras, quorum, etiqueta, inicio)
+
+def call_llm_muestras(client: OpenAI, model_name: str, messages: List[Dict], purpose: str = "", temperature: float = SELF_CONSISTENCY_TEMPERATURE,
+                      n: int = 1) -> Tuple[List[str], Optional[object]]:
+    """Pide 'n' completions en una sola llamada ('n=': el prompt se factura una vez). Sin caché.
+
+    Devuelve (contenidos, usage); ante un error, ([mensaje de error], None).
+    """
+    with get_trazador().span(purpose, "llm", model=model_name, samples=n) as span:
+        contenidos, usage = _call_llm_muestras(client, model_name, messages, purpose, temperature, n)
+        usage = usage_con_modelo(usage, model_name); anotar_llamada_llm(span, contenidos[0] if contenidos else None, usage)
+    return contenidos, usage
+
+def _call_llm_muestras(client: OpenAI, model_name: str, messages: List[Dict], purpose: str, temperature: float, n: int) -> Tuple[List[str], Optional[object]]:
+    print(f"\n--- LLM Call ({purpose} | Temp: {temperature} | n={n}) ---")
+    if not client: return ["Error: Cliente LLM no proporcionado."], None
+    reserva = None
+    try:
+        reserva = _reservar_presupuesto(model_name, messages, completions=n)
+        response, info = get_planificador_llm().ejecutar(
+            lambda timeout: client.chat.completions.create(model=model_name, messages=messages, temperature=temperature, n=n, timeout=timeout),
+            tokens_estimados_llamada(messages, completions=n), completions=n)
+        contenidos = [c.message.content for c in response.choices if c.message.content]
+        usage = usage_con_reintentos(response.usage, info)
+        print(f"Token Usage ({purpose}): Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}, Muestras={len(contenidos)}")
+        _liquidar_presupuesto(reserva, model_name, usage)
+        return contenidos, usage
+    except Exception as e: _liquidar_presupuesto(reserva, model_name, None); return [mensaje_error_llm(e)], None
+
+
+# --- Plan como Grafo de Dependencias (DAG) ---
+STEP_LINE_RE = re.compile(r'^\s*[\d]+[.)]?\s+')
+STEP_NUMBER_RE = re.compile(r'^\s*(\d+)[.)]?\s+')
+STEP_DEPS_RE = re.compile(r'\[\s*depende\s+de\s*:\s*([^\]]*)\]', re.IGNORECASE)
+STEP_REF_RE = re.compile(r'\bpasos?\s+(\d+(?:\s*(?:,|y|e|-|a|al|hasta)\s*\d+)*)', re.IGNORECASE)
+STEP_PREVIOUS_RE = re.compile(r'\b(anterior(?:es)?|previos?|previamente|sumando|suma\s+de|total(?:es)?)\b', re.IGNORECASE)
+
+def extraer_pasos_plan(plan_str: str) -> List[str]:
+    """Extrae la lista de pasos numerados del plan (o líneas no vacías si no hay numeración)."""
+    pasos = [line.strip() for line in plan_str.split('\n') if STEP_LINE_RE.match(line)]
+    if not pasos: pasos = [line.strip() for line in plan_str.split('\n') if line.strip()] or [plan_str]
+    return pasos
+
+def _numeros_referenciados(texto: str) -> Set[int]:
+    """Devuelve los números de paso citados en un texto ('Paso 2', 'pasos 1 y 3', 'pasos 1-3')."""
+    numeros: Set[int] = set()
+    for match in STEP_REF_RE.finditer(texto):
+        tokens = re.findall(r'\d+|-|\ba\b|\bal\b|\bhasta\b', match.group(1))
+        previo, rango = None, False
+        for tok in tokens:
+            if tok.isdigit():
+                n = int(tok)
+                if rango and previo is not None: numeros.update(range(min(previo, n), max(previo, n) + 1))
+                else: numeros.add(n)
+                previo, rango = n, False
+            else: rango = True
+    return numeros
+
+def construir_dag_pasos(pasos: List[str]) -> Dict[int, List[int]]:
+    """Construye el DAG del plan: índice de paso -> índices de sus dependencias directas.
+
+    Usa la anotación '[depende de: ...]' del descompositor, las referencias explícitas
+    a otros pasos y los NOMBRES definidos por pasos previos ('V_base = ...') que aparecen
+    en la fórmula. Si el plan no cita ninguna dependencia, o si una anotación cita el propio
+    paso o uno posterior (un ciclo), se asume la cadena secuencial original (cada paso
+    depende del anterior), que es la interpretación conservadora.
+    """
+    numero_a_indice: Dict[int, int] = {}
+    for i, paso in enumerate(pasos):
+        m = STEP_NUMBER_RE.match(paso)
+        numero_a_indice.setdefault(int(m.group(1)) if m else i + 1, i)
+    cuerpos = [STEP_NUMBER_RE.sub('', paso, count=1) for paso in pasos]
+    plan_anotado = any(STEP_DEPS_RE.search(c) or STEP_REF_RE.search(c) for c in cuerpos)
+    dag: Dict[int, List[int]] = {}; definidos: Dict[str, int] = {} # nombre de variable -> último paso que la define
+    for i, cuerpo in enumerate(cuerpos):
+        nombre = nombre_asignado_paso(pasos[i])
+        if not plan_anotado:
+            dag[i] = [i - 1] if i > 0 else []
+            if nombre: definidos[nombre] = i
+            continue
+        anotacion = STEP_DEPS_RE.search(cuerpo)
+        if anotacion: numeros = _numeros_referenciados("pasos " + re.sub(r'(?i)\bpasos?\b', '', anotacion.group(1)))
+        else: numeros = _numeros_referenciados(cuerpo)
+        if anotacion and any(numero_a_indice.get(n, -1) >= i for n in numeros):
+            print(f"Adv: el Paso {i+1} depende de sí mismo o de un paso posterior; el plan se ejecuta en secuencia.")
+            return {j: [j - 1] if j > 0 else [] for j in range(len(pasos))}
+        deps = {numero_a_indice[n] for n in numeros if n in numero_a_indice and numero_a_indice[n] < i}
+        # Paso sin anotación que agrega resultados previos ("total", "anterior"): depende de todos
+        if not anotacion and not deps and STEP_PREVIOUS_RE.search(cuerpo): deps = set(range(i))
+        deps.update(definidos[n] for n in _nombres_formula(pasos[i]) if n in definidos)
+        dag[i] = sorted(deps)
+        if nombre: definidos[nombre] = i
+    return dag
+
+def ancestros_paso(dag: Dict[int, List[int]], indice: int) -> List[int]:
+    """Devuelve (ordenados) todos los ancestros transitivos de un paso en el DAG."""
+    visitados: Set[int] = set(); pendientes = list(dag.get(indice, []))
+    while pendientes:
+        dep = pendientes.pop()
+        if dep in visitados: continue
+        visitados.add(dep); pendientes.extend(dag.get(dep, []))
+    return sorted(visitados)
+
+# --- Construcción Incremental del Contexto (presupuesto de tokens por llamada) ---
+RESULT_LINE_RE = re.compile(r'^\s*\**\s*Resultado[^:\n]*:\s*(.+)$', re.IGNORECASE | re.MULTILINE)
+QUANTITY_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+MAX_COMPACT_RESULT_CHARS = 200
+
+def estimar_tokens(texto: str) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token); evita depender de un tokenizador."""
+    return (len(texto) + 3) // 4
+
+def extraer_resultado_compacto(respuesta: Optional[str]) -> str:
+    """Reduce la salida verbosa de un paso ('MUESTRA TU TRABAJO') a su resultado: valor + unidades."""
+    if not respuesta or not respuesta.strip(): return ""
+    lineas_resultado = RESULT_LINE_RE.findall(respuesta)
+    if lineas_resultado: compacto = lineas_resultado[-1]
+    else:
+        # Sin línea 'Resultado:': última línea con una cantidad numérica
+        con_numero = [l for l in respuesta.strip().splitlines() if QUANTITY_RE.search(l)]
+        compacto = con_numero[-1] if con_numero else respuesta.strip().splitlines()[-1]
+    compacto = re.sub(r'\s+', ' ', compacto.replace('**', '')).strip()
+    return compacto[:MAX_COMPACT_RESULT_CHARS]
+
+class ContextoRazonamiento:
+    """Arma el contexto de cada llamada a partir de la pregunta, el plan y los pasos resueltos.
+
+    Guarda por paso la transcripción completa y un resultado compacto (valor + unidades), y
+    entrega a cada llamada un contexto acotado por 'presupuesto_tokens' según la política:
+      - "full": plan completo + transcripciones completas de los ancestros.
+      - "results-only": plan completo + resultados compactos de los ancestros.
+      - "ancestors-only": sólo el texto de los pasos ancestros (sin el plan) + sus resultados compactos.
+    La pregunta y el plan ('plan_prefijo') viajan en el prefijo común de los mensajes (ver
+    mensajes_prefijo); 'para_paso' devuelve sólo la parte que cambia entre pasos. También mide
+    los tokens enviados frente a la línea base histórica (pregunta + plan + todas las
+    transcripciones previas) en 'reporte'.
+    """
+    POLITICAS = ("full", "results-only", "ancestors-only")
+
+    def __init__(self, pregunta: str, plan_str: str, pasos: List[str], dag: Dict[int, List[int]],
+                 politica: Optional[str] = None, presupuesto_tokens: Optional[int] = None):
+        politica = politica or CONTEXT_POLICY
+        if politica not in self.POLITICAS: raise ValueError(f"Política de contexto desconocida: {politica}")
+        self.pregunta = pregunta; self.plan_str = plan_str; self.pasos = pasos; self.dag = dag
+        self.politica = politica; self.presupuesto_tokens = presupuesto_tokens or CONTEXT_TOKEN_BUDGET
+        self.transcripciones: Dict[int, str] = {}; self.compactos: Dict[int, str] = {}
+        self.reporte: Dict[str, Any] = {"policy": politica, "budget": self.presupuesto_tokens, "steps": {}, "synthesis": None}
+
+    def registrar(self, indice: int, respuesta: Optional[str]) -> None:
+        """Registra la salida de un paso resuelto (transcripción + resultado compacto)."""
+        if indice in self.transcripciones or respuesta is None: return
+        self.transcripciones[indice] = respuesta; self.compactos[indice] = extraer_resultado_compacto(respuesta)
+
+    def registrar_todos(self, respuestas: Dict[int, str]) -> None:
+        for indice, respuesta in respuestas.items(): self.registrar(indice, respuesta)
+
+    def _clave(self, indice: int) -> str:
+        return f"Paso {indice+1}: {self.pasos[indice]}"
+
+    @property
+    def plan_prefijo(self) -> str:
+        """Plan que va en el prefijo de las llamadas del Solucionador ('ancestors-only' no envía el plan completo)."""
+        return "" if self.politica == "ancestors-only" else self.plan_str
+
+    def _linea_base(self, indice: int) -> str:
+        """Contexto histórico: pregunta + plan + transcripciones de todos los pasos previos."""
+        previos = [j for j in sorted(self.transcripciones) if j < indice]
+        return (f"Pregunta Original: {self.pregunta}\nPlan General:\n{self.plan_str}\n\n--- Resultados Pasos Anteriores ---\n"
+                + "".join(f"{self._clave(j)}:\n{self.transcripciones[j]}\n" for j in previos)
+                + f"\n---\nTarea Actual: Ejecutar y detallar el paso '{self.pasos[indice]}'")
+
+    def _ajustar_presupuesto(self, cabecera: str, entradas: List[Tuple[int, str]], protegidos: Set[int]) -> List[Tuple[int, str]]:
+        """Recorta entradas hasta entrar en el presupuesto: primero compacta, luego descarta las más lejanas."""
+        def _total() -> int: return estimar_tokens(cabecera) + sum(estimar_tokens(f"{self._clave(j)}:\n{t}\n") for j, t in entradas)
+        entradas = list(entradas)
+        for pos, (j, texto) in enumerate(entradas):
+            if _total() <= self.presupuesto_tokens: return entradas
+            entradas[pos] = (j, self.compactos[j])
+        while _total() > self.presupuesto_tokens:
+            descartables = [pos for pos, (j, _) in enumerate(entradas) if j not in protegidos]
+            if not descartables: break
+            entradas.pop(descartables[0])
+        return entradas
+
+    def para_paso(self, indice: int) -> str:
+        """Contexto (acotado) para resolver el paso 'indice' con el Agente Solucionador, sin la pregunta ni el plan del prefijo."""
+        ancestros = [j for j in ancestros_paso(self.dag, indice) if j in self.transcripciones]
+        prefijo = contenido_prefijo(self.pregunta, self.plan_prefijo) + "\n\n"
+        if self.politica == "ancestors-only":
+            cabecera = "Pasos Relevantes del Plan:\n" + "\n".join(self.pasos[j] for j in ancestros + [indice]) + "\n\n--- Resultados Pasos Anteriores ---\n"
+        else: cabecera = "--- Resultados Pasos Anteriores ---\n"
+        fuente = self.transcripciones if self.politica == "full" else self.compactos
+        entradas = self._ajustar_presupuesto(prefijo + cabecera, [(j, fuente[j]) for j in ancestros], set(self.dag.get(indice, [])))
+        contexto = cabecera + "".join(f"{self._clave(j)}:\n{texto}\n" for j, texto in entradas)
+        self.reporte["steps"][f"Paso {indice+1}"] = {"tokens": estimar_tokens(prefijo + contexto), "tokens_baseline": estimar_tokens(self._linea_base(indice))}
+        return contexto
+
+    def para_sintesis(self, resultados_parciales: Dict[str, str]) -> Dict[str, str]:
+        """Resultados a entregar al Agente Sintetizador: completos ('full') o compactos (resto de políticas)."""
+        if self.politica == "full": seleccion = dict(resultados_parciales)
+        else:
+            por_clave = {self._clave(j): compacto for j, compacto in self.compactos.items()}
+            seleccion = {k: por_clave.get(k, v) for k, v in resultados_parciales.items()}
+        def _tokens(resultados: Dict[str, str]) -> int:
+            return estimar_tokens(self.pregunta + self.plan_str + "".join(f"- {k}:\n  {v}\n" for k, v in resultados.items()))
+        self.reporte["synthesis"] = {"tokens": _tokens(seleccion), "tokens_baseline": _tokens(resultados_parciales)}
+        return seleccion
+
+    def resumen(self) -> Dict[str, Any]:
+        return resumen_contexto(self.reporte)
+
+def resumen_contexto(reporte: Dict[str, Any]) -> Dict[str, Any]:
+    """Reporte de tokens de contexto por llamada (política actual vs. línea base) con totales."""
+    llamadas = list(reporte["steps"].values()) + ([reporte["synthesis"]] if reporte["synthesis"] else [])
+    return {**reporte, "steps": dict(reporte["steps"]), "total": sum(c["tokens"] for c in llamadas), "total_baseline": sum(c["tokens_baseline"] for c in llamadas)}
+
+
+# --- Motor Aritmético Determinista (pasos que son fórmulas puras) ---
+ASSIGNMENT_RE = re.compile(r'([^\W\d]\w*)\s*=(?!=)')
+CONDITIONAL_RE = re.compile(r'^(?P<si>.+?)\s+si\s+(?P<cond>.+?)\s*,?\s*(?:si\s+no|sino|de\s+lo\s+contrario|en\s+otro\s+caso)\s*,?\s+(?P<no>.+)$', re.IGNORECASE)
+UNIT_RE = re.compile(r'(?<![\w.])(?:m[²³23]?|cm|kg|usd|USD|dólares|metros(?:\s+c[úu]bicos)?)(?![\w])')
+_SAFE_FUNCS: Dict[str, Callable[..., float]] = {"sqrt": math.sqrt, "abs": abs, "min": min, "max": max,
+                                                  "round": lambda x, decimales=0: round(x, int(decimales))} # Las constantes llegan como float
+_SAFE_BINOPS = {ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b,
+                ast.Div: lambda a, b: a / b, ast.Pow: lambda a, b: a ** b, ast.Mod: lambda a, b: a % b}
+_SAFE_CMPOPS = {ast.Gt: lambda a, b: a > b, ast.GtE: lambda a, b: a >= b, ast.Lt: lambda a, b: a < b,
+                ast.LtE: lambda a, b: a <= b, ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b}
+MAX_EXPRESSION_LENGTH = 400
+MAX_EXPONENT = 64
+FINAL_VALUE_RE = re.compile(r'\$?\s*(-?\d[\d,]*(?:\.\d+)?)(?!\.?\d|,\d)(?!\s*[-+*/^×÷·%(\dxX])') # Número atómico, sin operador detrás
+
+def evaluar_expresion_segura(expresion: str, variables: Optional[Dict[str, float]] = None) -> float:
+    """Evalúa una expresión aritmética recorriendo su AST (nunca usa eval).
+
+    Admite + - * / ** %, comparaciones, 'A if COND else B', constantes numéricas, 'pi',
+    variables conocidas y las funciones de _SAFE_FUNCS. Cualquier otra cosa (o una división por
+    cero, o una operación sobre un complejo) -> ValueError.
+    Todo se calcula en float: un resultado desbordado falla al instante (OverflowError o inf)
+    en lugar de construir enteros arbitrariamente grandes ('(9**64)**64' no bloquea el hilo).
+    """
+    if len(expresion) > MAX_EXPRESSION_LENGTH: raise ValueError("Expresión demasiado larga.")
+    nombres = {"pi": PI_VALUE, **{k: float(v) for k, v in (variables or {}).items()}}
+
+    def _eval(nodo: ast.AST) -> Any:
+        if isinstance(nodo, ast.Expression): return _eval(nodo.body)
+        if isinstance(nodo, ast.Constant) and isinstance(nodo.value, (int, float)) and not isinstance(nodo.value, bool): return float(nodo.value)
+        if isinstance(nodo, ast.Name):
+            if nodo.id in nombres: return nombres[nodo.id]
+            raise ValueError(f"Variable desconocida: {nodo.id}")
+        if isinstance(nodo, ast.UnaryOp) and isinstance(nodo.op, (ast.USub, ast.UAdd)):
+            valor = _eval(nodo.operand); return -valor if isinstance(nodo.op, ast.USub) else valor
+        if isinstance(nodo, ast.BinOp) and type(nodo.op) in _SAFE_BINOPS:
+            izq, der = _eval(nodo.left), _eval(nodo.right)
+            if isinstance(nodo.op, ast.Pow) and abs(der) > MAX_EXPONENT: raise ValueError("Exponente fuera de rango.")
+            return _SAFE_BINOPS[type(nodo.op)](izq, der)
+        if isinstance(nodo, ast.Compare) and all(type(op) in _SAFE_CMPOPS for op in nodo.ops):
+            izq = _eval(nodo.left)
+            for op, comparador in zip(nodo.ops, nodo.comparators):
+                der = _eval(comparador)
+                if not _SAFE_CMPOPS[type(op)](izq, der): return False
+                izq = der
+            return True
+        if isinstance(nodo, ast.IfExp): return _eval(nodo.body) if _eval(nodo.test) else _eval(nodo.orelse)
+        if isinstance(nodo, ast.Call) and isinstance(nodo.func, ast.Name) and nodo.func.id in _SAFE_FUNCS and not nodo.keywords:
+            return _SAFE_FUNCS[nodo.func.id](*[_eval(arg) for arg in nodo.args])
+        raise ValueError(f"Construcción no permitida: {type(nodo).__name__}")
+
+    try: arbol = ast.parse(expresion.strip(), mode="eval")
+    except SyntaxError as e: raise ValueError(f"Expresión inválida: {e}")
+    try: valor = _eval(arbol)
+    except OverflowError: raise ValueError("Resultado fuera de rango.")
+    except ZeroDivisionError: raise ValueError("División por cero.")
+    except TypeError as e: raise ValueError(f"Operación no válida: {e}") # p. ej. comparar un complejo ('(-8)**0.5 > 1')
+    if isinstance(valor, bool) or not isinstance(valor, (int, float)) or not math.isfinite(valor): raise ValueError("El resultado no es numérico.")
+    return float(valor)
+
+def normalizar_expresion(texto: str) -> str:
+    """Traduce notación matemática de los planes (×, ², π, %, 10,000, 'si ... si no ...') a sintaxis Python."""
+    expr = texto.strip().rstrip('.;')
+    condicional = CONDITIONAL_RE.match(expr)
+    if condicional:
+        return f"({normalizar_expresion(condicional.group('si'))}) if ({normalizar_expresion(condicional.group('cond'))}) else ({normalizar_expresion(condicional.group('no'))})"
+    expr = UNIT_RE.sub('', expr) # antes de traducir ²/³ para no convertir 'm³' en una potencia
+    expr = expr.replace('$', '').replace('π', 'pi').replace('×', '*').replace('·', '*').replace('÷', '/').replace('−', '-')
+    expr = expr.replace('²', '**2').replace('³', '**3').replace('^', '**').replace('≥', '>=').replace('≤', '<=')
+    expr = re.sub(r'(\d),(\d{3})(?!\d)', r'\1\2', expr) # separador de miles
+    expr = re.sub(r'(\d+(?:\.\d+)?)\s*%', r'(\1/100)', expr)
+    expr = re.sub(r'(?<=[\d)])\s*[xX]\s*(?=[\d(])', '*', expr)
+    expr = re.sub(r'(\d|\))\s*(pi\b|\()', r'\1*\2', expr) # multiplicación implícita: 2pi, 3(…), )(…)
+    expr = re.sub(r'\bsupera\b', '>', expr, flags=re.IGNORECASE)
+    return expr
+
+def _cuerpo_paso(paso: str) -> str:
+    """Texto del paso sin numeración ni anotación de dependencias."""
+    return STEP_DEPS_RE.sub('', STEP_NUMBER_RE.sub('', paso, count=1)).strip()
+
+def nombre_asignado_paso(paso: str) -> Optional[str]:
+    """Nombre de la variable que define el paso ('V_base = ...'), si lo hay."""
+    m = ASSIGNMENT_RE.search(_cuerpo_paso(paso))
+    return m.group(1) if m else None
+
+def _formatear_numero(valor: float) -> str:
+    return f"{valor:.6f}".rstrip('0').rstrip('.') if valor != int(valor) else str(int(valor))
+
+def resolver_paso_local(paso: str, variables: Dict[str, float]) -> Optional[Tuple[str, float, str]]:
+    """Intenta resolver un paso como aritmética pura sobre cantidades conocidas.
+
+    Devuelve (nombre, valor, texto_resultado) o None si el paso no es una fórmula evaluable
+    (en cuyo caso se delega al Agente Solucionador).
+    """
+    if not ARITHMETIC_ENGINE_ENABLED: return None
+    cuerpo = _cuerpo_paso(paso)
+    m = ASSIGNMENT_RE.search(cuerpo)
+    if not m: return None
+    nombre = m.group(1)
+    # 'V = π × r² × h = π × 3² × 0.5 ≈ 14.14': se prueba cada miembro de izquierda a derecha, sin aproximaciones
+    miembros = cuerpo[m.end():].split('≈')[0].split('=')
+    for miembro in miembros:
+        if not miembro.strip(): continue
+        try: valor = evaluar_expresion_segura(normalizar_expresion(miembro), variables)
+        except ValueError: continue
+        texto = f"{nombre} = {miembro.strip()} = {_formatear_numero(valor)}\nResultado: {nombre} = {_formatear_numero(valor)} (cálculo determinista local)"
+        return nombre, valor, texto
+    return None
+
+def valor_final_cadena(cadena: str) -> Optional[float]:
+    """Valor tras el último '=' (o '≈') de una cadena de igualdades: '30 / 2 = 15' -> 15.
+
+    El último miembro tiene que ser un número solo (con unidades o '$'); si es una expresión
+    ('3 - 0.25') devuelve None. La cadena termina en el fin de línea o en ', '/'; ' (otra asignación).
+    """
+    cadena = re.sub(r'(?<=\S)\*\*(?=[\s.,;:)]|$)', '', cadena) # Cierre de negrita markdown ('**RE = 15**'), no '3**2'
+    miembro = re.split(r'[=≈]', re.split(r'[,;]\s|\n', cadena, maxsplit=1)[0])[-1].strip()
+    m = FINAL_VALUE_RE.match(miembro)
+    if not m: return None
+    try: return float(m.group(1).replace(',', ''))
+    except ValueError: return None
+
+def registrar_variable_respuesta(paso: str, respuesta: Optional[str], variables: Dict[str, float]) -> None:
+    """Vincula el valor final informado por el LLM ('NOMBRE = 30 / 2 = 15') al nombre que define el paso.
+
+    Manda la línea 'Resultado: NOMBRE = valor' (la última); si no la hay, la última línea que
+    asigne NOMBRE. Si ningún candidato termina en un número solo, el nombre queda sin valor y los
+    pasos que lo usan se delegan al LLM en lugar de calcularse con un valor equivocado.
+    """
+    nombre = nombre_asignado_paso(paso)
+    if not nombre or not respuesta: return
+    asignacion = re.compile(rf'(?<![\w.])\*{{0,2}}{re.escape(nombre)}\*{{0,2}}\s*[=≈](?!=)')
+    candidatas = list(reversed(RESULT_LINE_RE.findall(respuesta))) + list(reversed(respuesta.splitlines()))
+    for linea in candidatas:
+        asignaciones = list(asignacion.finditer(linea))
+        if not asignaciones: continue
+        valor = valor_final_cadena(linea[asignaciones[-1].end():])
+        if valor is not None: variables[nombre] = valor; return
+
+def _nombres_formula(paso: str) -> Set[str]:
+    """Identificadores usados en el miembro derecho de la fórmula del paso."""
+    cuerpo = _cuerpo_paso(paso)
+    m = ASSIGNMENT_RE.search(cuerpo)
+    return set(re.findall(r'[^\W\d]\w*', re.sub(r'[²³]', ' ', cuerpo[m.end():]))) if m else set() # 'R²' usa R (² es \w)
+
+def usage_local() -> object:
+    """'usage' de un paso resuelto por el motor aritmético: no consume tokens."""
+    return types.SimpleNamespace(prompt_tokens=0, completion_tokens=0, local=True)
+
+def es_paso_local(usage: Optional[object]) -> bool:
+    return bool(getattr(usage, "local", False))
+
+def resolver_pasos_locales(pasos: List[str], dag: Dict[int, List[int]], completados: Set[int], ocupados: Set[int],
+                           respuestas: Dict[int, str], usages: Dict[int, object], variables: Dict[str, float]) -> List[int]:
+    """Resuelve con el motor aritmético todos los pasos listos que sean fórmulas evaluables.
+
+    Itera hasta un punto fijo (un paso local puede habilitar otro) y devuelve los índices resueltos.
+    """
+    resueltos: List[int] = []; avance = True
+    while avance:
+        avance = False
+        for i in range(len(pasos)):
+            if i in completados or i in ocupados or not all(dep in completados for dep in dag.get(i, [])): continue
+            inicio = time.perf_counter(); local = resolver_paso_local(pasos[i], variables)
+            if local is None: continue
+            nombre, valor, texto = local
+            print(f"\n--- Paso {i+1} resuelto localmente: {nombre} = {_formatear_numero(valor)} ---")
+            get_trazador().registrar_span(f"Paso {i+1}", "step", time.perf_counter() - inicio, local=True)
+            variables[nombre] = valor; respuestas[i] = texto; usages[i] = usage_local()
+            completados.add(i); resueltos.append(i); avance = True
+    return resueltos
+
+def paso_fallido(respuesta: Optional[str], usage: Optional[object]) -> bool:
+    """Indica si la respuesta del Agente Solucionador corresponde a un error crítico."""
+    return usage is None or not respuesta or ("Error API" in respuesta or "Error inesperado" in respuesta or respuesta.startswith("Error Votación"))
+
+def ejecutar_pasos_dag(client: OpenAI, model_name: str, contexto: ContextoRazonamiento,
+                       max_workers: int = MAX_PARALLEL_STEPS, on_delta: Optional[Callable[[int, str], None]] = None,
+                       ttft: Optional[Dict[int, Optional[float]]] = None, variables: Optional[Dict[str, float]] = None,
+                       on_resultado: Optional[Callable[[int, str, object], None]] = None) -> Tuple[Dict[int, str], Dict[int, object], Optional[int]]:
+    """Ejecuta los pasos del plan respetando el DAG, despachando en paralelo los que están listos.
+
+    Los pasos ya registrados en 'contexto' se consideran completados (no se re-ejecutan) y
+    'variables' acumula los valores con nombre que produce cada paso.
+    Devuelve (respuestas por índice, usages por índice, índice del paso fallido o None) de los pasos ejecutados;
+    un paso fallido sólo trae 'usage' si la llamada llegó a cobrarse (ver paso_fallido).
+    Ante un fallo no se despachan pasos nuevos, pero se esperan los que ya estaban en curso.
+    Si se pasa 'on_delta(indice, fragmento)' los pasos se ejecutan en streaming (el callback se
+    invoca desde los hilos del pool) y el TTFT de cada paso se guarda en 'ttft'.
+    'on_resultado(indice, respuesta, usage)' se invoca (en este hilo) apenas un paso termina bien.
+    """
+    pasos, dag = contexto.pasos, contexto.dag
+    def _resolver(i: int, contexto_texto: str, enviado: float) -> Tuple[Optional[str], Optional[object]]:
+        modelo = modelo_para_llamada(model_name, "solving", pasos[i])
+        with get_trazador().span(f"Paso {i+1}", "step", queue_wait_s=time.perf_counter() - enviado) as span:
+            prefijo = {"pregunta_original": contexto.pregunta, "plan": contexto.plan_prefijo}
+            if on_delta is None: salida = agente_solucionador(client, modelo, pasos[i], contexto_texto, etiqueta=f"Paso {i+1}", **prefijo)
+            else:
+                metricas: Dict[str, Any] = {}
+                salida = agente_solucionador(client, modelo, pasos[i], contexto_texto, on_delta=lambda d: on_delta(i, d), metricas=metricas, etiqueta=f"Paso {i+1}", **prefijo)
+                if ttft is not None: ttft[i] = metricas.get("ttft")
+            if paso_fallido(*salida): span["error"] = (salida[0] or "sin respuesta")[:200]
+            return salida
+
+    respuestas: Dict[int, str] = {}; usages: Dict[int, object] = {}; fallido: Optional[int] = None
+    completados: Set[int] = set(contexto.transcripciones); en_curso: Dict[Any, int] = {}
+    variables = {} if variables is None else variables
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        while True:
+            if fallido is None:
+                # Primero los pasos aritméticos puros (sin LLM); el resto va al Agente Solucionador
+                for i in resolver_pasos_locales(pasos, dag, completados, set(en_curso.values()), respuestas, usages, variables):
+                    contexto.registrar(i, respuestas[i])
+                    if on_delta: on_delta(i, respuestas[i])
+                    if ttft is not None: ttft[i] = 0.0
+                    if on_resultado: on_resultado(i, respuestas[i], usages[i])
+                for i in range(len(pasos)):
+                    if i in completados or i in en_curso.values(): continue
+                    if all(dep in completados for dep in dag.get(i, [])):
+                        print(f"\n--- Ejecutando Paso {i+1}: {pasos[i][:80]}... ---")
+                        # copy_context: los spans del paso quedan bajo el span de la etapa aunque corran en otro hilo
+                        en_curso[pool.submit(contextvars.copy_context().run, _resolver, i, contexto.para_paso(i), time.perf_counter())] = i
+            if not en_curso: break
+            terminados, _ = wait(list(en_curso), return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                i = en_curso.pop(futuro)
+                try: respuesta, usage = futuro.result()
+                except Exception as e: respuesta, usage = f"Error inesperado: {e}", None
+                respuestas[i] = respuesta
+                if paso_fallido(respuesta, usage):
+                    print(f"!!! Error Crítico Paso {i+1}: {respuesta}")
+                    if fallido is None or i < fallido: fallido = i
+                    if usage is not None: usages[i] = usage # Fallo ya pagado: se contabiliza, pero el paso no queda resuelto
+                else:
+                    usages[i] = usage; completados.add(i); contexto.registrar(i, respuesta); registrar_variable_respuesta(pasos[i], respuesta, variables)
+                    if on_resultado: on_resultado(i, respuesta, usage)
+    return respuestas, usages, fallido
+
+
+# --- Caché Semántica de Planes (plantillas de preguntas con otros números) ---
+PLAN_NUMBER_RE = re.compile(r'(?<![\w.])(?:[0-9]{1,3}(?:,[0-9]{3})+|[0-9]+)(?:\.[0-9]+)?(?![0-9])')
+PLAN_SLOT_RE = re.compile(r'⟦(\d+)⟧')
+VERDICT_APPROVED, VERDICT_REJECTED = "VEREDICTO: APROBADO", "VEREDICTO: RECHAZADO" # Última línea de la revisión del plan
+VERDICT_RE = re.compile(r'^\W*VEREDICTO\W*:\W*(APROBADO|RECHAZADO)\W*$', re.IGNORECASE | re.MULTILINE)
+PLAN_SAFE_CONSTANTS = (0, 1, 2, 3, 4, 10, 100, 1000, round(PI_VALUE, 2), round(PI_VALUE, 4))
+# Relaciones admitidas entre un número del plan y uno de la pregunta (p. ej. 15% -> 1.15, diámetro 6 -> radio 3)
+PLAN_DERIVATIONS: Dict[str, Callable[[float], float]] = {
+    "x": lambda x: x, "x/100": lambda x: x / 100, "1+x/100": lambda x: 1 + x / 100, "1-x/100": lambda x: 1 - x / 100, "x/2": lambda x: x / 2,
+}
+
+LIST_ITEM_RE = re.compile(r'(?m)^\s*\d+[.)]\s+')
+
+def _numeros_texto(texto: str, protegidos: List[Tuple[int, int]] = ()) -> List[Tuple[int, int, str, float]]:
+    """(inicio, fin, literal, valor) de cada número del texto fuera de los tramos protegidos ('10,000' se lee como 10000)."""
+    return [(m.start(), m.end(), m.group(0), float(m.group(0).replace(",", ""))) for m in PLAN_NUMBER_RE.finditer(texto)
+            if not any(a <= m.start() < b for a, b in protegidos)]
+
+def normalizar_pregunta(pregunta: str) -> Tuple[str, List[float]]:
+    """Plantilla de la pregunta (números -> '#', minúsculas, espacios colapsados) y sus números en orden.
+
+    La numeración de listas ('1. Una base...') queda como texto: es estructura, no un dato.
+    """
+    partes, numeros, ultimo = [], [], 0
+    for inicio, fin, _, valor in _numeros_texto(pregunta, [m.span() for m in LIST_ITEM_RE.finditer(pregunta)]):
+        partes.append(pregunta[ultimo:inicio] + "#"); numeros.append(valor); ultimo = fin
+    return " ".join(("".join(partes) + pregunta[ultimo:]).lower().split()), numeros
+
+def _mismo_valor(a: float, b: float) -> bool:
+    return abs(a - b) <= 1e-9 * max(1.0, abs(b))
+
+def _ngramas(texto: str, n: int = 3) -> Dict[str, int]:
+    texto = f" {texto} "; conteo: Dict[str, int] = {}
+    for i in range(len(texto) - n + 1): conteo[texto[i:i+n]] = conteo.get(texto[i:i+n], 0) + 1
+    return conteo
+
+def similitud_ngramas(a: Dict[str, int], b: Dict[str, int]) -> float:
+    """Similitud coseno entre dos vectores de n-gramas de caracteres."""
+    producto = sum(v * b.get(k, 0) for k, v in a.items())
+    norma = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return producto / norma if norma else 0.0
+
+def _tramos_protegidos(plan: str) -> List[Tuple[int, int]]:
+    """Numeración de líneas y referencias a pasos ('Paso 3'): no son números de la pregunta."""
+    return [m.span() for m in re.finditer(STEP_LINE_RE.pattern, plan, re.MULTILINE)] + [m.span() for m in STEP_REF_RE.finditer(plan)]
+
+def plantilla_plan(plan: str, numeros_pregunta: List[float]) -> Tuple[Optional[str], List[Dict[str, Any]], Optional[str]]:
+    """Convierte un plan en plantilla: cada número se vincula a números de la pregunta.
+
+    Devuelve (plantilla, vínculos, motivo). Cada vínculo guarda sus candidatos en orden de
+    preferencia (igualdad con un número de la pregunta, constante conocida, relación derivada);
+    si un número del plan no tiene origen en la pregunta, la plantilla es None y 'motivo' lo explica.
+    """
+    partes: List[str] = []; vinculos: List[Dict[str, Any]] = []; ultimo = 0; sin_origen = []
+    for inicio, fin, literal, valor in _numeros_texto(plan, _tramos_protegidos(plan)):
+        candidatos: List[List[Any]] = [["q", k, "x"] for k, q in enumerate(numeros_pregunta) if _mismo_valor(valor, q)]
+        candidatos += [["c", c, ""] for c in PLAN_SAFE_CONSTANTS if _mismo_valor(valor, c)]
+        candidatos += [["q", k, op] for op, f in PLAN_DERIVATIONS.items() if op != "x" for k, q in enumerate(numeros_pregunta) if _mismo_valor(valor, f(q))]
+        if not candidatos: sin_origen.append(literal); continue
+        partes.append(plan[ultimo:inicio] + f"⟦{len(vinculos)}⟧"); vinculos.append({"literal": literal, "candidatos": candidatos}); ultimo = fin
+    if sin_origen: return None, [], f"números del plan sin origen en la pregunta: {', '.join(sin_origen[:5])}"
+    return "".join(partes) + plan[ultimo:], vinculos, None
+
+def _renderizar_numero(valor: float, literal: str) -> str:
+    valor = round(valor, 9)
+    return f"{int(valor):,}" if "," in literal and valor == int(valor) else _formatear_numero(valor)
+
+def vincular_plan(plantilla: str, vinculos: List[Dict[str, Any]], numeros_pregunta: List[float]) -> Tuple[str, bool]:
+    """Reemplaza los números de la pregunta nueva en la plantilla. Devuelve (plan, ambiguo).
+
+    'ambiguo' indica que algún número tenía varios orígenes posibles que ahora dan valores
+    distintos: no se sabe cuál corresponde, así que el plan no debe reutilizarse.
+    """
+    ambiguo = False; valores = []
+    for vinculo in vinculos:
+        opciones = [c[1] if c[0] == "c" else PLAN_DERIVATIONS[c[2]](numeros_pregunta[c[1]]) for c in vinculo["candidatos"]]
+        ambiguo = ambiguo or any(not _mismo_valor(v, opciones[0]) for v in opciones[1:])
+        valores.append(_renderizar_numero(opciones[0], vinculo["literal"]))
+    return PLAN_SLOT_RE.sub(lambda m: valores[int(m.group(1))], plantilla), ambiguo
+
+class PlanTemplateCache:
+    """Planes verificados indexados por la plantilla de la pregunta (memoria + SQLite en disco).
+
+    La búsqueda es exacta por plantilla y, si no hay coincidencia, por similitud coseno de
+    n-gramas de caracteres contra las plantillas guardadas. Es segura para uso entre hilos.
+    """
+
+    def __init__(self, path: Optional[str] = PLAN_CACHE_PATH, max_entries: int = PLAN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.stats_report = {"lookups": 0, "hits": 0, "reverify": 0, "misses": 0, "fallbacks": 0, "stored": 0}
+        self._entradas: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS plan_templates (
+                key TEXT PRIMARY KEY, question_template TEXT, n_numbers INTEGER, plan_template TEXT, bindings TEXT, last_access REAL)""")
+            self._db.commit()
+            filas = self._db.execute("SELECT key, question_template, n_numbers, plan_template, bindings FROM plan_templates ORDER BY last_access DESC LIMIT ?", (max_entries,)).fetchall()
+            for fila in reversed(filas): self._entradas[fila[0]] = self._entrada(fila[1], fila[2], fila[3], json.loads(fila[4]))
+
+    @staticmethod
+    def _entrada(plantilla_pregunta: str, n_numeros: int, plantilla: str, vinculos: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"question_template": plantilla_pregunta, "n_numbers": n_numeros, "plan_template": plantilla,
+                "bindings": vinculos, "ngrams": _ngramas(plantilla_pregunta)}
+
+    @staticmethod
+    def make_key(plantilla_pregunta: str) -> str:
+        return hashlib.sha256(plantilla_pregunta.encode("utf-8")).hexdigest()
+
+    def buscar(self, plantilla_pregunta: str) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Entrada exacta (similitud 1.0) o la más parecida por n-gramas; (None, 0.0) si está vacía."""
+        key = self.make_key(plantilla_pregunta)
+        with self._lock:
+            self.stats_report["lookups"] += 1
+            if key in self._entradas:
+                self._entradas.move_to_end(key)
+                if self._db is not None: self._db.execute("UPDATE plan_templates SET last_access = ? WHERE key = ?", (time.time(), key)); self._db.commit()
+                return self._entradas[key], 1.0
+            consulta = _ngramas(plantilla_pregunta); mejor, similitud = None, 0.0
+            for entrada in self._entradas.values():
+                s = similitud_ngramas(consulta, entrada["ngrams"])
+                if s > similitud: mejor, similitud = entrada, s
+            return mejor, similitud
+
+    def guardar(self, plantilla_pregunta: str, n_numeros: int, plantilla: str, vinculos: List[Dict[str, Any]]) -> None:
+        key = self.make_key(plantilla_pregunta)
+        with self._lock:
+            self._entradas[key] = self._entrada(plantilla_pregunta, n_numeros, plantilla, vinculos); self._entradas.move_to_end(key)
+            while len(self._entradas) > self.max_entries: self._entradas.popitem(last=False)
+            self.stats_report["stored"] += 1
+            if self._db is None: return
+            self._db.execute("INSERT OR REPLACE INTO plan_templates VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, plantilla_pregunta, n_numeros, plantilla, json.dumps(vinculos), time.time()))
+            self._db.execute("""DELETE FROM plan_templates WHERE key IN (SELECT key FROM plan_templates
+                                ORDER BY last_access DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+            self._db.commit()
+
+    def contar(self, evento: str) -> None:
+        with self._lock: self.stats_report[evento] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores globales y tasa de aciertos (planes reutilizados / búsquedas)."""
+        with self._lock: reporte = dict(self.stats_report)
+        reporte["hit_rate"] = (reporte["hits"] + reporte["reverify"]) / reporte["lookups"] if reporte["lookups"] else 0.0
+        return reporte
+
+_PLAN_CACHE: Optional[PlanTemplateCache] = None
+_PLAN_CACHE_LOCK = threading.Lock()
+
+def get_plan_cache() -> Optional[PlanTemplateCache]:
+    """Devuelve la caché de planes global (creada de forma perezosa) o None si está deshabilitada."""
+    global _PLAN_CACHE
+    if not PLAN_CACHE_ENABLED: return None
+    with _PLAN_CACHE_LOCK:
+        if _PLAN_CACHE is None:
+            try: _PLAN_CACHE = PlanTemplateCache()
+            except sqlite3.Error as e: print(f"Adv: caché de planes en disco no disponible ({e}); se usa sólo memoria."); _PLAN_CACHE = PlanTemplateCache(path=None)
+        return _PLAN_CACHE
+
+def veredicto_revision(revision_plan: Optional[str]) -> Optional[bool]:
+    """True/False según la última línea 'VEREDICTO: ...' de la revisión; None si no la hay."""
+    veredictos = VERDICT_RE.findall(revision_plan or "")
+    return veredictos[-1].upper() == "APROBADO" if veredictos else None
+
+
+# --- Almacén Durable de Ejecuciones (checkpoint y reanudación) ---
+class AlmacenEjecuciones:
+    """Checkpoints de ejecuciones en SQLite: la foto más reciente del estado + una bitácora de eventos.
+
+    Cada transición de etapa y cada paso resuelto se escriben apenas ocurren, así una ejecución
+    interrumpida (reinicio del proceso o fallo de un paso) se retoma desde el último paso bueno.
+    El archivo no crece sin límite: al abrirlo y cada vez que una ejecución termina se borran las
+    ejecuciones (y su bitácora) más antiguas que 'max_edad_dias' o que exceden 'max_ejecuciones'.
+    Es segura para uso entre hilos.
+    """
+
+    def __init__(self, path: str = RUN_STORE_PATH, max_ejecuciones: int = RUN_STORE_MAX_RUNS, max_edad_dias: float = RUN_STORE_MAX_AGE_DAYS):
+        self.max_ejecuciones = max_ejecuciones; self.max_edad_dias = max_edad_dias
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY, question TEXT, stage TEXT, state TEXT, created_at REAL, updated_at REAL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS run_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT, ts REAL, stage TEXT, event TEXT, detail TEXT)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS run_events_run_id ON run_events (run_id)")
+        self._db.commit()
+        self.podar()
+
+    def guardar(self, estado: Dict[str, Any], evento: str, detalle: Optional[str] = None) -> None:
+        """Reemplaza la foto del estado y agrega el evento a la bitácora (en una sola transacción)."""
+        ahora = time.time(); foto = json.dumps(estado, ensure_ascii=False)
+        with self._lock:
+            self._db.execute("""INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(run_id) DO UPDATE SET
+                                stage = excluded.stage, state = excluded.state, updated_at = excluded.updated_at""",
+                             (estado["run_id"], estado["pregunta_original"], estado["current_stage"], foto, ahora, ahora))
+            self._db.execute("INSERT INTO run_events (run_id, ts, stage, event, detail) VALUES (?, ?, ?, ?, ?)",
+                             (estado["run_id"], ahora, estado["current_stage"], evento, detalle))
+            self._db.commit()
+        if estado["current_stage"] in ETAPAS_FINALES: self.podar()
+
+    def podar(self) -> int:
+        """Borra las ejecuciones vencidas o que exceden el máximo (las menos recientes) y su bitácora; devuelve cuántas."""
+        with self._lock:
+            borradas = self._db.execute("""DELETE FROM runs WHERE updated_at < ? OR run_id IN (SELECT run_id FROM runs
+                                           ORDER BY updated_at DESC LIMIT -1 OFFSET ?)""",
+                                        (time.time() - self.max_edad_dias * 86400, max(0, self.max_ejecuciones))).rowcount
+            if borradas: self._db.execute("DELETE FROM run_events WHERE run_id NOT IN (SELECT run_id FROM runs)")
+            self._db.commit()
+        return borradas
+
+    def cargar(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """Última foto del estado de 'run_id' (None si no existe)."""
+        with self._lock: fila = self._db.execute("SELECT state FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if fila is None: return None
+        estado = {**nuevo_estado_razonamiento(""), **json.loads(fila[0])} # Claves nuevas con su valor inicial en fotos antiguas
+        # JSON convierte las claves enteras en texto
+        estado["dag"] = {int(k): v for k, v in estado["dag"].items()}
+        estado["step_results"] = {int(k): v for k, v in estado["step_results"].items()}
+        return estado
+
+    def listar(self, limite: int = 20, incluir_terminadas: bool = False) -> List[Dict[str, Any]]:
+        """Ejecuciones más recientes (por defecto sólo las que no terminaron bien)."""
+        filtro = "" if incluir_terminadas else "WHERE stage != 'done'"
+        with self._lock:
+            filas = self._db.execute(f"SELECT run_id, question, stage, updated_at FROM runs {filtro} ORDER BY updated_at DESC LIMIT ?", (limite,)).fetchall()
+        return [{"run_id": f[0], "question": f[1], "stage": f[2], "updated_at": f[3]} for f in filas]
+
+    def eventos(self, run_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            filas = self._db.execute("SELECT ts, stage, event, detail FROM run_events WHERE run_id = ? ORDER BY id", (run_id,)).fetchall()
+        return [{"ts": f[0], "stage": f[1], "event": f[2], "detail": f[3]} for f in filas]
+
+_ALMACEN_EJECUCIONES: Optional[AlmacenEjecuciones] = None
+_ALMACEN_EJECUCIONES_LOCK = threading.Lock()
+
+def get_almacen_ejecuciones() -> Optional[AlmacenEjecuciones]:
+    """Devuelve el almacén global (creado de forma perezosa) o None si está deshabilitado o no disponible."""
+    global _ALMACEN_EJECUCIONES
+    if not RUN_STORE_ENABLED: return None
+    with _ALMACEN_EJECUCIONES_LOCK:
+        if _ALMACEN_EJECUCIONES is None:
+            try: _ALMACEN_EJECUCIONES = AlmacenEjecuciones()
+            except sqlite3.Error as e: print(f"Adv: almacén de ejecuciones no disponible ({e}); no habrá checkpoints."); return None
+        return _ALMACEN_EJECUCIONES
+
+def checkpoint_estado(estado: Dict[str, Any], evento: str, detalle: Optional[str] = None) -> None:
+    """Persiste el estado si el almacén está habilitado; un fallo de escritura no detiene la ejecución."""
+    almacen = get_almacen_ejecuciones()
+    if almacen is None: return
+    try: almacen.guardar(estado, evento, detalle)
+    except (sqlite3.Error, TypeError, ValueError) as e: print(f"Adv: no se pudo guardar el checkpoint de {estado.get('run_id')}: {e}")
+
+def preparar_reanudacion(estado: Dict[str, Any]) -> Dict[str, Any]:
+    """Deja un estado (cargado o en memoria) listo para continuar desde el último paso bueno.
+
+    Una ejecución en 'error' vuelve a la etapa que falló; los resultados de pasos que no
+    terminaron bien se descartan para que se re-ejecuten. Una ejecución 'done' no cambia.
+    """
+    if estado["current_stage"] == "error" and estado.get("failed_stage"):
+        estado["current_stage"] = estado["failed_stage"]; estado["failed_stage"] = None
+        estado["error_message"] = None; estado["respuesta_final"] = None
+    estado["resultados_parciales"] = {f"Paso {i+1}: {paso}": estado["step_results"][i] for i, paso in enumerate(estado["steps"]) if i in estado["step_results"]}
+    return estado
+
+def reanudar_estado(run_id: str) -> Optional[Dict[str, Any]]:
+    """Carga la ejecución 'run_id' del almacén y la prepara para continuar (None si no existe)."""
+    almacen = get_almacen_ejecuciones()
+    estado = almacen.cargar(run_id) if almacen is not None else None
+    if estado is None: return None
+    print(f"\n--- Reanudando ejecución {run_id} desde '{estado['current_stage']}' ({len(estado['step_results'])} pasos ya resueltos) ---")
+    return preparar_reanudacion(estado)
+
+
+# --- Estado de una Ejecución y Máquina de Etapas (compartida por orquestadores y UI) ---
+# decomposing -> verifying -> solving -> synthesizing -> done  (o 'error' en cualquier punto)
+ETAPAS_FINALES = ("done", "error")
+
+def calcular_token_report(tokens: Dict[str, int], uso_por_modelo: Optional[Dict[str, Dict[str, int]]] = None) -> Dict[str, Any]:
+    """Calcula costos y arma el 'token_report' final.
+
+    'tokens' separa la entrada de todas las llamadas ('prompt', de la que 'cached' vino de la caché
+    de prefijos del proveedor) de la salida intermedia ('reasoning': plan, revisión y pasos) y la
+    final ('output': síntesis). El costo se calcula por modelo: entrada a su tarifa de entrada (la
+    cacheada a su tarifa reducida) y salida a su tarifa de salida. Los tokens sin modelo asociado
+    (p. ej. de ejecuciones guardadas antes del ruteo) se costean con MODEL_NAME.
+    """
+    uso_por_modelo = uso_por_modelo or {}
+    sin_modelo = {"prompt": tokens["prompt"] - sum(u["prompt"] for u in uso_por_modelo.values()),
+                  "completion": tokens["reasoning"] + tokens["output"] - sum(u["completion"] for u in uso_por_modelo.values()),
+                  "cached": tokens.get("cached", 0) - sum(u.get("cached", 0) for u in uso_por_modelo.values())}
+    by_model = {}
+    for modelo, uso in list(uso_por_modelo.items()) + ([(MODEL_NAME, sin_modelo)] if sin_modelo["prompt"] > 0 or sin_modelo["completion"] > 0 else []):
+        tarifa_entrada, tarifa_salida = tarifas_modelo(modelo); previo = by_model.get(modelo, {"prompt": 0, "completion": 0, "cached": 0})
+        prompt, completion, cached = previo["prompt"] + uso["prompt"], previo["completion"] + uso["completion"], previo["cached"] + uso.get("cached", 0)
+        by_model[modelo] = {"prompt": prompt, "completion": completion, "cached": cached,
+                            "cost_input": (prompt - cached) * (tarifa_entrada / 1_000_000) + cached * (tarifa_entrada_cacheada(modelo) / 1_000_000),
+                            "cost_output": completion * (tarifa_salida / 1_000_000)}
+    cost_input = sum(m["cost_input"] for m in by_model.values()); cost_output = sum(m["cost_output"] for m in by_model.values())
+    return {
+        "prompt": tokens["prompt"], "prompt_cached": tokens.get("cached", 0), "reasoning": tokens["reasoning"], "output": tokens["output"],
+        "total_calc": tokens["prompt"] + tokens["reasoning"] + tokens["output"],
+        "cost_input": cost_input, "cost_output": cost_output, "cost_total": cost_input + cost_output, "by_model": by_model
+    }
+
+def nuevo_estado_razonamiento(pregunta_usuario: str, run_id: Optional[str] = None, presupuesto: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Estado inicial de una ejecución; avanzar_etapa lo va completando etapa por etapa.
+
+    'presupuesto' ({"max_cost_usd", "max_tokens"}) reemplaza los límites por defecto (RUN_MAX_*).
+    """
+    return {
+        "run_id": run_id or uuid.uuid4().hex[:12], "pregunta_original": pregunta_usuario, "current_stage": "decomposing", "failed_stage": None,
+        "plan": None, "plan_revision": None, "steps": [], "dag": {}, "step_results": {}, "variables": {},
+        "resultados_parciales": {}, "respuesta_final": None,
+        "tokens": {"prompt": 0, "reasoning": 0, "output": 0, "cached": 0}, "model_usage": {},
+        "token_report": calcular_token_report({"prompt": 0, "reasoning": 0, "output": 0, "cached": 0}),
+        "budget": {"max_cost_usd": RUN_MAX_COST_USD, "max_tokens": RUN_MAX_TOKENS, **(presupuesto or {})},
+        "cache_report": {"hits": 0, "misses": 0}, "ttft_report": {}, "local_steps": [], "stage_seconds": {},
+        "retry_report": {"retries": 0, "retry_tokens": 0, "throttled_seconds": 0.0},
+        "context_report": {"policy": CONTEXT_POLICY, "budget": CONTEXT_TOKEN_BUDGET, "steps": {}, "synthesis": None},
+        "plan_cache_report": {"status": None, "similarity": None, "reason": None, "stored": None},
+        "vote_report": {"samples": SELF_CONSISTENCY_SAMPLES, "steps": {}},
+        "error_message": None
+    }
+
+def resultados_desde_estado(estado: Dict[str, Any]) -> Dict[str, Any]:
+    """Diccionario de resultados público (formato histórico de proceso_razonamiento_llm_calculator)."""
+    return {
+        "run_id": estado["run_id"], "pregunta_original": estado["pregunta_original"], "plan": estado["plan"] or "N/A", "plan_revision": estado["plan_revision"] or "N/A",
+        "resultados_parciales": dict(estado["resultados_parciales"]), "respuesta_final": estado["respuesta_final"] or "N/A",
+        "token_report": dict(estado["token_report"]), "cache_report": dict(estado["cache_report"]), "ttft_report": dict(estado["ttft_report"]),
+        "stage_seconds": dict(estado["stage_seconds"]), "retry_report": dict(estado["retry_report"]), "local_steps": list(estado["local_steps"]),
+        "context_report": resumen_contexto(estado["context_report"]), "dag": dict(estado["dag"]), "spans": get_trazador().spans(estado["run_id"]),
+        "plan_cache_report": dict(estado["plan_cache_report"]), "budget": dict(estado["budget"]), "vote_report": {**estado["vote_report"], "steps": dict(estado["vote_report"]["steps"])},
+        "error_message": estado["error_message"]
+    }
+
+def _sumar_tokens(estado: Dict[str, Any], usage: object, final: bool = False) -> None:
+    """Suma el 'usage' de una llamada: entrada como 'prompt' (y su parte cacheada en 'cached'), salida como 'reasoning' (u 'output' si es la respuesta final)."""
+    tokens = estado["tokens"]; tokens["prompt"] += usage.prompt_tokens; tokens["output" if final else "reasoning"] += usage.completion_tokens
+    tokens["cached"] = tokens.get("cached", 0) + tokens_cacheados(usage)
+    modelo = getattr(usage, "modelo", None)
+    if modelo is not None:
+        uso = estado["model_usage"].setdefault(modelo, {"prompt": 0, "completion": 0})
+        uso["prompt"] += usage.prompt_tokens; uso["completion"] += usage.completion_tokens; uso["cached"] = uso.get("cached", 0) + tokens_cacheados(usage)
+    estado["token_report"] = calcular_token_report(tokens, estado["model_usage"])
+
+def _registrar_usage(estado: Dict[str, Any], usage: Optional[object]) -> None:
+    registrar_cache(estado["cache_report"], usage); registrar_reintentos(estado["retry_report"], usage)
+
+def _registrar_tiempo_etapa(estado: Dict[str, Any], etapa: str, inicio: float) -> None:
+    """Acumula el tiempo de pared de la etapa (una etapa puede repetirse al retomar una ejecución)."""
+    estado["stage_seconds"][etapa] = estado["stage_seconds"].get(etapa, 0.0) + (time.perf_counter() - inicio)
+
+def _marcar_error(estado: Dict[str, Any], mensaje: str) -> None:
+    print(f"!!! {mensaje}")
+    if estado["error_message"] is None: estado["error_message"] = mensaje
+    estado["failed_stage"] = estado["current_stage"]; estado["current_stage"] = "error"
+
+def contexto_estado(estado: Dict[str, Any]) -> ContextoRazonamiento:
+    """ContextoRazonamiento de la ejecución, con los pasos ya resueltos registrados y el reporte compartido."""
+    contexto = ContextoRazonamiento(estado["pregunta_original"], estado["plan"] or "", estado["steps"], estado["dag"],
+                                    politica=estado["context_report"]["policy"], presupuesto_tokens=estado["context_report"]["budget"])
+    contexto.registrar_todos(estado["step_results"])
+    contexto.reporte = estado["context_report"]
+    return contexto
+
+def aplicar_descomposicion(estado: Dict[str, Any], plan_str: Optional[str], usage: Optional[object]) -> None:
+    _registrar_usage(estado, usage)
+    if usage is None or not plan_str or ("Error" in plan_str): _marcar_error(estado, f"Fallo Descomp: {plan_str}"); return
+    estado["plan"] = plan_str; print(f"\nPlan:\n{plan_str}")
+    _sumar_tokens(estado, usage)
+    estado["current_stage"] = "verifying"
+
+def aplicar_verificacion(estado: Dict[str, Any], revision_plan: Optional[str], usage: Optional[object]) -> None:
+    """La revisión es consultiva para un plan nuevo: un rechazo o un fallo de la API no detiene la
+    ejecución (el plan queda marcado 'Sin verificar'). Un plan reutilizado de la caché sólo se usa con
+    un veredicto de aprobación explícito; si no, se descarta y se vuelve a descomponer. Un presupuesto
+    agotado detiene la ejecución aquí, para que al reanudarla se verifique el plan.
+    Aquí se parsea el plan en pasos + DAG."""
+    _registrar_usage(estado, usage)
+    if usage is None and (revision_plan or "").startswith("Error Presupuesto"): _marcar_error(estado, f"Fallo Verificación: {revision_plan}"); return
+    if usage: _sumar_tokens(estado, usage); estado["plan_revision"] = revision_plan; print(f"Revisión: {revision_plan}")
+    reporte = estado["plan_cache_report"]; cache = get_plan_cache()
+    veredicto = veredicto_revision(revision_plan) if usage else None
+    if veredicto is False: print("Adv: Plan podría ser incorrecto.")
+    if reporte["status"] == "reverify" and veredicto is not True:
+        reporte["status"] = "rejected"
+        reporte["reason"] = "el revisor rechazó el plan reutilizado" if veredicto is False else "el plan reutilizado no obtuvo la aprobación del revisor"
+        print(f"Adv: {reporte['reason']}; se descompone desde cero.")
+        if cache is not None: cache.contar("fallbacks")
+        estado["plan"] = None; estado["plan_revision"] = None; estado["current_stage"] = "decomposing"; return
+    if veredicto and reporte["status"] in ("miss", "fallback", "rejected"): guardar_plan_cacheado(estado)
+    if usage is None: estado["plan_revision"] = f"Sin verificar ({revision_plan or 'sin respuesta del revisor'})."; print(f"Adv: plan sin verificar: {revision_plan}")
+    _preparar_pasos(estado)
+
+def _preparar_pasos(estado: Dict[str, Any]) -> None:
+    estado["steps"] = extraer_pasos_plan(estado["plan"] or "")
+    estado["dag"] = construir_dag_pasos(estado["steps"])
+    estado["current_stage"] = "solving" if estado["steps"] else "synthesizing"
+
+def aplicar_plan_cacheado(estado: Dict[str, Any]) -> bool:
+    """Etapa 'decomposing': intenta reutilizar el plan verificado de una pregunta con la misma estructura.
+
+    Con coincidencia exacta de plantilla se omiten la descomposición y la verificación; con una
+    plantilla parecida sólo la descomposición, y el plan pasa por el revisor. Si algún número del
+    plan tiene varios orígenes que ahora dan valores distintos, se descompone desde cero.
+    Devuelve True si se usó un plan de la caché.
+    """
+    reporte = estado["plan_cache_report"]; cache = get_plan_cache()
+    if reporte["status"] is not None: return False # Ya se consultó (p. ej. plan reutilizado y rechazado)
+    if cache is None: reporte["status"] = "disabled"; return False
+    plantilla_pregunta, numeros = normalizar_pregunta(estado["pregunta_original"])
+    entrada, similitud = cache.buscar(plantilla_pregunta); reporte["similarity"] = round(similitud, 4)
+    if entrada is None or similitud < PLAN_CACHE_MIN_SIMILARITY: reporte["status"] = "miss"; cache.contar("misses"); return False
+    if entrada["n_numbers"] != len(numeros):
+        reporte["status"] = "fallback"; reporte["reason"] = f"la pregunta tiene {len(numeros)} números y la plantilla {entrada['n_numbers']}"
+        print(f"Adv: caché de planes descartada ({reporte['reason']})."); cache.contar("fallbacks"); return False
+    plan, ambiguo = vincular_plan(entrada["plan_template"], entrada["bindings"], numeros)
+    if ambiguo:
+        reporte["status"] = "fallback"; reporte["reason"] = "números del plan con más de un origen posible que ahora difieren"
+        print(f"Adv: caché de planes descartada ({reporte['reason']})."); cache.contar("fallbacks"); return False
+    exacto = similitud >= 1.0
+    reporte["status"] = "hit" if exacto else "reverify"
+    reporte["reason"] = None if exacto else "plantilla parecida, no idéntica"
+    cache.contar("hits" if exacto else "reverify")
+    estado["plan"] = plan; print(f"\nPlan (reutilizado de la caché, similitud {similitud:.2f}):\n{plan}")
+    if not exacto: estado["current_stage"] = "verifying"; return True
+    estado["plan_revision"] = "Plan OK (reutilizado de una pregunta verificada con la misma estructura; verificación omitida)."
+    _preparar_pasos(estado)
+    return True
+
+def guardar_plan_cacheado(estado: Dict[str, Any]) -> None:
+    """Guarda como plantilla un plan generado y aprobado por el revisor (si sus números se pueden vincular)."""
+    cache = get_plan_cache(); reporte = estado["plan_cache_report"]
+    if cache is None or not estado["plan"]: return
+    plantilla_pregunta, numeros = normalizar_pregunta(estado["pregunta_original"])
+    plantilla, vinculos, motivo = plantilla_plan(estado["plan"], numeros)
+    reporte["stored"] = plantilla is not None
+    if plantilla is None: reporte["reason"] = f"plan no reutilizable: {motivo}"; print(f"Adv: {reporte['reason']}."); return
+    cache.guardar(plantilla_pregunta, len(numeros), plantilla, vinculos)
+
+def _ordenar_resultados(estado: Dict[str, Any]) -> None:
+    """Orden del plan, independiente del orden de finalización (o de reanudación)."""
+    claves = [f"Paso {i+1}: {paso}" for i, paso in enumerate(estado["steps"])]
+    estado["resultados_parciales"] = {k: estado["resultados_parciales"][k] for k in claves if k in estado["resultados_parciales"]}
+
+def aplicar_paso(estado: Dict[str, Any], indice: int, respuesta: str, usage: object) -> None:
+    """Incorpora un paso resuelto; es idempotente (un paso ya registrado no se vuelve a contabilizar)."""
+    if indice in estado["step_results"]: return
+    estado["step_results"][indice] = respuesta
+    estado["resultados_parciales"][f"Paso {indice+1}: {estado['steps'][indice]}"] = respuesta
+    _sumar_tokens(estado, usage); _registrar_usage(estado, usage)
+    if es_paso_local(usage): estado["local_steps"].append(f"Paso {indice+1}")
+    if getattr(usage, "votacion", None): estado["vote_report"]["steps"][f"Paso {indice+1}"] = usage.votacion
+    _ordenar_resultados(estado)
+
+def aplicar_pasos(estado: Dict[str, Any], respuestas: Dict[int, str], usages: Dict[int, object], fallido: Optional[int],
+                  ttft: Optional[Dict[int, Optional[float]]] = None) -> None:
+    for i in sorted(ttft or {}): estado["ttft_report"][f"Paso {i+1}"] = ttft[i]
+    fallidos = {i for i in respuestas if paso_fallido(respuestas[i], usages.get(i))}
+    for i in sorted(usages):
+        if i in fallidos: _sumar_tokens(estado, usages[i]); _registrar_usage(estado, usages[i]) # Pagado aunque el paso falló
+        else: aplicar_paso(estado, i, respuestas[i], usages[i])
+    for i in fallidos: estado["resultados_parciales"][f"Paso {i+1}: {estado['steps'][i]}"] = respuestas[i] # Se muestran, pero no cuentan como resueltos
+    _ordenar_resultados(estado)
+    if fallido is not None:
+        estado["respuesta_final"] = "No se pudo generar la respuesta final por errores previos."
+        _marcar_error(estado, f"Fallo Crítico Paso {fallido+1}: {respuestas.get(fallido)}")
+    else: estado["current_stage"] = "synthesizing"
+
+def aplicar_sintesis(estado: Dict[str, Any], respuesta_final: Optional[str], usage: Optional[object], ttft: Optional[float] = None) -> None:
+    _registrar_usage(estado, usage)
+    if ttft is not None: estado["ttft_report"]["Síntesis"] = ttft
+    if usage is None or not respuesta_final or ("Error" in respuesta_final):
+        synthesis_error = f"Fallo en Síntesis: {respuesta_final}"
+        estado["respuesta_final"] = synthesis_error; _marcar_error(estado, synthesis_error); return
+    estado["respuesta_final"] = respuesta_final
+    _sumar_tokens(estado, usage, final=True)
+    estado["current_stage"] = "done"
+
+def _checkpoint_paso(estado: Dict[str, Any], indice: int, respuesta: str, usage: object, on_paso: Optional[Callable[[int], None]] = None) -> None:
+    aplicar_paso(estado, indice, respuesta, usage); checkpoint_estado(estado, "step", f"Paso {indice+1}")
+    if on_paso: on_paso(indice)
+
+def avanzar_etapa(client: OpenAI, model_name: str, estado: Dict[str, Any],
+                  on_delta: Optional[Callable[[str, str], None]] = None, on_paso: Optional[Callable[[int], None]] = None) -> Dict[str, Any]:
+    """Ejecuta la etapa actual del estado y lo deja en la siguiente (o en 'error').
+
+    La etapa 'solving' resuelve todo el DAG de pasos (en paralelo donde se pueda). Con
+    'on_delta(etiqueta, fragmento)' la solución de pasos y la síntesis se hacen en streaming.
+    'on_paso(indice)' se invoca (en este hilo) apenas un paso queda aplicado al estado.
+    """
+    etapa = estado["current_stage"]; pregunta = estado["pregunta_original"]; inicio = time.perf_counter()
+    with get_trazador().span(etapa, "stage", run_id=estado["run_id"], stage=etapa) as span, presupuesto_activo(estado):
+        if etapa == "decomposing":
+            if not aplicar_plan_cacheado(estado): aplicar_descomposicion(estado, *agente_descompositor(client, model_name, pregunta))
+            span["plan_cache"] = estado["plan_cache_report"]["status"]
+        elif etapa == "verifying":
+            aplicar_verificacion(estado, *agente_verificador_plan(client, modelo_para_llamada(model_name, etapa), pregunta, estado["plan"]))
+        elif etapa == "solving":
+            contexto = contexto_estado(estado); ttft: Dict[int, Optional[float]] = {}
+            on_delta_paso = (lambda i, delta: on_delta(f"Paso {i+1}", delta)) if on_delta else None
+            respuestas, usages, fallido = ejecutar_pasos_dag(client, model_name, contexto, on_delta=on_delta_paso, ttft=ttft, variables=estado["variables"],
+                                                             on_resultado=lambda i, respuesta, usage: _checkpoint_paso(estado, i, respuesta, usage, on_paso))
+            aplicar_pasos(estado, respuestas, usages, fallido, ttft)
+        elif etapa == "synthesizing":
+            print("\n--- Sintetizando Respuesta Final ---")
+            contexto = contexto_estado(estado); metricas: Dict[str, Any] = {}
+            respuesta_final, usage = agente_sintetizador(client, model_name, pregunta, estado["plan"] or "", contexto.para_sintesis(estado["resultados_parciales"]),
+                                                         on_delta=(lambda delta: on_delta("Síntesis", delta)) if on_delta else None, metricas=metricas)
+            aplicar_sintesis(estado, respuesta_final, usage, metricas.get("ttft") if on_delta else None)
+        if estado["current_stage"] == "error": span["error"] = estado["error_message"]
+    _registrar_tiempo_etapa(estado, etapa, inicio)
+    checkpoint_estado(estado, "stage", f"{etapa} -> {estado['current_stage']}")
+    return estado
+
+
+ERROR_RUN_ID_DESCONOCIDO = "run_id desconocido"
+
+def _estado_inicial_o_reanudado(pregunta_usuario: str, run_id: Optional[str], presupuesto: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Estado reanudado de 'run_id' o uno nuevo; None si 'run_id' no tiene checkpoint y no hay pregunta con qué empezar."""
+    estado = reanudar_estado(run_id) if run_id else None
+    if run_id and estado is None:
+        if not pregunta_usuario.strip(): print(f"!!! No hay checkpoint de la ejecución {run_id} ni pregunta para iniciarla."); return None
+        print(f"Adv: no hay checkpoint de la ejecución {run_id}; se inicia desde cero con ese id.")
+    if estado is not None and presupuesto: estado["budget"].update(presupuesto) # Al reanudar se puede ampliar el presupuesto
+    return estado or nuevo_estado_razonamiento(pregunta_usuario, run_id, presupuesto)
+
+
+# --- FUNCIÓN DE ORQUESTACIÓN (MODIFICADA PARA CALCULAR COSTO) ---
+def proceso_razonamiento_llm_calculator(client: OpenAI, model_name: str, pregunta_usuario: str,
+                                        on_delta: Optional[Callable[[str, str], None]] = None, run_id: Optional[str] = None,
+                                        presupuesto: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Orquesta flujo LLM y calcula costo.
+
+    Si se pasa 'on_delta(etiqueta, fragmento)', la solución de pasos ("Paso N") y la síntesis
+    ("Síntesis") se ejecutan en streaming y el TTFT de cada una queda en results["ttft_report"].
+    Con 'run_id' de una ejecución guardada, se retoma desde su último paso bueno (la pregunta
+    guardada prevalece sobre 'pregunta_usuario'); si no hay checkpoint y la pregunta está vacía,
+    devuelve {"error_message": ERROR_RUN_ID_DESCONOCIDO} sin llamar al LLM. 'presupuesto' ({"max_cost_usd", "max_tokens"})
+    limita la ejecución: una llamada que lo superaría no se hace y la ejecución termina en 'error'.
+    """
+    print("\n--- Iniciando proceso LLM Calculator ---")
+    if not client: return {"error_message": "Error Crítico: Cliente LLM no disponible."}
+    estado = _estado_inicial_o_reanudado(pregunta_usuario, run_id, presupuesto)
+    if estado is None: return {"error_message": ERROR_RUN_ID_DESCONOCIDO, "run_id": run_id}
+    with get_trazador().span("run", "run", run_id=estado["run_id"], model=model_name):
+        while estado["current_stage"] not in ETAPAS_FINALES: avanzar_etapa(client, model_name, estado, on_delta)
+    print("\n--- Proceso Completado ---")
+    return resultados_desde_estado(estado)
+
+
+# --- Ejecuciones en Segundo Plano (pool acotado + registro consultable desde otros hilos) ---
+class RegistroEjecuciones:
+    """Corre ejecuciones completas en un pool de hilos acotado y publica su progreso.
+
+    Cada ejecución pasa por 'queued' -> 'running' -> 'done' / 'error'. El hilo que la corre es el
+    único que toca su estado; tras cada paso y cada etapa publica (bajo el lock) una copia, y
+    mientras tanto acumula el texto en streaming de los pasos en curso ("live"). Quien consulta (p. ej. la UI
+    de varias sesiones, refrescando cada tanto) sólo lee esas copias con 'foto'.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, conservar: Optional[int] = None):
+        self.max_workers = max_workers or BACKGROUND_MAX_RUNS; self.conservar = conservar or BACKGROUND_KEEP_FINISHED
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ejecucion")
+        self._lock = threading.Lock(); self._runs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def encolar(self, client: OpenAI, model_name: str, estado: Dict[str, Any]) -> str:
+        """Encola la ejecución de 'estado' (nuevo o preparado para reanudar) y devuelve su run_id.
+
+        Si esa ejecución ya está en cola o en curso no se encola de nuevo.
+        """
+        run_id = estado["run_id"]
+        with self._lock:
+            previa = self._runs.get(run_id)
+            if previa is not None and previa["status"] in ("queued", "running"): return run_id
+            self._runs[run_id] = {"run_id": run_id, "question": estado["pregunta_original"], "status": "queued", "state": copy.deepcopy(estado),
+                                  "live": {}, "queued_at": time.time(), "started_at": None, "finished_at": None}
+            self._runs.move_to_end(run_id); self._podar()
+        self._pool.submit(self._ejecutar, client, model_name, estado)
+        return run_id
+
+    def _ejecutar(self, client: OpenAI, model_name: str, estado: Dict[str, Any]) -> None:
+        run_id = estado["run_id"]
+        def _on_delta(etiqueta: str, delta: str) -> None:
+            with self._lock: live = self._runs[run_id]["live"]; live[etiqueta] = live.get(etiqueta, "") + delta
+        try:
+            with self._lock: self._runs[run_id].update(status="running", started_at=time.time())
+            with get_trazador().span("run", "run", run_id=run_id, model=model_name):
+                while estado["current_stage"] not in ETAPAS_FINALES:
+                    avanzar_etapa(client, model_name, estado, _on_delta, on_paso=lambda i: self._publicar(estado, f"Paso {i+1}")); self._publicar(estado)
+        except Exception as e:
+            traceback.print_exc(); _marcar_error(estado, f"Error en etapa '{estado['current_stage']}': {e}")
+        finally: self._finalizar(estado)
+
+    def _finalizar(self, estado: Dict[str, Any]) -> None:
+        """Publica el estado final y fija el status terminal, aunque la copia falle o la ejecución se haya cortado."""
+        try:
+            if estado["current_stage"] not in ETAPAS_FINALES: _marcar_error(estado, f"Ejecución interrumpida en etapa '{estado['current_stage']}'.") # Queda reanudable
+            self._publicar(estado)
+        finally:
+            with self._lock:
+                entrada = self._runs[estado["run_id"]]; entrada["live"] = {}
+                entrada.update(status=estado["current_stage"] if estado["current_stage"] in ETAPAS_FINALES else "error", finished_at=time.time())
+
+    def _publicar(self, estado: Dict[str, Any], paso: Optional[str] = None) -> None:
+        """Publica una copia del estado: tras un paso (descarta su texto en streaming) o tras una etapa (descarta todo)."""
+        foto = copy.deepcopy(estado)
+        with self._lock:
+            entrada = self._runs[estado["run_id"]]; entrada["state"] = foto
+            if paso is not None: entrada["live"].pop(paso, None)
+            else: entrada["live"] = {}
+
+    def _podar(self) -> None:
+        terminadas = [r for r, e in self._runs.items() if e["status"] in ETAPAS_FINALES]
+        for run_id in terminadas[:max(0, len(terminadas) - self.conservar)]: del self._runs[run_id]
+
+    def foto(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """Copia del progreso de 'run_id': status, estado de la última etapa terminada y texto en streaming (None si no está)."""
+        with self._lock:
+            entrada = self._runs.get(run_id)
+            return copy.deepcopy(entrada) if entrada is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock: estados = [e["status"] for e in self._runs.values()]
+        return {"queued": estados.count("queued"), "running": estados.count("running"), "max_workers": self.max_workers}
+
+_REGISTRO_EJECUCIONES: Optional[RegistroEjecuciones] = None
+_REGISTRO_EJECUCIONES_LOCK = threading.Lock()
+
+def get_registro_ejecuciones() -> RegistroEjecuciones:
+    """Devuelve el registro de ejecuciones en segundo plano del proceso (compartido por todas las sesiones)."""
+    global _REGISTRO_EJECUCIONES
+    with _REGISTRO_EJECUCIONES_LOCK:
+        if _REGISTRO_EJECUCIONES is None: _REGISTRO_EJECUCIONES = RegistroEjecuciones()
+        return _REGISTRO_EJECUCIONES
+
+
+# --- 3. Ruta Asíncrona (AsyncOpenAI) y Orquestador Batch Multi-Pregunta ---
+# Semáforo global del batch: limita las llamadas LLM en vuelo sumando TODOS los pipelines.
+_LLM_SEMAPHORE: contextvars.ContextVar[Optional[asyncio.Semaphore]] = contextvars.ContextVar("_LLM_SEMAPHORE", default=None)
+
+def _con_semaforo(llamada: Callable[[float], Any], span: Dict[str, Any]) -> Callable[[float], Any]:
+    """Envuelve 'llamada(timeout)' para que sólo la petición ocupe un lugar del semáforo del batch:
+    las esperas del planificador (turnos, backoff, retry-after) no retienen el semáforo."""
+    semaforo = _LLM_SEMAPHORE.get()
+    if semaforo is None: return llamada
+    async def llamada_con_semaforo(timeout: float) -> Any:
+        en_cola = time.perf_counter()
+        async with semaforo:
+            span["queue_wait_s"] = (span.get("queue_wait_s") or 0.0) + time.perf_counter() - en_cola # Espera por el semáforo del batch
+            return await llamada(timeout)
+    return llamada_con_semaforo
+
+def init_openai_async_client() -> AsyncOpenAI:
+    """Inicializa y devuelve el cliente AsyncOpenAI (sin dependencia de Streamlit)."""
+    from openai import AsyncOpenAI
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key: raise ValueError("Variable de entorno OPENAI_API_KEY no encontrada.")
+    return AsyncOpenAI(api_key=api_key)
+
+async def call_llm_with_usage_async(client: AsyncOpenAI, model_name: str, messages: List[Dict], purpose: str = "", temperature: float = 0.1, use_cache: bool = True) -> Tuple[Optional[str], Optional[object]]:
+    """Versión asíncrona de call_llm_with_usage; respeta el semáforo global del batch si existe."""
+    with get_trazador().span(purpose, "llm", model=model_name) as span:
+        content, usage = await _call_llm_with_usage_async(client, model_name, messages, purpose, temperature, use_cache, span)
+        usage = usage_con_modelo(usage, model_name); anotar_llamada_llm(span, content, usage)
+    return content, usage
+
+async def _call_llm_with_usage_async(client: AsyncOpenAI, model_name: str, messages: List[Dict], purpose: str, temperature: float, use_cache: bool,
+                                     span: Dict[str, Any]) -> Tuple[Optional[str], Optional[object]]:
+    print(f"\n--- LLM Call Async ({purpose} | Temp: {temperature}) ---")
+    if not client: return "Error: Cliente LLM no proporcionado.", None
+    reserva = None
+    try:
+        key = None
+        if use_cache:
+            key, content, usage = _leer_cache(model_name, messages, temperature, purpose)
+            if usage is not None: return content, usage
+        reserva = _reservar_presupuesto(model_name, messages)
+        llamada = lambda timeout: client.chat.completions.create(model=model_name, messages=messages, temperature=temperature, timeout=timeout)
+        response, info = await get_planificador_llm().ejecutar_async(_con_semaforo(llamada, span), tokens_estimados_llamada(messages))
+        content = response.choices[0].message.content
+        usage = usage_con_reintentos(response.usage, info)
+        print(f"Token Usage ({purpose}): Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}")
+        _escribir_cache(key, model_name, content, response.usage); _liquidar_presupuesto(reserva, model_name, usage)
+        return content, usage
+    except Exception as e: _liquidar_presupuesto(reserva, model_name, None); return mensaje_error_llm(e), None
+
+async def agente_descompositor_async(client: AsyncOpenAI, model_name: str, pregunta_compleja: str) -> Tuple[Optional[str], Optional[object]]:
+    return await call_llm_with_usage_async(client, model_name, mensajes_descompositor(pregunta_compleja), purpose="Descomposición Ultra-Detallada", temperature=0.3)
+
+async def agente_verificador_plan_async(client: AsyncOpenAI, model_name: str, pregunta_original: str, plan_propuesto: str) -> Tuple[Optional[str], Optional[object]]:
+    return await call_llm_with_usage_async(client, model_name, mensajes_verificador_plan(pregunta_original, plan_propuesto), purpose="Verificación Plan", temperature=0.1)
+
+async def agente_solucionador_async(client: AsyncOpenAI, model_name: str, paso_actual: str, contexto_completo: str,
+                                    etiqueta: str = "Paso", pregunta_original: str = "", plan: str = "") -> Tuple[Optional[str], Optional[object]]:
+    if SELF_CONSISTENCY_SAMPLES > 1:
+        return await agente_solucionador_votacion_async(client, model_name, paso_actual, contexto_completo, etiqueta, pregunta_original=pregunta_original, plan=plan)
+    return await call_llm_with_usage_async(client, model_name, mensajes_solucionador(paso_actual, contexto_completo, pregunta_original, plan),
+                                           purpose=f"Solución {etiqueta}", temperature=0.05)
+
+async def agente_sintetizador_async(client: AsyncOpenAI, model_name: str, pregunta_original: str, plan: str, resultados_parciales: dict) -> Tuple[Optional[str], Optional[object]]:
+    return await call_llm_with_usage_async(client, model_name, mensajes_sintetizador(pregunta_original, plan, resultados_parciales), purpose="Auditoría y Síntesis Final", temperature=0.05)
+
+async def agente_solucionador_votacion_async(client: AsyncOpenAI, model_name: str, paso_actual: str, contexto_completo: str, etiqueta: str = "Paso",
+                                             muestras: Optional[int] = None, quorum: Optional[int] = None,
+                                             pregunta_original: str = "", plan: str = "") -> Tuple[Optional[str], Optional[object]]:
+    """Equivalente asíncrono de agente_solucionador_votacion (mismas rondas y reporte)."""
+    muestras = muestras or SELF_CONSISTENCY_SAMPLES; quorum = quorum or muestras // 2 + 1
+    messages = mensajes_solucionador(paso_actual, contexto_completo, pregunta_original, plan); inicio = time.perf_counter()
+    respuestas: List[str] = []; valores: List[Optional[float]] = []; usages: List[object] = []
+    while True:
+        pedir = muestras_pendientes(valores, muestras, quorum)
+        if pedir == 0: break
+        contenidos, usage = await call_llm_muestras_async(client, model_name, messages, purpose=f"Votación {etiqueta}", n=pedir)
+        if usage is None:
+            if not respuestas: return contenidos[0], None
+            break
+        usages.append(usage); respuestas += contenidos; valores += [valor_resultado(c) for c in contenidos]
+        if not contenidos: break
+    return _resultado_votacion(respuestas, usages, model_name, muestras, quorum, etiqueta, inicio)
+
+async def call_llm_muestras_async(client: AsyncOpenAI, model_name: str, messages: List[Dict], purpose: str = "",
+                                  temperature: float = SELF_CONSISTENCY_TEMPERATURE, n: int = 1) -> Tuple[List[str], Optional[object]]:
+    """Versión asíncrona de call_llm_muestras; respeta el semáforo global del batch si existe."""
+    with get_trazador().span(purpose, "llm", model=model_name, samples=n) as span:
+        print(f"\n--- LLM Call Async ({purpose} | Temp: {temperature} | n={n}) ---")
+        reserva = None; contenidos: List[str] = []; usage = None
+        try:
+            reserva = _reservar_presupuesto(model_name, messages, completions=n)
+            llamada = lambda timeout: client.chat.completions.create(model=model_name, messages=messages, temperature=temperature, n=n, timeout=timeout)
+            response, info = await get_planificador_llm().ejecutar_async(_con_semaforo(llamada, span), tokens_estimados_llamada(messages, completions=n), completions=n)
+            contenidos = [c.message.content for c in response.choices if c.message.content]
+            usage = usage_con_modelo(usage_con_reintentos(response.usage, info), model_name)
+            print(f"Token Usage ({purpose}): Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}, Muestras={len(contenidos)}")
+        except Exception as e: contenidos = [mensaje_error_llm(e)]
+        _liquidar_presupuesto(reserva, model_name, usage)
+        anotar_llamada_llm(span, contenidos[0] if contenidos else None, usage)
+    return contenidos, usage
+
+async def ejecutar_pasos_dag_async(client: AsyncOpenAI, model_name: str, contexto: ContextoRazonamiento,
+                                   max_workers: int = MAX_PARALLEL_STEPS, variables: Optional[Dict[str, float]] = None,
+                                   on_resultado: Optional[Callable[[int, str, object], None]] = None) -> Tuple[Dict[int, str], Dict[int, object], Optional[int]]:
+    """Equivalente asíncrono de ejecutar_pasos_dag (mismo contrato de retorno)."""
+    pasos, dag = contexto.pasos, contexto.dag
+    async def _resolver(i: int, contexto_texto: str, enviado: float) -> Tuple[Optional[str], Optional[object]]:
+        with get_trazador().span(f"Paso {i+1}", "step", queue_wait_s=time.perf_counter() - enviado) as span:
+            salida = await agente_solucionador_async(client, modelo_para_llamada(model_name, "solving", pasos[i]), pasos[i], contexto_texto, etiqueta=f"Paso {i+1}",
+                                                     pregunta_original=contexto.pregunta, plan=contexto.plan_prefijo)
+            if paso_fallido(*salida): span["error"] = (salida[0] or "sin respuesta")[:200]
+            return salida
+    respuestas: Dict[int, str] = {}; usages: Dict[int, object] = {}; fallido: Optional[int] = None
+    completados: Set[int] = set(contexto.transcripciones); en_curso: Dict[asyncio.Task, int] = {}
+    variables = {} if variables is None else variables
+    while True:
+        if fallido is None:
+            for i in resolver_pasos_locales(pasos, dag, completados, set(en_curso.values()), respuestas, usages, variables):
+                contexto.registrar(i, respuestas[i])
+                if on_resultado: on_resultado(i, respuestas[i], usages[i])
+            for i in range(len(pasos)):
+                if len(en_curso) >= max(1, max_workers): break
+                if i in completados or i in en_curso.values(): continue
+                if all(dep in completados for dep in dag.get(i, [])):
+                    print(f"\n--- Ejecutando Paso {i+1}: {pasos[i][:80]}... ---")
+                    en_curso[asyncio.ensure_future(_resolver(i, contexto.para_paso(i), time.perf_counter()))] = i
+        if not en_curso: break
+        terminados, _ = await asyncio.wait(list(en_curso), return_when=asyncio.FIRST_COMPLETED)
+        for tarea in terminados:
+            i = en_curso.pop(tarea)
+            try: respuesta, usage = tarea.result()
+            except Exception as e: respuesta, usage = f"Error inesperado: {e}", None
+            respuestas[i] = respuesta
+            if paso_fallido(respuesta, usage):
+                print(f"!!! Error Crítico Paso {i+1}: {respuesta}")
+                if fallido is None or i < fallido: fallido = i
+                if usage is not None: usages[i] = usage # Fallo ya pagado: se contabiliza, pero el paso no queda resuelto
+            else:
+                usages[i] = usage; completados.add(i); contexto.registrar(i, respuesta); registrar_variable_respuesta(pasos[i], respuesta, variables)
+                if on_resultado: on_resultado(i, respuesta, usage)
+    return respuestas, usages, fallido
+
+async def avanzar_etapa_async(client: AsyncOpenAI, model_name: str, estado: Dict[str, Any]) -> Dict[str, Any]:
+    """Equivalente asíncrono de avanzar_etapa (mismas transiciones y contabilidad)."""
+    etapa = estado["current_stage"]; pregunta = estado["pregunta_original"]; inicio = time.perf_counter()
+    with get_trazador().span(etapa, "stage", run_id=estado["run_id"], stage=etapa) as span, presupuesto_activo(estado):
+        if etapa == "decomposing":
+            if not aplicar_plan_cacheado(estado): aplicar_descomposicion(estado, *await agente_descompositor_async(client, model_name, pregunta))
+            span["plan_cache"] = estado["plan_cache_report"]["status"]
+        elif etapa == "verifying":
+            aplicar_verificacion(estado, *await agente_verificador_plan_async(client, modelo_para_llamada(model_name, etapa), pregunta, estado["plan"]))
+        elif etapa == "solving":
+            respuestas, usages, fallido = await ejecutar_pasos_dag_async(client, model_name, contexto_estado(estado), variables=estado["variables"],
+                                                                         on_resultado=lambda i, respuesta, usage: _checkpoint_paso(estado, i, respuesta, usage))
+            aplicar_pasos(estado, respuestas, usages, fallido)
+        elif etapa == "synthesizing":
+            contexto = contexto_estado(estado)
+            aplicar_sintesis(estado, *await agente_sintetizador_async(client, model_name, pregunta, estado["plan"] or "", contexto.para_sintesis(estado["resultados_parciales"])))
+        if estado["current_stage"] == "error": span["error"] = estado["error_message"]
+    _registrar_tiempo_etapa(estado, etapa, inicio)
+    checkpoint_estado(estado, "stage", f"{etapa} -> {estado['current_stage']}")
+    return estado
+
+async def proceso_razonamiento_llm_calculator_async(client: AsyncOpenAI, model_name: str, pregunta_usuario: str,
+                                                    run_id: Optional[str] = None, presupuesto: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Versión asíncrona de proceso_razonamiento_llm_calculator (mismas etapas, 'token_report' y reanudación)."""
+    print("\n--- Iniciando proceso LLM Calculator (async) ---")
+    if not client: return {"error_message": "Error Crítico: Cliente LLM no disponible."}
+    estado = _estado_inicial_o_reanudado(pregunta_usuario, run_id, presupuesto)
+    if estado is None: return {"error_message": ERROR_RUN_ID_DESCONOCIDO, "run_id": run_id}
+    with get_trazador().span("run", "run", run_id=estado["run_id"], model=model_name):
+        while estado["current_stage"] not in ETAPAS_FINALES: await avanzar_etapa_async(client, model_name, estado)
+    print("\n--- Proceso Completado (async) ---")
+    return resultados_desde_estado(estado)
+
+async def proceso_razonamiento_batch_async(questions: List[str], max_concurrency: int = MAX_BATCH_CONCURRENCY,
+                                           client: Optional[AsyncOpenAI] = None, model_name: str = MODEL_NAME,
+                                           presupuesto: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Ejecuta muchos pipelines completos a la vez bajo un semáforo global de llamadas LLM ('presupuesto' es por pregunta)."""
+    client = client or init_openai_async_client()
+    token = _LLM_SEMAPHORE.set(asyncio.Semaphore(max(1, max_concurrency)))
+    try:
+        salidas = await asyncio.gather(*(proceso_razonamiento_llm_calculator_async(client, model_name, q, presupuesto=presupuesto) for q in questions), return_exceptions=True)
+    finally: _LLM_SEMAPHORE.reset(token)
+    results = []
+    for pregunta, salida in zip(questions, salidas):
+        if isinstance(salida, BaseException):
+            fallo = nuevo_estado_razonamiento(pregunta, presupuesto=presupuesto); fallo["error_message"] = f"Error inesperado: {salida}"; results.append(resultados_desde_estado(fallo))
+        else: results.append(salida)
+    return results
+
+def proceso_razonamiento_batch(questions: List[str], max_concurrency: int = MAX_BATCH_CONCURRENCY,
+                               client: Optional[AsyncOpenAI] = None, model_name: str = MODEL_NAME,
+                               presupuesto: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Punto de entrada síncrono del batch: devuelve los resultados en el mismo orden que 'questions'."""
+    print(f"\n--- Iniciando batch de {len(questions)} preguntas (max_concurrency={max_concurrency}) ---")
+    return asyncio.run(proceso_razonamiento_batch_async(questions, max_concurrency=max_concurrency, client=client, model_name=model_name, presupuesto=presupuesto))
+
+
@@ -0,0 +1,6 @@
+# conftest.py: los tests importan los módulos de la raíz del repositorio (reasoning_core, benchmark).
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("RUN_STORE_ENABLED", "0"); os.environ.setdefault("LLM_CACHE_ENABLED", "0"); os.environ.setdefault("PLAN_CACHE_ENABLED", "0")
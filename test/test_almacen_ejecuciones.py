@@ -0,0 +1,87 @@
+# Tests del almacén de checkpoints (AlmacenEjecuciones): reanudación, retención y run_id desconocido.
+import asyncio
+import http.client
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_cli
+import reasoning_core
+from reasoning_core import (AlmacenEjecuciones, ERROR_RUN_ID_DESCONOCIDO, nuevo_estado_razonamiento, proceso_razonamiento_llm_calculator,
+                            proceso_razonamiento_llm_calculator_async)
+
+
+def guardar(almacen, pregunta, etapa="solving"):
+    estado = nuevo_estado_razonamiento(pregunta); estado["current_stage"] = etapa
+    estado["steps"] = ["Calcular A"]; estado["step_results"] = {0: "Resultado: 1"}; estado["dag"] = {0: []}
+    almacen.guardar(estado, "stage", etapa)
+    return estado["run_id"]
+
+
+def test_guardar_y_cargar(tmp_path):
+    almacen = AlmacenEjecuciones(str(tmp_path / "runs.sqlite3"))
+    run_id = guardar(almacen, "¿Cuánto es A?")
+    estado = almacen.cargar(run_id)
+    assert estado["step_results"] == {0: "Resultado: 1"} and estado["dag"] == {0: []} # Claves enteras restauradas
+    assert [r["run_id"] for r in almacen.listar()] == [run_id] and len(almacen.eventos(run_id)) == 1
+
+
+def test_retencion_por_cantidad_al_terminar(tmp_path):
+    almacen = AlmacenEjecuciones(str(tmp_path / "runs.sqlite3"), max_ejecuciones=3)
+    run_ids = [guardar(almacen, f"Pregunta {i}") for i in range(5)] # En curso: no se poda
+    assert len(almacen.listar(incluir_terminadas=True)) == 5
+    ultima = guardar(almacen, "Pregunta final", etapa="done")
+    restantes = [r["run_id"] for r in almacen.listar(incluir_terminadas=True)]
+    assert restantes == [ultima, run_ids[4], run_ids[3]]
+    assert almacen.eventos(run_ids[0]) == [] and almacen.cargar(run_ids[0]) is None # La bitácora también se borra
+
+
+def test_retencion_por_antiguedad_al_abrir(tmp_path):
+    path = str(tmp_path / "runs.sqlite3")
+    almacen = AlmacenEjecuciones(path)
+    vieja, nueva = guardar(almacen, "Pregunta vieja"), guardar(almacen, "Pregunta nueva")
+    almacen._db.execute("UPDATE runs SET updated_at = ? WHERE run_id = ?", (time.time() - 10 * 86400, vieja)); almacen._db.commit()
+    reabierto = AlmacenEjecuciones(path, max_edad_dias=7)
+    assert [r["run_id"] for r in reabierto.listar()] == [nueva] and reabierto.eventos(vieja) == []
+
+
+class ClienteSinLlamadas:
+    """Falla el test si el pipeline llega a llamar al LLM."""
+    def __init__(self): self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+    def create(self, **kwargs): pytest.fail("no debería llamarse al LLM")
+
+
+@pytest.fixture
+def almacen_temporal(tmp_path, monkeypatch):
+    almacen = AlmacenEjecuciones(str(tmp_path / "runs.sqlite3"))
+    monkeypatch.setattr(reasoning_core, "RUN_STORE_ENABLED", True); monkeypatch.setattr(reasoning_core, "_ALMACEN_EJECUCIONES", almacen)
+    return almacen
+
+
+def test_reanudar_run_id_desconocido_no_llama_al_llm(almacen_temporal):
+    resultado = proceso_razonamiento_llm_calculator(ClienteSinLlamadas(), "gpt-4o", "", run_id="typo")
+    assert resultado == {"error_message": ERROR_RUN_ID_DESCONOCIDO, "run_id": "typo"}
+    resultado = asyncio.run(proceso_razonamiento_llm_calculator_async(ClienteSinLlamadas(), "gpt-4o", "  ", run_id="typo"))
+    assert resultado["error_message"] == ERROR_RUN_ID_DESCONOCIDO and almacen_temporal.listar() == []
+
+
+def test_cli_resume_run_id_desconocido_sale_con_1(almacen_temporal, monkeypatch, capsys):
+    monkeypatch.setattr(reasoning_cli, "crear_cliente_openai", ClienteSinLlamadas)
+    assert reasoning_cli.main(["resume", "typo"]) == 1
+    assert "typo" in capsys.readouterr().err
+
+
+def test_servicio_run_id_desconocido_responde_404(almacen_temporal, monkeypatch):
+    monkeypatch.setattr(reasoning_cli.ServicioRazonamiento, "_client", ClienteSinLlamadas())
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), reasoning_cli.ServicioRazonamiento)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    try:
+        conexion = http.client.HTTPConnection("127.0.0.1", servidor.server_address[1], timeout=5)
+        conexion.request("POST", "/reason", body=json.dumps({"run_id": "typo"}), headers={"Content-Type": "application/json"})
+        respuesta = conexion.getresponse()
+        assert respuesta.status == 404 and json.loads(respuesta.read())["error_message"] == ERROR_RUN_ID_DESCONOCIDO
+    finally: servidor.shutdown(); servidor.server_close()
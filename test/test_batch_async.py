@@ -0,0 +1,78 @@
+# Tests de la ruta asíncrona batch (proceso_razonamiento_batch) con un cliente AsyncOpenAI simulado.
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import PlanificadorLLM, proceso_razonamiento_batch
+
+PLAN = "1. Calcular el costo de las manzanas del pedido. [depende de: ninguno]\n2. Calcular el costo de las peras del pedido. [depende de: ninguno]"
+
+
+def respuesta(contenido, prompt=50, completion=10):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=contenido))],
+                           usage=SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, prompt_tokens_details=None))
+
+
+class ClienteAsyncFalso:
+    """Responde según el rol (por el último mensaje) y registra cuántas peticiones hay en vuelo a la vez."""
+
+    def __init__(self, demora=0.02, fallos=None):
+        self.demora = demora; self.fallos = dict(fallos or {}); self.en_vuelo = 0; self.max_en_vuelo = 0; self.eventos = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, temperature, timeout, n=1):
+        pregunta = messages[1]["content"].split("\n")[1]; tarea = messages[-1]["content"]
+        self.en_vuelo += 1; self.max_en_vuelo = max(self.max_en_vuelo, self.en_vuelo); self.eventos.append(("inicio", pregunta, time.monotonic()))
+        try:
+            await asyncio.sleep(self.demora)
+            if self.fallos.get(pregunta): self.fallos[pregunta] -= 1; raise ConnectionError("conexión reiniciada")
+        finally: self.en_vuelo -= 1
+        if "Descompón" in tarea: return respuesta(PLAN)
+        if "Evaluación Crítica" in tarea: return respuesta("Plan coherente.\nVEREDICTO: APROBADO")
+        if "INSTRUCCIÓN FINAL" in tarea: return respuesta("Costo Total: 20.00")
+        return respuesta("Resultado: 12" if "manzanas" in tarea else "Resultado: 8")
+
+
+@pytest.fixture(autouse=True)
+def planificador_propio(monkeypatch):
+    planificador = PlanificadorLLM(rpm=10_000, tpm=10_000_000)
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", planificador)
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", "")
+    return planificador
+
+
+def test_batch_resuelve_todas_las_preguntas_en_orden():
+    preguntas = [f"Pregunta {i}: ¿costo total del pedido {i}?" for i in range(5)]
+    cliente = ClienteAsyncFalso()
+    resultados = proceso_razonamiento_batch(preguntas, max_concurrency=3, client=cliente, model_name="gpt-4o")
+    assert [r["pregunta_original"] for r in resultados] == preguntas
+    for r in resultados:
+        assert r["error_message"] is None and r["respuesta_final"] == "Costo Total: 20.00"
+        assert list(r["resultados_parciales"].values()) == ["Resultado: 12", "Resultado: 8"]
+        assert r["token_report"]["prompt"] == 5 * 50 and r["plan_revision"].endswith("APROBADO")
+    assert 1 < cliente.max_en_vuelo <= 3
+
+
+def test_semaforo_no_se_retiene_durante_el_backoff(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "LLM_BACKOFF_BASE_SECONDS", 0.3)
+    monkeypatch.setattr(reasoning_core.random, "uniform", lambda a, b: b) # Backoff determinista: 0.3s
+    preguntas = ["Pregunta A: ¿costo total?", "Pregunta B: ¿costo total?"]
+    cliente = ClienteAsyncFalso(fallos={"Pregunta A: ¿costo total?": 1})
+    resultados = proceso_razonamiento_batch(preguntas, max_concurrency=1, client=cliente, model_name="gpt-4o")
+    assert all(r["error_message"] is None for r in resultados)
+    inicios_a = [t for _, p, t in cliente.eventos if p.startswith("Pregunta A")]
+    assert inicios_a[1] - inicios_a[0] >= 0.3 # A reintentó tras el backoff...
+    durante_backoff = [p for _, p, t in cliente.eventos if inicios_a[0] < t < inicios_a[1]]
+    assert durante_backoff and all(p.startswith("Pregunta B") for p in durante_backoff) # ...y B avanzó mientras tanto
+    assert cliente.max_en_vuelo == 1
+
+
+def test_fallo_de_una_pregunta_no_afecta_a_las_demas(planificador_propio):
+    planificador_propio.max_reintentos = 0; planificador_propio.umbral_circuito = 100
+    preguntas = ["Pregunta A: ¿costo total?", "Pregunta B: ¿costo total?"]
+    cliente = ClienteAsyncFalso(fallos={"Pregunta A: ¿costo total?": 1})
+    a, b = proceso_razonamiento_batch(preguntas, max_concurrency=2, client=cliente, model_name="gpt-4o")
+    assert "Fallo Descomp" in a["error_message"] and b["respuesta_final"] == "Costo Total: 20.00"
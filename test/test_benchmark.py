@@ -0,0 +1,37 @@
+# Tests del benchmark en replay (benchmark.py): casos de test/test_case.txt contra test/bench_recordings.json.
+import json
+
+import pytest
+
+import reasoning_core
+from benchmark import CASES_PATH, RECORDINGS_PATH, ClienteReplay, ejecutar_benchmark, leer_casos
+from reasoning_core import PlanificadorLLM, proceso_razonamiento_llm_calculator, valor_resultado
+
+
+@pytest.fixture
+def grabaciones(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", ""); monkeypatch.setattr(reasoning_core, "SELF_CONSISTENCY_SAMPLES", 1)
+    with open(RECORDINGS_PATH, encoding="utf-8") as f: return json.load(f)
+
+
+def test_todos_los_casos_grabados_son_correctos(grabaciones):
+    casos = leer_casos(CASES_PATH)
+    reporte = ejecutar_benchmark(casos, grabaciones, muestras=1)
+    assert {cid: r["correct"] for cid, r in reporte["cases"].items()} == {c["id"]: True for c in casos}
+    assert all(r["error_message"] is None for r in reporte["cases"].values())
+
+
+def test_respuestas_sin_linea_resultado_ligan_las_variables(grabaciones):
+    """CASE4: el Solucionador responde con igualdades encadenadas, '×' y '-', negritas y sin línea 'Resultado:'.
+
+    Los valores ligados (LE, AE, AP) alimentan los pasos locales; el TOTAL calculado localmente
+    debe coincidir con el esperado, no sólo el texto grabado del Sintetizador.
+    """
+    caso = next(c for c in leer_casos(CASES_PATH) if c["id"] == "CASE4")
+    resultado = proceso_razonamiento_llm_calculator(ClienteReplay(grabaciones["CASE4"]), "gpt-4o", caso["question"])
+    assert resultado["error_message"] is None
+    valores = [valor_resultado(r) for r in resultado["resultados_parciales"].values()]
+    assert valores[:6] == pytest.approx([8.4, 4.4, 4.96, 7.44, 9.24, 16.68])
+    assert valores[-1] == pytest.approx(caso["expected"], abs=0.005)
+    assert sorted(resultado["local_steps"], key=lambda p: int(p.split()[1])) == [f"Paso {i}" for i in range(4, 11)] # Todo lo posterior a los pasos del LLM es local
@@ -0,0 +1,91 @@
+# Tests de la caché de respuestas LLM (LLMResponseCache): LRU, TTL, persistencia en SQLite y qué llamadas la usan.
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import LLMResponseCache, PlanificadorLLM, call_llm_with_usage, call_llm_muestras, es_cache_hit
+
+MENSAJES = [{"role": "system", "content": "Eres un calculista."}, {"role": "user", "content": "¿3 × 4?"}]
+
+
+class Reloj:
+    def __init__(self): self.ahora = 1_000_000.0
+    def __call__(self): return self.ahora
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj(); monkeypatch.setattr(reasoning_core.time, "time", reloj)
+    return reloj
+
+
+def test_lru_en_memoria_expulsa_la_menos_usada():
+    cache = LLMResponseCache(path=None, memory_entries=2)
+    cache.put("a", "m", "A", 1, 1); cache.put("b", "m", "B", 1, 1)
+    assert cache.get("a") == ("A", 1, 1) # 'a' pasa a ser la más reciente
+    cache.put("c", "m", "C", 1, 1)
+    assert cache.get("b") is None and cache.get("a") == ("A", 1, 1) and cache.get("c") == ("C", 1, 1)
+    assert cache.stats() == {"hits": 3, "misses": 1}
+
+
+def test_ttl_vence_en_memoria_y_en_disco(tmp_path, reloj):
+    cache = LLMResponseCache(path=str(tmp_path / "llm.sqlite3"), ttl_seconds=60)
+    cache.put("k", "m", "respuesta", 10, 2)
+    reloj.ahora += 59; assert cache.get("k") == ("respuesta", 10, 2)
+    reloj.ahora += 2; assert cache.get("k") is None
+    assert LLMResponseCache(path=str(tmp_path / "llm.sqlite3"), ttl_seconds=60).get("k") is None
+
+
+def test_persistencia_entre_instancias(tmp_path):
+    path = str(tmp_path / "llm.sqlite3")
+    LLMResponseCache(path=path).put("k", "gpt-4o", "respuesta", 10, 2)
+    assert LLMResponseCache(path=path).get("k") == ("respuesta", 10, 2)
+
+
+def test_disco_expulsa_por_tamano_la_de_acceso_mas_viejo(tmp_path, reloj):
+    path = str(tmp_path / "llm.sqlite3")
+    cache = LLMResponseCache(path=path, disk_entries=2)
+    for clave in "abc": cache.put(clave, "m", clave.upper(), 1, 1); reloj.ahora += 1
+    reabierta = LLMResponseCache(path=path) # Memoria vacía: sólo responde el disco
+    assert reabierta.get("a") is None and reabierta.get("b") == ("B", 1, 1) and reabierta.get("c") == ("C", 1, 1)
+
+
+class ClienteContador:
+    def __init__(self):
+        self.llamadas = 0; self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, timeout, n=1):
+        self.llamadas += 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"Resultado: 12 ({self.llamadas})")) for _ in range(n)],
+                               usage=SimpleNamespace(prompt_tokens=40, completion_tokens=5 * n, prompt_tokens_details=None))
+
+
+@pytest.fixture
+def cache_activa(tmp_path, monkeypatch):
+    cache = LLMResponseCache(path=str(tmp_path / "llm.sqlite3"))
+    monkeypatch.setattr(reasoning_core, "LLM_CACHE_ENABLED", True); monkeypatch.setattr(reasoning_core, "_LLM_CACHE", cache)
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    return cache
+
+
+def test_la_clave_no_incluye_el_proposito(cache_activa):
+    cliente = ClienteContador()
+    primera, _ = call_llm_with_usage(cliente, "gpt-4o", MENSAJES, purpose="Solución Paso 1 a3f9c1", temperature=0.05)
+    segunda, usage = call_llm_with_usage(cliente, "gpt-4o", MENSAJES, purpose="Solución Paso 1 77be02", temperature=0.05)
+    assert cliente.llamadas == 1 and segunda == primera and es_cache_hit(usage) and usage.prompt_tokens == 0
+    call_llm_with_usage(cliente, "gpt-4o", MENSAJES, temperature=0.1) # Otra temperatura: otra clave
+    call_llm_with_usage(cliente, "gpt-4o-mini", MENSAJES, temperature=0.05) # Otro modelo: otra clave
+    assert cliente.llamadas == 3
+
+
+def test_temperatura_de_muestreo_no_usa_la_cache(cache_activa):
+    cliente = ClienteContador()
+    for _ in range(2): call_llm_with_usage(cliente, "gpt-4o", MENSAJES, temperature=0.7)
+    assert cliente.llamadas == 2 and cache_activa.stats() == {"hits": 0, "misses": 0}
+
+
+def test_votacion_con_n_no_usa_la_cache(cache_activa):
+    cliente = ClienteContador()
+    for _ in range(2): call_llm_muestras(cliente, "gpt-4o", MENSAJES, n=3, temperature=0.05)
+    assert cliente.llamadas == 2 and cache_activa.stats() == {"hits": 0, "misses": 0}
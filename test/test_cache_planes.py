@@ -0,0 +1,87 @@
+# Tests de la caché semántica de planes: vínculos ambiguos y veredicto del revisor para planes reutilizados.
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import (PlanTemplateCache, normalizar_pregunta, plantilla_plan, vincular_plan, veredicto_revision,
+                            nuevo_estado_razonamiento, aplicar_plan_cacheado, aplicar_verificacion)
+
+PREGUNTA = "Una tienda vende 3 cajas de 3 kg a 5 dólares cada una. ¿Cuánto cobra?"
+PLAN = "1. Multiplicar 3 cajas por 5 dólares.\n2. Informar el total del Paso 1."
+USAGE = SimpleNamespace(prompt_tokens=100, completion_tokens=20)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = PlanTemplateCache(path=None)
+    monkeypatch.setattr(reasoning_core, "PLAN_CACHE_ENABLED", True); monkeypatch.setattr(reasoning_core, "_PLAN_CACHE", cache)
+    return cache
+
+
+def guardar(cache, pregunta=PREGUNTA, plan=PLAN):
+    plantilla_pregunta, numeros = normalizar_pregunta(pregunta)
+    plantilla, vinculos, motivo = plantilla_plan(plan, numeros)
+    assert motivo is None
+    cache.guardar(plantilla_pregunta, len(numeros), plantilla, vinculos)
+
+
+@pytest.mark.parametrize("revision, esperado", [
+    ("El plan es correcto.\nVEREDICTO: APROBADO", True), ("Falta un paso.\n**Veredicto: RECHAZADO**", False),
+    ("Sin errores, todo ok.", None), ("VEREDICTO: APROBADO\nRevisando mejor...\nVEREDICTO: RECHAZADO", False), (None, None),
+])
+def test_veredicto_revision(revision, esperado):
+    assert veredicto_revision(revision) is esperado
+
+
+def test_vinculo_ambiguo_se_detecta():
+    _, numeros = normalizar_pregunta(PREGUNTA)
+    plantilla, vinculos, _ = plantilla_plan(PLAN, numeros)
+    assert vincular_plan(plantilla, vinculos, [3.0, 3.0, 7.0]) == ("1. Multiplicar 3 cajas por 7 dólares.\n2. Informar el total del Paso 1.", False)
+    assert vincular_plan(plantilla, vinculos, [4.0, 2.0, 5.0])[1] is True
+
+
+def test_pregunta_identica_reutiliza_el_plan(cache):
+    guardar(cache)
+    estado = nuevo_estado_razonamiento(PREGUNTA.replace("5 dólares", "7 dólares"))
+    assert aplicar_plan_cacheado(estado)
+    assert estado["plan_cache_report"]["status"] == "hit" and "por 7 dólares" in estado["plan"] and estado["current_stage"] == "solving"
+
+
+def test_vinculo_ambiguo_descompone_desde_cero(cache):
+    guardar(cache)
+    estado = nuevo_estado_razonamiento("Una tienda vende 4 cajas de 2 kg a 5 dólares cada una. ¿Cuánto cobra?")
+    assert not aplicar_plan_cacheado(estado)
+    assert estado["plan_cache_report"]["status"] == "fallback" and estado["plan"] is None
+    assert cache.stats()["fallbacks"] == 1
+
+
+def estado_reverificando(cache):
+    guardar(cache)
+    estado = nuevo_estado_razonamiento(PREGUNTA.replace("¿Cuánto cobra?", "¿Cuánto cobra en total?"))
+    assert aplicar_plan_cacheado(estado) and estado["plan_cache_report"]["status"] == "reverify"
+    assert estado["current_stage"] == "verifying"
+    return estado
+
+
+def test_plan_reutilizado_aprobado_se_ejecuta(cache):
+    estado = estado_reverificando(cache)
+    aplicar_verificacion(estado, "Correcto.\nVEREDICTO: APROBADO", USAGE)
+    assert estado["current_stage"] == "solving" and estado["plan_cache_report"]["status"] == "reverify"
+
+
+@pytest.mark.parametrize("revision, usage", [("Hay un error en el paso 1.\nVEREDICTO: RECHAZADO", USAGE),
+                                              ("Parece ok, aunque el error de redondeo...", USAGE), (None, None)])
+def test_plan_reutilizado_sin_aprobacion_se_descarta(cache, revision, usage):
+    estado = estado_reverificando(cache)
+    aplicar_verificacion(estado, revision, usage)
+    assert estado["current_stage"] == "decomposing" and estado["plan"] is None
+    assert estado["plan_cache_report"]["status"] == "rejected"
+    assert not aplicar_plan_cacheado(estado) # No se vuelve a consultar la caché
+
+
+def test_solo_se_guardan_planes_aprobados(cache):
+    for revision, guardados in (("Revisión sin veredicto.", 0), ("Bien.\nVEREDICTO: RECHAZADO", 0), ("Bien.\nVEREDICTO: APROBADO", 1)):
+        estado = nuevo_estado_razonamiento(PREGUNTA); estado["plan"] = PLAN; estado["plan_cache_report"]["status"] = "miss"
+        aplicar_verificacion(estado, revision, USAGE)
+        assert cache.stats()["stored"] == guardados and estado["current_stage"] == "solving"
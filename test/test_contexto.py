@@ -0,0 +1,64 @@
+# Tests del contexto incremental (ContextoRazonamiento): políticas y recorte por presupuesto de tokens.
+import pytest
+
+from reasoning_core import ContextoRazonamiento, construir_dag_pasos, extraer_pasos_plan, mensajes_solucionador
+
+PREGUNTA = "Un tanque cilíndrico de radio 3 m y alto 5 m con pared de 0.25 m: ¿cuál es el volumen de material? " * 3
+PLAN = ("1. R = 3 [depende de: ninguno]\n2. H = 5 [depende de: ninguno]\n3. V = π × R² × H [depende de: Paso 1, Paso 2]\n"
+        "4. Informar el volumen V en m³. [depende de: Paso 3]")
+TRABAJO = "MUESTRA TU TRABAJO: " + "se revisan las unidades y se desarrolla el cálculo con cuidado. " * 30
+
+
+def contexto(politica="full", presupuesto=100_000):
+    pasos = extraer_pasos_plan(PLAN)
+    ctx = ContextoRazonamiento(PREGUNTA, PLAN, pasos, construir_dag_pasos(pasos), politica=politica, presupuesto_tokens=presupuesto)
+    ctx.registrar_todos({0: f"{TRABAJO}\nResultado: R = 3 m", 1: f"{TRABAJO}\nResultado: H = 5 m", 2: f"{TRABAJO}\nResultado: V = 141.37 m³"})
+    return ctx
+
+
+def incluidos(texto):
+    """Pasos presentes en el contexto: (índice, con transcripción completa)."""
+    return {j: f"Paso {j+1}:" in texto and TRABAJO in texto.split(f"Paso {j+1}:")[1].split("\nPaso ")[0] for j in range(3) if f"Paso {j+1}:" in texto}
+
+
+def test_politicas_sin_presupuesto_ajustado():
+    full = contexto("full").para_paso(2)
+    assert incluidos(full) == {0: True, 1: True} and "Paso 3:" not in full # Sólo ancestros, completos
+    compacto = contexto("results-only").para_paso(2)
+    assert incluidos(compacto) == {0: False, 1: False} and "R = 3 m" in compacto and "H = 5 m" in compacto
+    solo_ancestros = contexto("ancestors-only")
+    texto = solo_ancestros.para_paso(2)
+    assert solo_ancestros.plan_prefijo == "" and texto.startswith("Pasos Relevantes del Plan:\n1. R = 3") and "4. Informar" not in texto
+
+
+def test_contexto_por_paso_frente_a_la_linea_base():
+    ctx = contexto("results-only"); ctx.para_paso(3)
+    reporte = ctx.resumen()["steps"]["Paso 4"]
+    assert reporte["tokens"] < reporte["tokens_baseline"] / 5
+
+
+@pytest.mark.parametrize("politica", ["full", "results-only"])
+def test_recorte_compacta_y_descarta_primero_lo_mas_lejano(politica):
+    vistos = []
+    for presupuesto in range(1, 3000, 10):
+        presentes = incluidos(contexto(politica, presupuesto).para_paso(3)) # Paso 4: ancestros 1, 2 y 3; depende directo del 3
+        assert 2 in presentes # La dependencia directa nunca se descarta
+        assert sorted(presentes) == list(range(min(presentes), 3)) # Se descartan primero los más lejanos
+        completos = [j for j, completo in sorted(presentes.items()) if completo]
+        assert not completos or completos == list(range(completos[0], 3)) # Y se compactan primero los más lejanos
+        vistos.append(tuple(sorted(presentes.items())))
+    assert vistos[0] == ((2, False),) and vistos[-1] == (((0, True), (1, True), (2, True)) if politica == "full" else ((0, False), (1, False), (2, False)))
+
+
+def test_pregunta_y_plan_nunca_se_recortan():
+    ctx = contexto("full", presupuesto=1)
+    mensajes = mensajes_solucionador(ctx.pasos[3], ctx.para_paso(3), ctx.pregunta, ctx.plan_prefijo)
+    prefijo = mensajes[1]["content"]
+    assert PREGUNTA in prefijo and PLAN in prefijo
+    assert "V = 141.37 m³" in mensajes[-1]["content"] and TRABAJO not in mensajes[-1]["content"]
+
+
+def test_sintesis_compacta_salvo_en_full():
+    resultados = {f"Paso {j+1}: {p}": f"{TRABAJO}\nResultado: {j}" for j, p in enumerate(extraer_pasos_plan(PLAN)[:3])}
+    assert all(TRABAJO in v for v in contexto("full").para_sintesis(resultados).values())
+    assert list(contexto("results-only").para_sintesis(resultados).values()) == ["R = 3 m", "H = 5 m", "V = 141.37 m³"]
@@ -0,0 +1,80 @@
+# Tests del plan como DAG (construir_dag_pasos) y del despacho en paralelo de pasos independientes (ejecutar_pasos_dag).
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import ContextoRazonamiento, PlanificadorLLM, construir_dag_pasos, ejecutar_pasos_dag, extraer_pasos_plan
+
+
+def dag(plan):
+    return construir_dag_pasos(extraer_pasos_plan(plan))
+
+
+def test_anotaciones_de_dependencias():
+    assert dag("1. Calcular A. [depende de: ninguno]\n2. Calcular B. [depende de: ninguno]\n3. Sumar. [depende de: Paso 1, Paso 2]") == {0: [], 1: [], 2: [0, 1]}
+    assert dag("1. A. [depende de: ninguno]\n2. B. [depende de: ninguno]\n3. C. [depende de: ninguno]\n4. D. [depende de: pasos 1 a 3]") == {0: [], 1: [], 2: [], 3: [0, 1, 2]}
+
+
+def test_referencias_en_el_texto_y_agregados():
+    plan = "1. Calcular el área.\n2. Calcular el perímetro.\n3. Multiplicar el resultado del paso 1 por 2.\n4. Calcular el total."
+    assert dag(plan) == {0: [], 1: [], 2: [0], 3: [0, 1, 2]} # 'total' sin referencias: depende de todo lo anterior
+
+
+def test_nombres_de_variables_agregan_dependencias():
+    plan = "1. R = 3 [depende de: ninguno]\n2. H = 5 [depende de: ninguno]\n3. V = π × R² × H [depende de: ninguno]"
+    assert dag(plan) == {0: [], 1: [], 2: [0, 1]} # La anotación olvidó R y H: la fórmula las aporta
+
+
+def test_plan_sin_dependencias_es_secuencial():
+    assert dag("1. Calcular A.\n2. Calcular B.\n3. Calcular C.") == {0: [], 1: [0], 2: [1]}
+
+
+@pytest.mark.parametrize("plan", [
+    "1. A. [depende de: ninguno]\n2. B. [depende de: Paso 2]\n3. C. [depende de: Paso 1]", # Autorreferencia
+    "1. A. [depende de: Paso 2]\n2. B. [depende de: Paso 1]\n3. C. [depende de: ninguno]", # Ciclo 1 <-> 2
+])
+def test_ciclos_y_autorreferencias_vuelven_a_la_secuencia(plan):
+    assert dag(plan) == {0: [], 1: [0], 2: [1]}
+
+
+class ClienteConcurrente:
+    """Solucionador simulado: los pasos 'A' y 'B' esperan en una barrera, que sólo se cruza si corren a la vez."""
+
+    def __init__(self):
+        self.barrera = threading.Barrier(2, timeout=5); self.eventos = []; self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, timeout, stream=False, stream_options=None, n=1):
+        tarea = messages[-1]["content"]; paso = tarea.rsplit("Ejecuta y detalla este paso del plan: ", 1)[1][3]
+        with self._lock: self.eventos.append(("inicio", paso, time.monotonic()))
+        if paso in "AB": self.barrera.wait()
+        with self._lock: self.eventos.append(("fin", paso, time.monotonic()))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"Resultado: {paso} = 1"))],
+                               usage=SimpleNamespace(prompt_tokens=20, completion_tokens=5, prompt_tokens_details=None))
+
+
+@pytest.fixture
+def aislado(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", ""); monkeypatch.setattr(reasoning_core, "SELF_CONSISTENCY_SAMPLES", 1)
+
+
+def test_pasos_independientes_corren_en_paralelo(aislado):
+    plan = "1. A: medir el lado. [depende de: ninguno]\n2. B: medir el alto. [depende de: ninguno]\n3. C: combinar ambos. [depende de: Paso 1, Paso 2]"
+    pasos = extraer_pasos_plan(plan); cliente = ClienteConcurrente()
+    contexto = ContextoRazonamiento("¿Pregunta?", plan, pasos, construir_dag_pasos(pasos))
+    respuestas, usages, fallido = ejecutar_pasos_dag(cliente, "gpt-4o", contexto, max_workers=4)
+    assert fallido is None and sorted(usages) == [0, 1, 2] and respuestas[2] == "Resultado: C = 1"
+    orden = [(tipo, paso) for tipo, paso, _ in cliente.eventos]
+    assert orden.index(("inicio", "C")) > max(orden.index(("fin", "A")), orden.index(("fin", "B"))) # C espera a sus dependencias
+
+
+def test_con_un_solo_hilo_los_pasos_no_se_solapan(aislado):
+    plan = "1. A: medir el lado. [depende de: ninguno]\n2. B: medir el alto. [depende de: ninguno]"
+    pasos = extraer_pasos_plan(plan); cliente = ClienteConcurrente(); cliente.barrera = threading.Barrier(2, timeout=0.2)
+    contexto = ContextoRazonamiento("¿Pregunta?", plan, pasos, construir_dag_pasos(pasos))
+    _, _, fallido = ejecutar_pasos_dag(cliente, "gpt-4o", contexto, max_workers=1)
+    assert fallido == 0 # La barrera no se cruza: prueba que el paralelismo del test anterior es real
@@ -0,0 +1,70 @@
+# Tests del motor aritmético: evaluador seguro de fórmulas (evaluar_expresion_segura) y vínculo de los valores del LLM.
+import time
+
+import pytest
+
+from reasoning_core import evaluar_expresion_segura, registrar_variable_respuesta, resolver_paso_local, MAX_EXPRESSION_LENGTH
+
+
+def test_aritmetica_condicionales_y_funciones():
+    assert evaluar_expresion_segura("2 + 3 * 4") == 14.0
+    assert evaluar_expresion_segura("S * 0.95 if S > 10000 else S", {"S": 12000}) == pytest.approx(11400.0)
+    assert evaluar_expresion_segura("round(2.567, 2)") == 2.57
+    assert evaluar_expresion_segura("sqrt(16) + max(1, 2) + abs(-3)") == 9.0
+    assert evaluar_expresion_segura("pi * 2 ** 2") == pytest.approx(12.566370614)
+
+
+@pytest.mark.parametrize("expresion", ["(((9**64)**64)**64)**64", "((((9**64)**64)**64)**64)**64", "9**64 * 9**64 * 9**64 * 9**64 * 9**64 * 9**64", "1e308 * 10"])
+def test_resultados_enormes_fallan_al_instante(expresion):
+    inicio = time.perf_counter()
+    with pytest.raises(ValueError): evaluar_expresion_segura(expresion)
+    assert time.perf_counter() - inicio < 0.5
+
+
+@pytest.mark.parametrize("expresion", ["2 ** 65", "2 ** -100"])
+def test_exponentes_fuera_de_rango(expresion):
+    with pytest.raises(ValueError, match="Exponente"): evaluar_expresion_segura(expresion)
+
+
+@pytest.mark.parametrize("expresion", ["x + 1", "__import__('os')", "open('f')", "(1).real", "pi.real", "[1, 2]", "'a' * 3", "lambda: 1", "True + 1"])
+def test_construcciones_no_permitidas(expresion):
+    with pytest.raises(ValueError): evaluar_expresion_segura(expresion)
+
+
+def test_expresion_demasiado_larga():
+    with pytest.raises(ValueError, match="larga"): evaluar_expresion_segura("1+" * MAX_EXPRESSION_LENGTH + "1")
+
+
+@pytest.mark.parametrize("paso, respuesta, esperado", [
+    ("1. RE = 30 / 2", "Radio exterior: RE = 30 / 2 = 15", 15.0),
+    ("1. RE = 3.4 × 2", "RE = 3.4 × 2 = 6.8", 6.8),
+    ("1. RI = R - 0.25", "RI = 3 - 0.25 = 2.75 m", 2.75),
+    ("1. RI = R - 0.25", "RI = 3 − 0.25 ≈ 2.75 m (radio interior)", 2.75),
+    ("1. C = 1000 × 10", "**C = $10,000.50**.", 10000.5),
+    ("1. C = 1000 × 10", "C = 10,000, y D = 5", 10000.0),
+    ("1. A = 3 ** 2", "A = 3**2 = 9 m²", 9.0),
+    ("1. RI = R - 0.25", "RI = 3 - 0.25 = 2.7 (redondeado)\nResultado: RI = 2.75 m", 2.75), # Manda la línea 'Resultado:'
+])
+def test_vincula_el_valor_final_de_la_cadena(paso, respuesta, esperado):
+    variables = {}
+    registrar_variable_respuesta(paso, respuesta, variables)
+    assert variables == {paso.split()[1]: pytest.approx(esperado)}
+
+
+@pytest.mark.parametrize("respuesta", ["RI = 3 - 0.25", "RI = 3 × R", "RI = 3 ** 2", "El radio interior es menor que R."])
+def test_sin_valor_final_no_se_vincula(respuesta):
+    variables = {"R": 3.0}
+    registrar_variable_respuesta("1. RI = R - 0.25", respuesta, variables)
+    assert variables == {"R": 3.0}
+
+
+def test_paso_local_usa_el_valor_vinculado():
+    variables = {"R": 3.0}
+    registrar_variable_respuesta("2. RI = R - 0.25", "RI = 3 - 0.25 = 2.75 m", variables)
+    nombre, valor, texto = resolver_paso_local("3. VM = π × (R² - RI²) × 3", variables)
+    assert nombre == "VM" and valor == pytest.approx(3.141592653589793 * (9 - 2.75 ** 2) * 3, rel=1e-3) and "determinista local" in texto
+
+
+@pytest.mark.parametrize("expresion, motivo", [("1/0", "cero"), ("5 % (2 - 2)", "cero"), ("(-8)**0.5 > 1", "no válida"), ("(-8)**0.5", "numérico")])
+def test_errores_aritmeticos_son_value_error(expresion, motivo):
+    with pytest.raises(ValueError, match=motivo): evaluar_expresion_segura(expresion)
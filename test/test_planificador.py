@@ -0,0 +1,163 @@
+# Tests del planificador de llamadas LLM (PlanificadorLLM): reintentos, retry-after, plazo y circuit breaker.
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import PlanificadorLLM, CircuitoAbiertoError, LLM_EXPECTED_COMPLETION_TOKENS
+
+
+class ErrorLimite(Exception):
+    """429 con cabeceras HTTP, como los errores del cliente openai."""
+    def __init__(self, headers): super().__init__("429"); self.response = SimpleNamespace(headers=headers)
+
+
+@pytest.fixture(autouse=True)
+def backoff_corto(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "LLM_BACKOFF_BASE_SECONDS", 0.001)
+    tipo_original = reasoning_core.tipo_error_llm
+    monkeypatch.setattr(reasoning_core, "tipo_error_llm", lambda e: "rate_limit" if isinstance(e, ErrorLimite) else tipo_original(e))
+
+
+def llamada_con_fallos(*errores, respuesta="ok"):
+    """Devuelve una llamada que lanza los errores indicados en orden y después responde."""
+    pendientes = list(errores); timeouts = []
+    def llamada(timeout):
+        timeouts.append(timeout)
+        if pendientes: raise pendientes.pop(0)
+        return respuesta
+    llamada.timeouts = timeouts
+    return llamada
+
+
+def test_backoff_reintenta_errores_transitorios():
+    planificador = PlanificadorLLM(max_reintentos=3)
+    respuesta, info = planificador.ejecutar(llamada_con_fallos(ConnectionError("reset"), TimeoutError("lento")), 100)
+    assert respuesta == "ok" and info["attempts"] == 3 and info["retries"] == 2
+    assert planificador.stats["timeouts"] == 1 and planificador._estado == "cerrado" and planificador._fallos_seguidos == 0
+
+
+def test_reintentos_agotados_propagan_el_ultimo_error():
+    planificador = PlanificadorLLM(max_reintentos=1, umbral_circuito=10)
+    with pytest.raises(ConnectionError, match="b"):
+        planificador.ejecutar(llamada_con_fallos(ConnectionError("a"), ConnectionError("b")), 100)
+    assert planificador.stats["attempts"] == 2
+
+
+def test_error_permanente_no_se_reintenta():
+    planificador = PlanificadorLLM()
+    llamada = llamada_con_fallos(ValueError("400 prompt inválido"))
+    with pytest.raises(ValueError): planificador.ejecutar(llamada, 100)
+    assert len(llamada.timeouts) == 1
+
+
+def test_retry_after_pausa_el_siguiente_intento():
+    planificador = PlanificadorLLM()
+    inicio = time.monotonic()
+    respuesta, info = planificador.ejecutar(llamada_con_fallos(ErrorLimite({"retry-after-ms": "200"})), 100)
+    assert respuesta == "ok" and info["retries"] == 1 and time.monotonic() - inicio >= 0.2
+    assert planificador.stats["rate_limited"] == 1 and planificador._fallos_seguidos == 0
+
+
+def test_retry_after_mas_alla_del_plazo_no_reintenta():
+    planificador = PlanificadorLLM(plazo=1.0)
+    with pytest.raises(ErrorLimite): planificador.ejecutar(llamada_con_fallos(ErrorLimite({"retry-after": "5"})), 100)
+
+
+def test_plazo_agotado_esperando_turno():
+    planificador = PlanificadorLLM(rpm=1, plazo=0.5)
+    planificador.ejecutar(llamada_con_fallos(), 100) # Consume la única petición del minuto
+    with pytest.raises(TimeoutError, match="Plazo"): planificador.ejecutar(llamada_con_fallos(), 100)
+
+
+def test_timeout_por_intento_respeta_el_plazo():
+    planificador = PlanificadorLLM(timeout=60, plazo=2)
+    llamada = llamada_con_fallos()
+    planificador.ejecutar(llamada, 100)
+    assert llamada.timeouts[0] <= 2
+
+
+@pytest.mark.parametrize("completions", [1, 3])
+def test_tokens_de_prompt_perdidos_por_timeout(completions):
+    planificador = PlanificadorLLM(max_reintentos=1)
+    prompt = 1000; reserva = prompt + completions * LLM_EXPECTED_COMPLETION_TOKENS
+    _, info = planificador.ejecutar(llamada_con_fallos(TimeoutError("lento")), reserva, completions=completions)
+    assert info["timed_out_tokens"] == prompt
+
+
+def test_circuito_se_abre_tras_fallos_transitorios():
+    planificador = PlanificadorLLM(max_reintentos=0, umbral_circuito=3, enfriamiento=60)
+    for _ in range(3):
+        with pytest.raises(ConnectionError): planificador.ejecutar(llamada_con_fallos(ConnectionError("caída")), 100)
+    assert planificador._estado == "abierto" and planificador.stats["circuit_opens"] == 1
+    with pytest.raises(CircuitoAbiertoError): planificador.ejecutar(llamada_con_fallos(), 100)
+
+
+def test_errores_permanentes_no_abren_el_circuito():
+    planificador = PlanificadorLLM(max_reintentos=0, umbral_circuito=2)
+    for _ in range(5):
+        with pytest.raises(ValueError): planificador.ejecutar(llamada_con_fallos(ValueError("400")), 100)
+    assert planificador._estado == "cerrado" and planificador._fallos_seguidos == 0
+    assert planificador.ejecutar(llamada_con_fallos(), 100)[0] == "ok"
+
+
+def abrir_circuito(planificador):
+    planificador._estado = "abierto"; planificador._fallos_seguidos = planificador.umbral_circuito; planificador._abierto_hasta = time.monotonic() - 1
+
+
+def test_prueba_semiabierta_con_exito_cierra_el_circuito():
+    planificador = PlanificadorLLM(max_reintentos=0)
+    abrir_circuito(planificador)
+    assert planificador.ejecutar(llamada_con_fallos(), 100)[0] == "ok"
+    assert planificador._estado == "cerrado" and planificador._fallos_seguidos == 0
+
+
+def test_prueba_semiabierta_fallida_reabre_el_circuito():
+    planificador = PlanificadorLLM(max_reintentos=0, enfriamiento=60)
+    abrir_circuito(planificador)
+    with pytest.raises(ConnectionError): planificador.ejecutar(llamada_con_fallos(ConnectionError("caída")), 100)
+    assert planificador._estado == "abierto" and planificador._abierto_hasta > time.monotonic() + 50
+
+
+def test_prueba_semiabierta_con_error_permanente_cierra_el_circuito():
+    planificador = PlanificadorLLM(max_reintentos=0)
+    abrir_circuito(planificador)
+    with pytest.raises(ValueError): planificador.ejecutar(llamada_con_fallos(ValueError("400")), 100)
+    assert planificador._estado == "cerrado"
+
+
+def test_prueba_semiabierta_se_libera_si_agota_el_plazo():
+    planificador = PlanificadorLLM(rpm=1, plazo=0.5)
+    planificador.ejecutar(llamada_con_fallos(), 100) # Sin cupo: la prueba agotará el plazo esperando turno
+    abrir_circuito(planificador)
+    with pytest.raises(TimeoutError): planificador.ejecutar(llamada_con_fallos(), 100)
+    assert planificador._estado == "abierto" and planificador._abierto_hasta <= time.monotonic()
+    planificador.rpm = 1000; planificador._peticiones = 10.0 # Vuelve el cupo: la siguiente llamada puede probar
+    assert planificador.ejecutar(llamada_con_fallos(), 100)[0] == "ok" and planificador._estado == "cerrado"
+
+
+def test_prueba_semiabierta_reintenta_sin_bloquearse():
+    planificador = PlanificadorLLM(max_reintentos=2)
+    abrir_circuito(planificador)
+    respuesta, info = planificador.ejecutar(llamada_con_fallos(ErrorLimite({"retry-after-ms": "10"})), 100)
+    assert respuesta == "ok" and info["attempts"] == 2 and planificador._estado == "cerrado"
+
+
+def test_solo_una_prueba_a_la_vez():
+    planificador = PlanificadorLLM(max_reintentos=0)
+    abrir_circuito(planificador)
+    def llamada(timeout):
+        with pytest.raises(CircuitoAbiertoError, match="prueba"): planificador.ejecutar(llamada_con_fallos(), 100)
+        return "ok"
+    assert planificador.ejecutar(llamada, 100)[0] == "ok"
+
+
+def test_ejecutar_async_reintenta_y_libera_la_prueba():
+    planificador = PlanificadorLLM(rpm=1, plazo=0.5)
+    async def llamada(timeout): return "ok"
+    assert asyncio.run(planificador.ejecutar_async(llamada, 100))[0] == "ok"
+    abrir_circuito(planificador)
+    with pytest.raises(TimeoutError): asyncio.run(planificador.ejecutar_async(llamada, 100))
+    assert planificador._estado == "abierto"
@@ -0,0 +1,78 @@
+# Tests del prefijo estable de los mensajes (caché de prefijos del proveedor) y del costo de los tokens cacheados.
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import (PlanificadorLLM, SYSTEM_PROMPT_COMUN, contenido_prefijo, costo_llamada, proceso_razonamiento_llm_calculator,
+                            tarifas_modelo, tarifa_entrada_cacheada)
+
+PREGUNTA = "Un pedido lleva 3 kg de manzanas a 4 dólares, 2 kg de peras a 5 dólares y 1 kg de uvas a 6 dólares. ¿Costo total?"
+PLAN = ("1. Calcular el costo de las manzanas del pedido. [depende de: ninguno]\n2. Calcular el costo de las peras del pedido. [depende de: ninguno]\n"
+        "3. Calcular el costo de las uvas del pedido. [depende de: ninguno]\n4. Sumar los costos de los pasos 1 a 3. [depende de: Paso 1, Paso 2, Paso 3]")
+PROMPT, CACHEADOS, COMPLETION = 2000, 1024, 30
+
+
+class ClienteGrabador:
+    """Responde según el rol y guarda los mensajes de cada llamada; desde la segunda, informa 1024 tokens cacheados."""
+
+    def __init__(self):
+        self.llamadas = []; self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, timeout, n=1):
+        tarea = messages[-1]["content"]
+        if "Descompón" in tarea: texto, rol = PLAN, "descompositor"
+        elif "Evaluación Crítica" in tarea: texto, rol = "Plan coherente.\nVEREDICTO: APROBADO", "verificador"
+        elif "INSTRUCCIÓN FINAL" in tarea: texto, rol = "Costo Total: 28.00", "sintetizador"
+        else: texto, rol = "Resultado: 12", "solucionador"
+        cacheados = CACHEADOS if self.llamadas else 0
+        self.llamadas.append((rol, json.loads(json.dumps(messages)), cacheados))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=texto))],
+                               usage=SimpleNamespace(prompt_tokens=PROMPT, completion_tokens=COMPLETION, prompt_tokens_details=SimpleNamespace(cached_tokens=cacheados)))
+
+
+@pytest.fixture
+def ejecucion(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", ""); monkeypatch.setattr(reasoning_core, "SELF_CONSISTENCY_SAMPLES", 1)
+    cliente = ClienteGrabador()
+    resultado = proceso_razonamiento_llm_calculator(cliente, "gpt-4o", PREGUNTA)
+    assert resultado["error_message"] is None
+    return cliente, resultado
+
+
+def test_pasos_de_una_ejecucion_comparten_un_prefijo_identico(ejecucion):
+    cliente, _ = ejecucion
+    pasos = [mensajes for rol, mensajes, _ in cliente.llamadas if rol == "solucionador"]
+    assert len(pasos) == 4
+    prefijos = {json.dumps(m[:2], ensure_ascii=False) for m in pasos}
+    assert len(prefijos) == 1 # Sistema y pregunta + plan, byte a byte iguales
+    assert len({m[-1]["content"] for m in pasos}) == 4 # Lo que varía va al final
+
+
+def test_un_unico_sistema_y_la_pregunta_como_inicio_comun(ejecucion):
+    cliente, _ = ejecucion
+    for rol, mensajes, _ in cliente.llamadas:
+        assert [m["role"] for m in mensajes].count("system") == 1 and mensajes[0]["role"] == "system"
+        assert mensajes[0]["content"].startswith(SYSTEM_PROMPT_COMUN)
+        assert mensajes[1]["content"].startswith(contenido_prefijo(PREGUNTA))
+    con_plan = {mensajes[1]["content"] for rol, mensajes, _ in cliente.llamadas if rol != "descompositor"}
+    assert con_plan == {contenido_prefijo(PREGUNTA, PLAN)} # Verificador, solucionador y sintetizador: mismo mensaje de pregunta + plan
+
+
+def test_tokens_cacheados_se_cobran_a_tarifa_reducida(ejecucion):
+    cliente, resultado = ejecucion
+    reporte = resultado["token_report"]; llamadas = len(cliente.llamadas)
+    assert reporte["prompt_cached"] == (llamadas - 1) * CACHEADOS and reporte["by_model"]["gpt-4o"]["cached"] == reporte["prompt_cached"]
+    esperado = sum(costo_llamada(PROMPT, COMPLETION, "gpt-4o", cacheados) for _, _, cacheados in cliente.llamadas)
+    assert reporte["cost_total"] == pytest.approx(esperado)
+    entrada, _ = tarifas_modelo("gpt-4o"); ahorro = reporte["prompt_cached"] * (entrada - tarifa_entrada_cacheada("gpt-4o")) / 1_000_000
+    assert reporte["cost_total"] == pytest.approx(costo_llamada(PROMPT * llamadas, COMPLETION * llamadas, "gpt-4o") - ahorro)
+    assert ahorro > 0
+
+
+def test_costo_llamada_con_tokens_cacheados():
+    assert costo_llamada(1000, 0, "gpt-4o", cached_tokens=1000) == pytest.approx(1000 * 1.25 / 1_000_000)
+    assert costo_llamada(1000, 0, "gpt-4o", cached_tokens=5000) == costo_llamada(1000, 0, "gpt-4o", cached_tokens=1000) # Nunca más que el prompt
+    assert costo_llamada(1000, 100, "gpt-4o") == pytest.approx((1000 * 2.50 + 100 * 10.00) / 1_000_000)
@@ -0,0 +1,60 @@
+# Tests del presupuesto por ejecución y del ruteo de modelos.
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import (PresupuestoEjecucion, PresupuestoExcedidoError, modelo_para_llamada, nuevo_estado_razonamiento,
+                            aplicar_verificacion, preparar_reanudacion)
+
+MENSAJES = [{"role": "user", "content": "x" * 4000}]
+PLAN = "1. Calcular el área.\n2. Sumar el resultado del Paso 1."
+
+
+def test_presupuesto_rechaza_la_llamada_que_lo_superaria():
+    presupuesto = PresupuestoEjecucion(max_cost_usd=None, max_tokens=2000)
+    reserva = presupuesto.reservar("gpt-4o", MENSAJES)
+    with pytest.raises(PresupuestoExcedidoError): presupuesto.reservar("gpt-4o", MENSAJES)
+    presupuesto.liquidar(reserva, "gpt-4o", SimpleNamespace(prompt_tokens=100, completion_tokens=10))
+    assert presupuesto.tokens == 110
+    presupuesto.reservar("gpt-4o", MENSAJES) # Liquidada la primera, vuelve a haber margen
+
+
+def test_presupuesto_de_costo():
+    presupuesto = PresupuestoEjecucion(max_cost_usd=0.005, max_tokens=None)
+    with pytest.raises(PresupuestoExcedidoError, match="costo"): presupuesto.reservar("gpt-4o", MENSAJES, completions=5)
+    presupuesto.reservar("gpt-4.1-nano", MENSAJES, completions=5)
+
+
+def estado_verificando():
+    estado = nuevo_estado_razonamiento("¿Cuál es el área de un círculo de radio 2?", presupuesto={"max_tokens": 1000})
+    estado["plan"] = PLAN; estado["plan_cache_report"]["status"] = "disabled"; estado["current_stage"] = "verifying"
+    return estado
+
+
+def test_verificacion_bloqueada_por_presupuesto_detiene_y_se_reanuda_verificando():
+    estado = estado_verificando()
+    aplicar_verificacion(estado, "Error Presupuesto: 900 tokens + ~600 estimados superan el máximo de 1000", None)
+    assert estado["current_stage"] == "error" and estado["failed_stage"] == "verifying" and "Presupuesto" in estado["error_message"]
+    assert not estado["steps"]
+    preparar_reanudacion(estado)
+    assert estado["current_stage"] == "verifying" and estado["plan"] == PLAN
+    aplicar_verificacion(estado, "Bien.\nVEREDICTO: APROBADO", SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+    assert estado["current_stage"] == "solving" and estado["plan_revision"].endswith("APROBADO")
+
+
+def test_verificacion_fallida_se_marca_sin_verificar():
+    estado = estado_verificando()
+    aplicar_verificacion(estado, "Error API: conexión rechazada", None)
+    assert estado["current_stage"] == "solving" and estado["plan_revision"].startswith("Sin verificar")
+
+
+def test_ruteo_solo_abarata(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", "gpt-4.1-nano")
+    assert modelo_para_llamada("gpt-4o", "verifying") == "gpt-4.1-nano"
+    assert modelo_para_llamada("gpt-4o", "solving", "Calcular AREA = pi * 2 ** 2") == "gpt-4.1-nano"
+    assert modelo_para_llamada("gpt-4o", "solving", "Explicar por qué el área crece") == "gpt-4o"
+    assert modelo_para_llamada("gpt-4o", "synthesizing") == "gpt-4o"
+    assert modelo_para_llamada("gpt-4.1-nano", "verifying") == "gpt-4.1-nano" # Nunca sube de modelo
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", "")
+    assert modelo_para_llamada("gpt-4o", "verifying") == "gpt-4o"
@@ -0,0 +1,92 @@
+# Tests del registro de ejecuciones en segundo plano (RegistroEjecuciones) con un cliente OpenAI simulado en streaming.
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import PlanificadorLLM, RegistroEjecuciones, nuevo_estado_razonamiento
+
+PLAN = "1. Calcular el costo de las manzanas del pedido. [depende de: ninguno]"
+USAGE = SimpleNamespace(prompt_tokens=50, completion_tokens=10, prompt_tokens_details=None)
+
+
+def fragmento(texto=None, usage=None):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=texto))] if texto else [], usage=usage)
+
+
+class ClienteFalso:
+    """Responde según el rol; las llamadas con stream=True entregan el texto en fragmentos y
+    el de la solución del paso se detiene a mitad hasta que el test lo libera."""
+
+    def __init__(self):
+        self.a_mitad = threading.Event(); self.continuar = threading.Event()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, timeout, stream=False, stream_options=None, n=1):
+        tarea = messages[-1]["content"]
+        if "Descompón" in tarea: texto = PLAN
+        elif "Evaluación Crítica" in tarea: texto = "Plan coherente.\nVEREDICTO: APROBADO"
+        elif "INSTRUCCIÓN FINAL" in tarea: texto = "Costo Total: 12.00"
+        else: texto = "Manzanas: 3 x 4.\nResultado: 12"
+        if not stream: return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=texto))], usage=USAGE)
+        return self._fragmentos(texto, pausar="Resultado" in texto)
+
+    def _fragmentos(self, texto, pausar):
+        primera, _, resto = texto.partition("\n")
+        yield fragmento(primera + "\n" if resto else primera)
+        if pausar: self.a_mitad.set(); assert self.continuar.wait(5)
+        if resto: yield fragmento(resto)
+        yield fragmento(usage=USAGE)
+
+
+@pytest.fixture(autouse=True)
+def aislado(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", "")
+    monkeypatch.setattr(reasoning_core, "SELF_CONSISTENCY_SAMPLES", 1)
+
+
+def esperar(registro, run_id, status, plazo=5.0):
+    limite = time.monotonic() + plazo
+    while time.monotonic() < limite:
+        foto = registro.foto(run_id)
+        if foto["status"] == status: return foto
+        time.sleep(0.01)
+    pytest.fail(f"la ejecución no llegó a '{status}' (está en '{registro.foto(run_id)['status']}')")
+
+
+def test_progreso_en_streaming_y_estado_final():
+    registro = RegistroEjecuciones(max_workers=1); cliente = ClienteFalso()
+    run_id = registro.encolar(cliente, "gpt-4o", nuevo_estado_razonamiento("¿Cuánto cuestan 3 manzanas a 4 dólares?"))
+    assert cliente.a_mitad.wait(5)
+    foto = registro.foto(run_id)
+    assert foto["status"] == "running" and foto["live"] == {"Paso 1": "Manzanas: 3 x 4.\n"} # Texto parcial del paso en curso
+    assert foto["state"]["current_stage"] == "solving" and foto["state"]["plan"] == PLAN
+    assert registro.stats()["running"] == 1
+    cliente.continuar.set()
+    foto = esperar(registro, run_id, "done")
+    assert foto["live"] == {} and foto["finished_at"] is not None
+    assert foto["state"]["respuesta_final"] == "Costo Total: 12.00"
+    assert foto["state"]["step_results"] == {0: "Manzanas: 3 x 4.\nResultado: 12"}
+
+
+def test_fallo_inesperado_termina_en_error(monkeypatch):
+    def avanzar_roto(*args, **kwargs): raise RuntimeError("estado corrupto")
+    monkeypatch.setattr(reasoning_core, "avanzar_etapa", avanzar_roto)
+    registro = RegistroEjecuciones(max_workers=1)
+    run_id = registro.encolar(ClienteFalso(), "gpt-4o", nuevo_estado_razonamiento("¿Cuánto cuestan 3 manzanas?"))
+    foto = esperar(registro, run_id, "error")
+    assert "estado corrupto" in foto["state"]["error_message"] and foto["finished_at"] is not None
+
+
+def test_status_terminal_aunque_la_ejecucion_se_corte(monkeypatch):
+    class Corte(BaseException): pass
+    def avanzar_cortado(*args, **kwargs): raise Corte()
+    monkeypatch.setattr(reasoning_core, "avanzar_etapa", avanzar_cortado)
+    registro = RegistroEjecuciones(max_workers=1)
+    run_id = registro.encolar(ClienteFalso(), "gpt-4o", nuevo_estado_razonamiento("¿Cuánto cuestan 3 manzanas?"))
+    foto = esperar(registro, run_id, "error")
+    assert foto["state"]["failed_stage"] == "decomposing" and "interrumpida" in foto["state"]["error_message"] # Reanudable
+    assert registro.stats()["running"] == 0
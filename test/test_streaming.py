@@ -0,0 +1,96 @@
+# Tests del modo streaming (stream_llm_with_usage): TTFT, usage del último chunk y vuelta a la llamada sin streaming.
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import PlanificadorLLM, call_llm_with_usage, proceso_razonamiento_llm_calculator
+
+MENSAJES = [{"role": "system", "content": "Eres un calculista."}, {"role": "user", "content": "¿3 × 4?"}]
+ESPERA_PRIMERO, ESPERA_RESTO = 0.15, 0.05
+
+
+def chunk(texto=None, usage=None):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=texto))] if texto is not None else [], usage=usage)
+
+
+class ClienteStream:
+    """Emite 'Resultado: 12' en fragmentos con demoras; 'fallo_stream' hace que create(stream=True) lance esa excepción."""
+
+    def __init__(self, fragmentos=("Resultado", ": ", "12"), con_usage=True, fallo_stream=None):
+        self.fragmentos, self.con_usage, self.fallo_stream = fragmentos, con_usage, fallo_stream
+        self.llamadas = []; self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, timeout, stream=False, stream_options=None, n=1):
+        self.llamadas.append("stream" if stream else "completa")
+        if stream and self.fallo_stream is not None:
+            fallo, self.fallo_stream = self.fallo_stream, (None if isinstance(self.fallo_stream, ConnectionError) else self.fallo_stream)
+            raise fallo
+        usage = SimpleNamespace(prompt_tokens=40, completion_tokens=5, prompt_tokens_details=None)
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(self.fragmentos)))], usage=usage)
+        return self._stream(usage)
+
+    def _stream(self, usage):
+        yield chunk("") # Chunk inicial con el rol y sin texto: no cuenta para el TTFT
+        for j, texto in enumerate(self.fragmentos):
+            time.sleep(ESPERA_PRIMERO if j == 0 else ESPERA_RESTO); yield chunk(texto)
+        if self.con_usage: yield chunk(usage=usage)
+
+
+@pytest.fixture(autouse=True)
+def aislado(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", ""); monkeypatch.setattr(reasoning_core, "SELF_CONSISTENCY_SAMPLES", 1)
+
+
+def llamar(cliente):
+    deltas, metricas = [], {}; inicio = time.perf_counter()
+    content, usage = call_llm_with_usage(cliente, "gpt-4o", MENSAJES, "Paso", stream=True, on_delta=deltas.append, metricas=metricas)
+    return content, usage, deltas, metricas["ttft"], time.perf_counter() - inicio
+
+
+def test_ttft_es_el_tiempo_hasta_el_primer_fragmento():
+    content, usage, deltas, ttft, total = llamar(ClienteStream())
+    assert content == "Resultado: 12" and deltas == ["Resultado", ": ", "12"]
+    assert ESPERA_PRIMERO <= ttft < ESPERA_PRIMERO + ESPERA_RESTO and ttft + 2 * ESPERA_RESTO <= total
+    assert (usage.prompt_tokens, usage.completion_tokens) == (40, 5)
+
+
+def test_stream_sin_usage_registra_cero_tokens():
+    content, usage, _, ttft, _ = llamar(ClienteStream(con_usage=False))
+    assert content == "Resultado: 12" and ttft is not None and (usage.prompt_tokens, usage.completion_tokens) == (0, 0)
+
+
+def test_si_el_stream_no_se_abre_se_repite_sin_streaming():
+    cliente = ClienteStream(fallo_stream=TypeError("create() got an unexpected keyword argument 'stream_options'"))
+    content, usage, deltas, ttft, total = llamar(cliente)
+    assert cliente.llamadas == ["stream", "completa"] # Error permanente: sin reintentos del stream
+    assert content == "Resultado: 12" and deltas == ["Resultado: 12"] and (usage.prompt_tokens, usage.completion_tokens) == (40, 5)
+    assert 0 < ttft <= total
+
+
+def test_error_transitorio_reintenta_el_stream_sin_caer_a_la_llamada_completa(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "LLM_BACKOFF_BASE_SECONDS", 0.001)
+    cliente = ClienteStream(fallo_stream=ConnectionError("conexión reiniciada"))
+    content, _, deltas, _, _ = llamar(cliente)
+    assert cliente.llamadas == ["stream", "stream"] and content == "Resultado: 12" and deltas == ["Resultado", ": ", "12"]
+
+
+def test_pipeline_en_streaming_informa_ttft_por_paso_y_sintesis(monkeypatch):
+    plan = "1. Calcular 3 × 4. [depende de: ninguno]"
+
+    class ClientePipeline(ClienteStream):
+        def create(self, model, messages, temperature, timeout, stream=False, stream_options=None, n=1):
+            tarea = messages[-1]["content"]
+            if "Descompón" in tarea: self.fragmentos = (plan,)
+            elif "Evaluación Crítica" in tarea: self.fragmentos = ("Plan coherente.\nVEREDICTO: APROBADO",)
+            elif "INSTRUCCIÓN FINAL" in tarea: self.fragmentos = ("Total", ": 12")
+            else: self.fragmentos = ("Resultado", ": 12")
+            return super().create(model, messages, temperature, timeout, stream, stream_options, n)
+
+    cliente = ClientePipeline(); fragmentos = []
+    resultado = proceso_razonamiento_llm_calculator(cliente, "gpt-4o", "¿Cuánto es 3 × 4?", on_delta=lambda etiqueta, texto: fragmentos.append((etiqueta, texto)))
+    assert resultado["error_message"] is None and resultado["respuesta_final"] == "Total: 12"
+    assert set(resultado["ttft_report"]) == {"Paso 1", "Síntesis"} and all(v >= ESPERA_PRIMERO for v in resultado["ttft_report"].values())
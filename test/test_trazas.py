@@ -0,0 +1,113 @@
+# Tests de las trazas (Trazador): anidamiento de spans, exportación JSONL, métricas Prometheus y cascada de la app.
+import contextvars
+import json
+import re
+import threading
+
+import pytest
+
+from reasoning_core import Trazador
+
+MUESTRA_RE = re.compile(r'^(?P<nombre>[a-z_]+)\{(?P<etiquetas>(?:[a-z_]+="(?:[^"\\]|\\.)*",?)*)\} (?P<valor>\S+)$')
+
+
+def ejecucion(trazador, run_id="r1", nombre_etapa="solving"):
+    with trazador.span("run", "run", run_id=run_id):
+        with trazador.span(nombre_etapa, "stage", stage="solving"):
+            with trazador.span("Paso 1", "step"):
+                with trazador.span("Solución Paso 1", "llm", model="gpt-4o") as llm: llm.update(prompt_tokens=100, completion_tokens=20, cost_usd=0.001)
+            trazador.registrar_span("Paso 2", "step", 0.01, local=True)
+    return {s["name"]: s for s in trazador.spans(run_id)}
+
+
+def test_spans_anidados_heredan_run_id_y_etapa():
+    spans = ejecucion(Trazador(jsonl_path=None))
+    assert spans["run"]["parent_id"] is None
+    assert spans["solving"]["parent_id"] == spans["run"]["span_id"]
+    assert spans["Paso 1"]["parent_id"] == spans["Paso 2"]["parent_id"] == spans["solving"]["span_id"]
+    assert spans["Solución Paso 1"]["parent_id"] == spans["Paso 1"]["span_id"]
+    assert {s["run_id"] for s in spans.values()} == {"r1"} and spans["Solución Paso 1"]["stage"] == "solving"
+    assert spans["run"]["duration_s"] >= spans["solving"]["duration_s"] >= spans["Paso 1"]["duration_s"]
+
+
+def test_span_en_otro_hilo_conserva_el_padre_si_se_propaga_el_contexto():
+    trazador = Trazador(jsonl_path=None)
+    with trazador.span("run", "run", run_id="r1") as run:
+        def en_hilo():
+            with trazador.span("Paso 1", "step"): pass
+        hilo = threading.Thread(target=contextvars.copy_context().run, args=(en_hilo,)); hilo.start(); hilo.join()
+    paso = next(s for s in trazador.spans("r1") if s["name"] == "Paso 1")
+    assert paso["parent_id"] == run["span_id"]
+
+
+def test_excepcion_marca_el_span_como_error():
+    trazador = Trazador(jsonl_path=None)
+    with pytest.raises(RuntimeError):
+        with trazador.span("run", "run", run_id="r1"): raise RuntimeError("caída")
+    assert trazador.spans("r1")[0]["status"] == "error"
+    assert 'reasoning_errors_total{kind="run",stage="",name="run"} 1' in trazador.metricas_prometheus()
+
+
+def test_jsonl_ida_y_vuelta(tmp_path):
+    path = tmp_path / "trazas.jsonl"
+    trazador = Trazador(jsonl_path=str(path))
+    ejecucion(trazador, "r1"); ejecucion(trazador, "r2")
+    exportado = [json.loads(linea) for linea in trazador.exportar_jsonl("r1").splitlines()]
+    assert exportado == trazador.spans("r1") and len(exportado) == 5
+    assert [json.loads(linea) for linea in trazador.exportar_jsonl().splitlines()] == trazador.spans("r1") + trazador.spans("r2")
+    en_archivo = [json.loads(linea) for linea in path.read_text(encoding="utf-8").splitlines()]
+    assert sorted(s["span_id"] for s in en_archivo) == sorted(s["span_id"] for s in trazador.spans("r1") + trazador.spans("r2"))
+
+
+def test_solo_se_conservan_las_ultimas_ejecuciones():
+    trazador = Trazador(jsonl_path=None, max_runs=2)
+    for run_id in ("r1", "r2", "r3"): ejecucion(trazador, run_id)
+    assert trazador.spans("r1") == [] and trazador.spans("r3")
+
+
+def muestras(texto):
+    valores = {}
+    for linea in texto.splitlines():
+        if linea.startswith("#"): continue
+        m = MUESTRA_RE.match(linea); assert m, f"línea Prometheus inválida: {linea!r}"
+        valores[(m["nombre"], m["etiquetas"])] = float(m["valor"])
+    return valores
+
+
+def test_prometheus_help_type_y_muestras():
+    trazador = Trazador(jsonl_path=None)
+    ejecucion(trazador)
+    texto = trazador.metricas_prometheus(); lineas = texto.splitlines()
+    nombres = {n for n, _ in muestras(texto)}
+    for nombre in nombres:
+        ayuda, tipo = lineas.index(next(l for l in lineas if l.startswith(f"# HELP {nombre} "))), lineas.index(f"# TYPE {nombre} counter")
+        primera = next(i for i, l in enumerate(lineas) if l.startswith(nombre + "{"))
+        assert ayuda + 1 == tipo < primera and nombre.endswith("_total")
+    valores = muestras(texto)
+    assert valores[("reasoning_prompt_tokens_total", 'kind="llm",stage="solving"')] == 100
+    assert valores[("reasoning_spans_total", 'kind="step",stage="solving"')] == 2
+
+
+def test_prometheus_escapa_las_etiquetas():
+    trazador = Trazador(jsonl_path=None)
+    ejecucion(trazador, nombre_etapa='etapa "rara" \\ con\nsalto')
+    texto = trazador.metricas_prometheus()
+    assert 'name="etapa \\"rara\\" \\\\ con\\nsalto"' in texto
+    muestras(texto) # Todas las líneas siguen siendo válidas
+
+
+def test_prometheus_contadores_monotonos():
+    trazador = Trazador(jsonl_path=None)
+    ejecucion(trazador, "r1"); antes = muestras(trazador.metricas_prometheus())
+    ejecucion(trazador, "r2"); despues = muestras(trazador.metricas_prometheus())
+    assert set(antes) <= set(despues) and all(despues[k] >= v for k, v in antes.items())
+    assert despues[("reasoning_spans_total", 'kind="run",stage="",name="run"')] == 2
+
+
+def test_cascada_html_escapa_los_nombres():
+    pytest.importorskip("streamlit")
+    from reasoning_app import cascada_spans_html
+    spans = ejecucion(Trazador(jsonl_path=None))
+    spans["Paso 2"]["name"] = "<script>x</script>"
+    html_cascada = cascada_spans_html(sorted(spans.values(), key=lambda s: s["start"]))
+    assert html_cascada.count('style="display:flex') == 5 and "<script>" not in html_cascada and "&lt;script&gt;" in html_cascada
@@ -0,0 +1,78 @@
+# Tests de la autoconsistencia del Solucionador (agente_solucionador_votacion) con un cliente OpenAI simulado que admite 'n='.
+from types import SimpleNamespace
+
+import pytest
+
+import reasoning_core
+from reasoning_core import PlanificadorLLM, agente_solucionador_votacion, paso_fallido, proceso_razonamiento_llm_calculator
+
+PLAN = "1. Calcular el costo de las manzanas del pedido. [depende de: ninguno]"
+
+
+class ClienteMuestras:
+    """Entrega por ronda los contenidos indicados (uno por muestra pedida con 'n=') y anota cuántas se pidieron."""
+
+    def __init__(self, *rondas):
+        self.rondas = list(rondas); self.pedidas = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, timeout, n=1):
+        tarea = messages[-1]["content"]
+        if "Descompón" in tarea: contenidos = [PLAN]
+        elif "Evaluación Crítica" in tarea: contenidos = ["Plan coherente.\nVEREDICTO: APROBADO"]
+        elif "INSTRUCCIÓN FINAL" in tarea: contenidos = ["Costo Total: 12.00"]
+        else: self.pedidas.append(n); contenidos = self.rondas.pop(0); assert len(contenidos) == n
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=c)) for c in contenidos],
+                               usage=SimpleNamespace(prompt_tokens=100, completion_tokens=10 * n, prompt_tokens_details=None))
+
+
+@pytest.fixture(autouse=True)
+def aislado(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "_PLANIFICADOR_LLM", PlanificadorLLM())
+    monkeypatch.setattr(reasoning_core, "ROUTER_SMALL_MODEL", "")
+
+
+def votar(cliente, muestras=3, quorum=None):
+    return agente_solucionador_votacion(cliente, "gpt-4o", "1. Calcular C = 3 × 4", "", muestras=muestras, quorum=quorum)
+
+
+def test_quorum_en_la_primera_ronda_corta_antes():
+    cliente = ClienteMuestras(["Resultado: C = 12", "C = 3 × 4 = 12.0"])
+    respuesta, usage = votar(cliente)
+    assert cliente.pedidas == [2] and respuesta == "Resultado: C = 12" # Quórum 2 de 3: la tercera muestra no se pide
+    assert usage.votacion == {**usage.votacion, "samples": 2, "requests": 1, "votes": 2, "quorum": 2, "agreement": 1.0, "value": 12.0, "consensus": True}
+
+
+def test_mayoria_tras_una_segunda_ronda():
+    cliente = ClienteMuestras(["Resultado: C = 12", "Resultado: C = 13"], ["Resultado: C = 12.0"])
+    respuesta, usage = votar(cliente)
+    assert cliente.pedidas == [2, 1] and respuesta == "Resultado: C = 12"
+    assert usage.votacion["votes"] == 2 and usage.votacion["consensus"] and usage.votacion["requests"] == 2
+    assert usage.prompt_tokens == 200 and usage.completion_tokens == 30
+
+
+def test_empate_gana_la_primera_muestra_sin_consenso():
+    cliente = ClienteMuestras(["Resultado: C = 13", "Resultado: C = 12"])
+    respuesta, usage = votar(cliente, muestras=2)
+    assert respuesta == "Resultado: C = 13" and not usage.votacion["consensus"] and usage.votacion["agreement"] == 0.5
+
+
+def test_quorum_inalcanzable_deja_de_pedir_muestras():
+    cliente = ClienteMuestras(["Resultado: 12", "Resultado: 12", "Resultado: 13", "Resultado: 14"])
+    respuesta, usage = votar(cliente, muestras=5, quorum=4)
+    assert cliente.pedidas == [4] and respuesta == "Resultado: 12" # 2 votos + 1 restante no llegan a 4
+    assert usage.votacion["votes"] == 2 and not usage.votacion["consensus"]
+
+
+def test_muestras_sin_contenido_son_un_fallo_con_su_usage():
+    cliente = ClienteMuestras([None, ""])
+    respuesta, usage = votar(cliente)
+    assert respuesta.startswith("Error Votación") and paso_fallido(respuesta, usage)
+    assert usage.prompt_tokens == 100 and usage.votacion["samples"] == 0 and usage.votacion["value"] is None
+
+
+def test_pipeline_con_muestras_vacias_falla_el_paso_y_cuenta_los_tokens(monkeypatch):
+    monkeypatch.setattr(reasoning_core, "SELF_CONSISTENCY_SAMPLES", 3)
+    resultado = proceso_razonamiento_llm_calculator(ClienteMuestras(["", ""]), "gpt-4o", "¿Cuánto cuestan 3 manzanas a 4 dólares?")
+    assert resultado["error_message"].startswith("Fallo Crítico Paso 1: Error Votación")
+    assert resultado["token_report"]["prompt"] == 3 * 100 # Descomposición, verificación y la votación fallida